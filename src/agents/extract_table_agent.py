@@ -1,5 +1,5 @@
 
-from typing import Literal
+from typing import List, Literal, Optional
 import pymupdf
 from langgraph.graph import END, START, StateGraph
 from langgraph.types import Command
@@ -7,21 +7,16 @@ from langgraph.types import Command
 from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
 from model import BaseState
 from pydantic import BaseModel, Field
-from util_functions import pdf_to_base64_images
+from util_functions import PYMUPDF_LOCK, pdf_to_base64_images
+from page_images import page_image, page_window_size, page_windows
 import os
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
-from util_functions import add_base64image_to_messages
-from azure.core.credentials import AzureKeyCredential
-from agents.prompts.extract_table_prompt import DETECT_CONTINUOUS_TABLES_SYSTEM_PROMPT, DETECT_CONTINUOUS_TABLES_USER_PROMPT, DETECT_IRRELEVANT_TABLES_SYSTEM_PROMPT, DETECT_IRRELEVANT_TABLES_USER_PROMPT
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from prompt_registry import CHARS_PER_TOKEN, PAGE_IMAGE_TOKENS, image_part, register_prompt, text_part
+from agents.prompts.extract_table_prompt import DETECT_CONTINUOUS_TABLES_SYSTEM_PROMPT, DETECT_CONTINUOUS_TABLES_USER_PROMPT, DETECT_IRRELEVANT_TABLES_SYSTEM_PROMPT, DETECT_IRRELEVANT_TABLES_USER_PROMPT, DETECT_IRRELEVANT_TABLES_PACKED_SYSTEM_PROMPT
+from handler.azure_blob_storage_handler import get_blob_storage_manager
+from handler.docint_scheduler import get_docint_scheduler
+from result_writer import document_stem
+from table_fingerprints import fingerprint_store_from_env
 from dotenv import load_dotenv
-from utils import llm
-from langchain_core.prompts.image import ImagePromptTemplate
 import pickle
 
 
@@ -33,12 +28,37 @@ class CheckContinuousTableResult(BaseModel):
 
     result: str = Field(description="One of the following options: CONTINUOUS or DISTINCT. Do not write anything else than one of these options.")
     reason: str = Field(description="Outline your reasoning.")
+    confidence: Optional[float] = Field(default=None, description="Your confidence in the result, between 0 and 1.")
 
 class CheckRelevantTableResult(BaseModel):
     """Represents the result of a verification, including a status and reason."""
 
     result: str = Field(description="One of the following options: RELEVANT or IRRELEVANT. Do not write anything else than one of these options.")
     reason: str = Field(description="Outline your reasoning.")
+    confidence: Optional[float] = Field(default=None, description="Your confidence in the result, between 0 and 1.")
+
+class PackedRelevantTableResult(BaseModel):
+    """Represents the relevance decision for one table of a packed request."""
+
+    table_number: int = Field(description="The number of the table as given in the input.")
+    result: str = Field(description="One of the following options: RELEVANT or IRRELEVANT. Do not write anything else than one of these options.")
+    reason: str = Field(description="Outline your reasoning.")
+    confidence: Optional[float] = Field(default=None, description="Your confidence in the result, between 0 and 1.")
+
+class CheckRelevantTablesResult(BaseModel):
+    """Represents the relevance decisions for all tables of a packed request."""
+
+    results: List[PackedRelevantTableResult] = Field(description="One result for each of the given tables.")
+
+CONTINUOUS_TABLES_PROMPT = register_prompt(
+    "detect_continuous_tables", DETECT_CONTINUOUS_TABLES_SYSTEM_PROMPT, CheckContinuousTableResult, DETECT_CONTINUOUS_TABLES_USER_PROMPT
+)
+RELEVANT_TABLE_PROMPT = register_prompt(
+    "detect_relevant_table", DETECT_IRRELEVANT_TABLES_SYSTEM_PROMPT, CheckRelevantTableResult, DETECT_IRRELEVANT_TABLES_USER_PROMPT
+)
+RELEVANT_TABLES_PROMPT = register_prompt(
+    "detect_relevant_tables", DETECT_IRRELEVANT_TABLES_PACKED_SYSTEM_PROMPT, CheckRelevantTablesResult, DETECT_IRRELEVANT_TABLES_USER_PROMPT
+)
 
 def _init(
     state: BaseState,
@@ -64,21 +84,117 @@ def _pdf_to_base64_images(
     state: BaseState,
 ) -> Command[Literal["extract_tables_and_page_contents"]]:
     """Splits the document into page images"""
-    pdf_bytes = pymupdf.open(state.doc_path).tobytes()
+    with PYMUPDF_LOCK:
+        with pymupdf.open(state.doc_path) as document:
+            page_count = document.page_count
+            if page_window_size(page_count) is not None:
+                # the pages of large documents are rendered on demand, see `page_images`
+                return Command(update={"page_count": page_count, "pdf_page_images": []}, goto="extract_tables_and_page_contents")
+            pdf_bytes = document.tobytes()
     pdf_page_images = pdf_to_base64_images(pdf_bytes)
 
-    return Command(update={"pdf_page_images": pdf_page_images}, goto="extract_tables_and_page_contents")
+    return Command(update={"page_count": page_count, "pdf_page_images": pdf_page_images}, goto="extract_tables_and_page_contents")
+
+def _document_url(state: BaseState) -> Optional[str]:
+    """Returns the SAS URL of a document from blob storage, or None if it has to be uploaded."""
+    if state.blob_name:
+        sas_url = get_blob_storage_manager().generate_sas_url(state.blob_name)
+        if sas_url:
+            return sas_url
+        print(f"Uploading '{state.doc_path}' because no SAS URL could be generated for blob '{state.blob_name}'.")
+    return None
+
+def _analyze_document_request(state: BaseState) -> AnalyzeDocumentRequest:
+    """Builds the analyze request of a document.
+
+    Documents from blob storage are analyzed by a SAS URL, so Document Intelligence reads them
+    from the storage account and they do not have to be uploaded. Local documents, and blob
+    documents for which no SAS URL can be generated, are uploaded as bytes.
+    """
+    sas_url = _document_url(state)
+    if sas_url:
+        return AnalyzeDocumentRequest(url_source=sas_url)
+    with open(state.doc_path, "rb") as fd:
+        return AnalyzeDocumentRequest(bytes_source=fd.read())
+
+def _window_request(document: pymupdf.Document, first_page: int, last_page: int) -> AnalyzeDocumentRequest:
+    """Builds the analyze request of an uploaded window from a PDF with only its pages (1-based, inclusive)."""
+    with PYMUPDF_LOCK:
+        with pymupdf.open() as window:
+            window.insert_pdf(document, from_page=first_page - 1, to_page=last_page - 1)
+            # without a new /ID the bytes of a window are the same in every run, e.g. for the cassettes
+            return AnalyzeDocumentRequest(bytes_source=window.tobytes(garbage=1, no_new_id=True))
+
+def get_table(analyze_result, table_index):
+    """Get the table details including caption, headers, and rows."""
+    table = analyze_result["tables"][table_index]
+
+    # Get caption
+    caption = ""
+    if "caption" in table and table["caption"]:
+        caption = table["caption"].get("content", "") or ""
+    else:
+        caption = ""
+
+        # Build a mapping of (rowIndex, columnIndex) -> cell
+    cell_map = {}
+    merged_cells = 0
+    for cell in table["cells"]:
+        key = (cell["rowIndex"], cell["columnIndex"])
+        cell_map[key] = cell
+        if (cell.get("rowSpan") or 1) > 1 or (cell.get("columnSpan") or 1) > 1:
+            merged_cells += 1
+
+        # Get the number of columns and rows
+    num_columns = table.get("columnCount", 0)
+    num_rows = table.get("rowCount", 0)
+
+    # Get headers from rowIndex == 0
+    headers = []
+    for col_index in range(num_columns):
+        key = (0, col_index)
+        if key in cell_map:
+            cell = cell_map[key]
+            content = cell.get("content", "") or ""
+            headers.append(content)
+        else:
+            headers.append("")
+
+            # Get data rows starting from rowIndex == 1
+    rows = []
+    for row_index in range(1, num_rows):
+        row = []
+        for col_index in range(num_columns):
+            key = (row_index, col_index)
+            if key in cell_map:
+                cell = cell_map[key]
+                content = cell.get("content", "") or ""
+                row.append(content)
+            else:
+                row.append("")
+        rows.append(row)
+
+    return {"caption": caption, "headers": headers, "rows": rows, "merged_cells": merged_cells}
+
+def get_table_content(table_dict):
+    """Create a string representation of the table, separate the columns with ||"""
+    table_content = ""
+    table_content += table_dict["caption"] + "\n"
+    table_content += "||".join(table_dict["headers"]) + "\n"
+    for row in table_dict["rows"]:
+        table_content += "||".join(row) + "\n"
+    return table_content
+
 
 def _extract_tables_and_page_contents(
     state: BaseState,
 ) -> Command[Literal["concatenate_tables"]]:
     """Extract tables and pages contents from images"""
 
-    def get_page_content(analyze_result: AnalyzeResult, page_number: int):
+    def get_page_content(analyze_result: AnalyzeResult, page):
         """Get the full textual content of the specified page from the document."""
         # Implementation to extract content from AnalyzeResult object
         # Assuming 'analyze_result' is the AnalyzeResult object.
-        page = analyze_result.pages[page_number - 1]  # Pages are 1-indexed
         content = ""
         for span in page.spans:
             offset = span.offset
@@ -86,63 +202,6 @@ def _extract_tables_and_page_contents(
             content += analyze_result.content[offset: offset + length]
         return content
 
-    def get_table(analyze_result, table_index):
-        """Get the table details including caption, headers, and rows."""
-        table = analyze_result["tables"][table_index]
-
-        # Get caption
-        caption = ""
-        if "caption" in table and table["caption"]:
-            caption = table["caption"].get("content", "") or ""
-        else:
-            caption = ""
-
-            # Build a mapping of (rowIndex, columnIndex) -> cell
-        cell_map = {}
-        for cell in table["cells"]:
-            key = (cell["rowIndex"], cell["columnIndex"])
-            cell_map[key] = cell
-
-            # Get the number of columns and rows
-        num_columns = table.get("columnCount", 0)
-        num_rows = table.get("rowCount", 0)
-
-        # Get headers from rowIndex == 0
-        headers = []
-        for col_index in range(num_columns):
-            key = (0, col_index)
-            if key in cell_map:
-                cell = cell_map[key]
-                content = cell.get("content", "") or ""
-                headers.append(content)
-            else:
-                headers.append("")
-
-                # Get data rows starting from rowIndex == 1
-        rows = []
-        for row_index in range(1, num_rows):
-            row = []
-            for col_index in range(num_columns):
-                key = (row_index, col_index)
-                if key in cell_map:
-                    cell = cell_map[key]
-                    content = cell.get("content", "") or ""
-                    row.append(content)
-                else:
-                    row.append("")
-            rows.append(row)
-
-        return {"caption": caption, "headers": headers, "rows": rows}
-
-    def get_table_content(table_dict):
-        """Create a string representation of the table, separate the columns with ||"""
-        table_content = ""
-        table_content += table_dict["caption"] + "\n"
-        table_content += "||".join(table_dict["headers"]) + "\n"
-        for row in table_dict["rows"]:
-            table_content += "||".join(row) + "\n"
-        return table_content
-
     def get_page_tables(analyze_result: AnalyzeResult, page_number: int):
         """Get the tables detected on the specified page."""
         # Implementation to extract tables from AnalyzeResult object
@@ -160,36 +219,96 @@ def _extract_tables_and_page_contents(
         return table_page
 
 
-    with DocumentIntelligenceClient(
-        endpoint=os.getenv("ENDPOINT_DOCINT"), credential=AzureKeyCredential(os.getenv("API_KEY_DOCINT"))
-    ) as document_intelligence_client:
-        file_path = state.doc_path
-        with open(file_path, "rb") as fd:
-            poller = document_intelligence_client.begin_analyze_document(
-                "prebuilt-layout",
-                AnalyzeDocumentRequest(bytes_source=fd.read()),
-            )
-            analyze_result = poller.result()
+    # Large documents are analyzed in windows of pages, so only the AnalyzeResult of one window
+    # is held at a time and their page images are rendered on demand instead of kept in the state.
+    # A document with a SAS URL is read by Document Intelligence, which analyzes the pages of
+    # the window; otherwise only a PDF with the pages of the window is uploaded, whose page
+    # numbers start at 1 again. Tables are numbered across the windows and continuations across
+    # a window boundary are detected by `_concatenate_tables` like any other.
+    window_size = page_window_size(state.page_count)
+    windows = page_windows(state.page_count, window_size) if window_size else [(1, state.page_count)]
+    document_url = None
+    document = None
+    if window_size:
+        print(f"Processing {state.page_count} pages in {len(windows)} windows of {window_size} pages.")
+        document_url = _document_url(state)
+        if document_url is None:
+            with PYMUPDF_LOCK:
+                document = pymupdf.open(state.doc_path)
 
     # We need to have the result in a list of pages and a list of tables
     # pages: List[Dict[str, Any]] = [], where a dictionary is {"page_number": int, "content": str, "tables": List[int]}
     # tables: List[Dict[str, Any]] = [], where a dictionary is {"table_number": int, "content": str, "pages": List[int]}
 
     pages = []
-    for page in analyze_result.pages:
-        page_content = get_page_content(analyze_result, page.page_number)
-        page_tables = get_page_tables(analyze_result, page.page_number)
-        page_image = state.pdf_page_images[page.page_number - 1]
-        pages.append({"number": page.page_number, "content": page_content, "tables": page_tables, "base64": page_image})
-
     tables = []
-    for table_index, table in enumerate(analyze_result.tables):
-        table_number = table_index
-        table_content = get_table_content(get_table(analyze_result, table_index))
-        tables.append({"number": table_number, "content": table_content, "pages": [get_table_page(analyze_result, table_index)-1]})
+    try:
+        for first_page, last_page in windows:
+            # the analyses of all documents share one client and one limit of analyses in flight
+            page_offset = 0
+            pages_selection = None
+            if not window_size:
+                analyze_request = _analyze_document_request(state)
+            elif document_url:
+                analyze_request = AnalyzeDocumentRequest(url_source=document_url)
+                pages_selection = f"{first_page}-{last_page}"
+            else:
+                analyze_request = _window_request(document, first_page, last_page)
+                page_offset = first_page - 1
+            analyze_result = get_docint_scheduler().analyze(
+                "prebuilt-layout", analyze_request, page_count=last_page - first_page + 1, pages=pages_selection
+            )
+            first_table_number = len(tables)
+
+            for page in analyze_result.pages:
+                page_number = page.page_number + page_offset
+                page_content = get_page_content(analyze_result, page)
+                page_tables = [first_table_number + table_index for table_index in get_page_tables(analyze_result, page.page_number)]
+                if window_size:
+                    pages.append({"number": page_number, "content": page_content, "tables": page_tables, "base64": None, "doc_path": state.doc_path})
+                else:
+                    page_image = state.pdf_page_images[page_number - 1]
+                    pages.append({"number": page_number, "content": page_content, "tables": page_tables, "base64": page_image})
+
+            for table_index, table in enumerate(analyze_result.tables):
+                table_number = first_table_number + table_index
+                table_grid = get_table(analyze_result, table_index)
+                table_content = get_table_content(table_grid)
+                table_page = get_table_page(analyze_result, table_index) + page_offset
+                tables.append({"number": table_number, "content": table_content, "pages": [table_page - 1], "grid": table_grid})
+
+            # release the request and the result of the window before the next one is analyzed
+            del analyze_request, analyze_result
+    finally:
+        if document is not None:
+            with PYMUPDF_LOCK:
+                document.close()
 
     return Command(update={"pages": pages, "tables": tables}, goto="concatenate_tables")
 
+def merge_table_grids(grids, pages):
+    """Merge the grids of table parts that span several pages into one grid.
+
+    A part that repeats the header of the first part contributes only its rows. Otherwise the
+    header detected by Document Intelligence is a regular data row and is kept. `pages` holds
+    the page index of every part; the merged grid records the page of every row in "row_pages".
+    """
+    merged = {
+        "caption": grids[0]["caption"],
+        "headers": grids[0]["headers"],
+        "rows": list(grids[0]["rows"]),
+        "row_pages": [pages[0]] * len(grids[0]["rows"]),
+        "merged_cells": sum(grid.get("merged_cells", 0) for grid in grids),
+    }
+    for grid, page in zip(grids[1:], pages[1:]):
+        if grid["headers"] != merged["headers"]:
+            merged["rows"].append(grid["headers"])
+            merged["row_pages"].append(page)
+        merged["rows"].extend(grid["rows"])
+        merged["row_pages"].extend([page] * len(grid["rows"]))
+    return merged
+
+
 def add_merged_table(tables, tables_to_merge, pages):
     """Merge tables that belong together"""
     table_index = len(tables)
@@ -197,6 +316,9 @@ def add_merged_table(tables, tables_to_merge, pages):
              "content": "\n".join(table["content"] for table in tables_to_merge),
              "pages": list(table["pages"][0] for table in tables_to_merge)
             }
+    grids = [table.get("grid") for table in tables_to_merge]
+    if all(grids):
+        table["grid"] = merge_table_grids(grids, table["pages"])
     tables.append(table)
     
     for table in tables_to_merge:
@@ -207,7 +329,7 @@ def add_merged_table(tables, tables_to_merge, pages):
 
 def _concatenate_tables(
     state: BaseState,
-) -> Command[Literal["filter_irrelevant_tables"]]:
+) -> Command[Literal["reuse_known_tables"]]:
     """Concatenates tables which belong together"""
     tables = []
     pages = state.pages
@@ -220,7 +342,7 @@ def _concatenate_tables(
         while table_index < len(state.tables):
             if tables_to_merge[-1]["pages"][0] + 1 == state.tables[table_index]["pages"][0]:
                 last_page = tables_to_merge[-1]["pages"][0]
-                tables_spills_to_next_page = check_if_table_spills(state.pdf_page_images[last_page], state.pdf_page_images[last_page + 1])
+                tables_spills_to_next_page = check_if_table_spills(page_image(pages[last_page]), page_image(pages[last_page + 1]))
                 
                 if tables_spills_to_next_page:
                     #add_merged_table(tables, tables_to_merge)
@@ -237,35 +359,47 @@ def _concatenate_tables(
         if table_index == len(state.tables):
             add_merged_table(tables, tables_to_merge, pages)
             
-    return Command(update={"pages": pages, "tables": tables}, goto="filter_irrelevant_tables")
+    return Command(update={"pages": pages, "tables": tables}, goto="reuse_known_tables")
     
 
 
 def check_if_table_spills(page1, page2):
-    parser = JsonOutputParser(pydantic_object=CheckContinuousTableResult)
-    messages = ChatPromptTemplate(
-        [
-            SystemMessagePromptTemplate.from_template(
-                DETECT_CONTINUOUS_TABLES_SYSTEM_PROMPT,
-                partial_variables={"format_instructions": parser.get_format_instructions()},
-            ),
-            HumanMessagePromptTemplate.from_template(
-                DETECT_CONTINUOUS_TABLES_USER_PROMPT,
-                #partial_variables={"pages": page1},
-                type="text",
-            ),
-        ]
-    )
-    
-    add_base64image_to_messages(messages, page1)
-    add_base64image_to_messages(messages, page2)
-    
-    chain = messages | llm | parser
-    resp = chain.invoke({})
+    resp = CONTINUOUS_TABLES_PROMPT.invoke([image_part(page1), image_part(page2)])
     resp = CheckContinuousTableResult.model_validate(resp)
     
     return resp.result == "CONTINUOUS"
 
+def _reuse_known_tables(
+    state: BaseState,
+) -> Command[Literal["filter_irrelevant_tables"]]:
+    """Takes over the results of tables that were already processed as part of another document"""
+    store = fingerprint_store_from_env()
+    if store is None:
+        return Command(update={}, goto="filter_irrelevant_tables")
+
+    tables = []
+    try:
+        for table in state.tables:
+            table = dict(table)
+            match = store.find(table["content"], exclude_document=document_stem(state.doc_path))
+            if match is not None and match["relevant"] is not None:
+                table["relevant"] = match["relevant"]
+                table["reused_from"] = {key: match[key] for key in ("document", "table_number", "similarity")}
+                if match["relevant"] and match["extracted_data"] is not None:
+                    table["extracted_data"] = match["extracted_data"]
+                    table["extraction_source"] = "reused"
+                    if match["normalized"] is not None:
+                        table["normalized"] = match["normalized"]
+            tables.append(table)
+    finally:
+        store.close()
+
+    reused = sum("reused_from" in table for table in tables)
+    if reused:
+        print(f"Reusing the results of {reused} of {len(tables)} tables from other documents.")
+    return Command(update={"tables": tables}, goto="filter_irrelevant_tables")
+
+
 def _filter_irrelevant_tables(
     state: BaseState,
 ) -> Command[Literal["__end__"]]:
@@ -273,9 +407,30 @@ def _filter_irrelevant_tables(
     relevant_tables = []
     relevant_pages_numbers = set()
 
+    # the relevance of reused tables is already known
+    relevance = {table["number"]: table["relevant"] for table in state.tables if "reused_from" in table}
+    unknown_tables = [table for table in state.tables if "reused_from" not in table]
+    if os.getenv("RELEVANCE_PACKING", "True") == "True":
+        max_tokens = int(os.getenv("RELEVANCE_PACK_MAX_TOKENS", "20000"))
+        max_tables = int(os.getenv("RELEVANCE_PACK_MAX_TABLES", "6"))
+        for pack in pack_tables_for_relevance(state.pages, unknown_tables, max_tokens, max_tables):
+            relevance.update(check_if_tables_relevant(state.pages, pack))
+    else:
+        relevance.update({table["number"]: check_if_table_relevant(state.pages, table) for table in unknown_tables})
+
+    # irrelevant tables are registered right away, relevant ones once they are normalized
+    store = fingerprint_store_from_env()
+    if store is not None:
+        try:
+            for table in unknown_tables:
+                if not relevance[table["number"]]:
+                    store.register(document_stem(state.doc_path), table, relevant=False)
+        finally:
+            store.close()
+
     for table in state.tables:
         # Check whether the table is relevant
-        if check_if_table_relevant(state.pages, table):
+        if relevance[table["number"]]:
             relevant_tables.append(table)
             relevant_pages_numbers.update(table["pages"])
 
@@ -293,50 +448,92 @@ def _filter_irrelevant_tables(
 
 
 def check_if_table_relevant(pages, table):
-    parser = JsonOutputParser(pydantic_object=CheckRelevantTableResult)
-    messages = ChatPromptTemplate(
-        [
-            SystemMessagePromptTemplate.from_template(
-                DETECT_IRRELEVANT_TABLES_SYSTEM_PROMPT,
-                partial_variables={"format_instructions": parser.get_format_instructions()},
-            ),
-            HumanMessagePromptTemplate.from_template(
-                DETECT_IRRELEVANT_TABLES_USER_PROMPT,
-                type="text",
-            ),
-        ]
-    )
-
     # Get the pages associated with the table
     table_pages = [pages[page_number] for page_number in table["pages"]]
 
-    # Add the table content
-    table_content = table["content"]
-    messages.append(
-        HumanMessagePromptTemplate.from_template(table_content, type="text")
-    )
-
-    # Add the page contents
-    # Gather page contents
-    pages_content = "\n".join(page["content"] for page in table_pages)
-    messages.append(
-        HumanMessagePromptTemplate.from_template(pages_content, type="text")
-        )
+    # Add the table content and the page contents
+    content = [text_part(table["content"]), text_part("\n".join(page["content"] for page in table_pages))]
 
     # Add the page images
-    # Get page images
-    page_images = [page["base64"] for page in table_pages]
-    for page_image in page_images:
-        add_base64image_to_messages(messages, page_image)
+    content.extend(image_part(page_image(page)) for page in table_pages)
 
-
-    chain = messages | llm | parser
-    resp = chain.invoke({})
+    resp = RELEVANT_TABLE_PROMPT.invoke(content)
     resp = CheckRelevantTableResult.model_validate(resp)
 
     return resp.result == "RELEVANT"
 
 
+def _estimate_tokens(pages, table, known_pages):
+    """Estimates the tokens a table adds to a request that already contains the known pages."""
+    tokens = len(table["content"]) // CHARS_PER_TOKEN
+    for page_number in set(table["pages"]) - known_pages:
+        tokens += len(pages[page_number]["content"]) // CHARS_PER_TOKEN + PAGE_IMAGE_TOKENS
+    return tokens
+
+
+def pack_tables_for_relevance(pages, tables, max_tokens, max_tables):
+    """Group tables into packs for combined relevance requests.
+
+    Tables are taken in document order. A page that is already part of a pack costs nothing
+    for further tables on it, so tables sharing pages end up in the same pack whenever the
+    estimated token budget allows it.
+    """
+    packs = []
+    pack, pack_pages, pack_tokens = [], set(), 0
+    for table in tables:
+        table_tokens = _estimate_tokens(pages, table, pack_pages)
+        if pack and (pack_tokens + table_tokens > max_tokens or len(pack) >= max_tables):
+            packs.append(pack)
+            pack, pack_pages, pack_tokens = [], set(), 0
+            table_tokens = _estimate_tokens(pages, table, pack_pages)
+
+        pack.append(table)
+        pack_pages.update(table["pages"])
+        pack_tokens += table_tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def check_if_tables_relevant(pages, tables):
+    """Decide the relevance of several tables with one request.
+
+    Returns a mapping from table number to relevance. Tables that are missing in the response
+    or a response that cannot be parsed fall back to one request per table.
+    """
+    if len(tables) == 1:
+        return {tables[0]["number"]: check_if_table_relevant(pages, tables[0])}
+
+    # Add every page of the pack only once
+    content = []
+    page_numbers = sorted({page_number for table in tables for page_number in table["pages"]})
+    for page_number in page_numbers:
+        page = pages[page_number]
+        content.append(text_part(f"Page {page['number']}:\n{page['content']}"))
+        content.append(image_part(page_image(page)))
+
+    # Add the table contents
+    for table in tables:
+        table_pages = ", ".join(str(pages[page_number]["number"]) for page_number in table["pages"])
+        content.append(text_part(f"Table {table['number']} (pages {table_pages}):\n{table['content']}"))
+
+    relevance = {}
+    try:
+        resp = RELEVANT_TABLES_PROMPT.invoke(content)
+        resp = CheckRelevantTablesResult.model_validate(resp)
+        table_numbers = {table["number"] for table in tables}
+        for result in resp.results:
+            if result.table_number in table_numbers:
+                relevance[result.table_number] = result.result == "RELEVANT"
+    except Exception as e:
+        print(f"Packed relevance check failed, falling back to single requests: {e}")
+
+    for table in tables:
+        if table["number"] not in relevance:
+            relevance[table["number"]] = check_if_table_relevant(pages, table)
+    return relevance
+
+
 def construct_extract_table_agent():
     """Constructs and returns the state graph for extracting tables."""
     workflow = StateGraph(BaseState)
@@ -344,6 +541,7 @@ def construct_extract_table_agent():
     workflow.add_node("pdf_to_base64_images", _pdf_to_base64_images)
     workflow.add_node("extract_tables_and_page_contents", _extract_tables_and_page_contents)
     workflow.add_node("concatenate_tables", _concatenate_tables)
+    workflow.add_node("reuse_known_tables", _reuse_known_tables)
     workflow.add_node("filter_irrelevant_tables",_filter_irrelevant_tables)
 
     workflow.add_edge(START, "init")
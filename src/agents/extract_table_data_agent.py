@@ -1,27 +1,36 @@
-import json
 import os
-import re
-import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Literal
 
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import (ChatPromptTemplate,
-                                    HumanMessagePromptTemplate,
-                                    SystemMessagePromptTemplate)
 from langgraph.graph import END, START, StateGraph
 from langgraph.types import Command
 from openai import BadRequestError
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
-from utils import llm
 from model import ExtractTableDataState
 from utils_mock_extract_table_data import mock_extract_table_data_state
 import pickle
 from agents.prompts.step2_prompts import (
+    CORRECT_CELLS,
     EXTRACT_DATA,
+    EXTRACT_DATA_CHUNK,
     VERIFY_DATA
 )
-from util_functions import add_base64image_to_messages
+from prompt_registry import image_part, register_prompt, text_part
+from page_images import page_image
+from result_writer import TableResultWriter
+from table_validation import (
+    assess_grid_quality,
+    check_row,
+    detect_weight_percent,
+    flagged_cells_of,
+    format_mismatches,
+    grid_to_table_data,
+    ocr_numbers,
+    patch_table_data,
+    stitch_table_chunks,
+    verify_table_locally,
+)
 import copy
 
 
@@ -30,10 +39,104 @@ class TableDataResult(BaseModel):
     table_data: List[List[str]] = Field(description="The structured table data.")
     is_weight_percent: bool = Field(description="True if the table data is in weight%, False if in mol%. Or NaN if you are unsure.")
 
+class FlaggedCell(BaseModel):
+    """Represents a wrong cell, or a wrong row if no column is given."""
+    row: int = Field(description="0-based index of the row in the table data.")
+    column: int | None = Field(default=None, description="0-based index of the column in the row, or null if the whole row is wrong.")
+
 class VerifyExtractionResult(BaseModel):
     """Represents """
     feedback: str = Field(description="List of ALL errors that were made.")
     reextraction_necessary: bool = Field(description="True if too many values are incorrect in the current state of the table and thus the data are not reliable. False otherwise.")
+    flagged_cells: List[FlaggedCell] = Field(default=[], description="All wrong cells, and all wrong rows without a column.")
+
+class CorrectedCell(BaseModel):
+    """Represents the corrected value of a flagged cell."""
+    row: int = Field(description="0-based index of the row in the table data.")
+    column: int = Field(description="0-based index of the column in the row.")
+    value: str = Field(description="The corrected value of the cell.")
+
+class CorrectedRow(BaseModel):
+    """Represents the corrected values of a flagged row."""
+    row: int = Field(description="0-based index of the row in the table data.")
+    values: List[str] = Field(description="All values of the corrected row.")
+
+class CellCorrectionResult(BaseModel):
+    """Represents the corrections of the flagged cells and rows of a table."""
+    cells: List[CorrectedCell] = Field(description="The corrected flagged cells.")
+    rows: List[CorrectedRow] = Field(default=[], description="The corrected flagged rows.")
+
+EXTRACT_DATA_PROMPT = register_prompt("extract_table_data", EXTRACT_DATA, TableDataResult)
+EXTRACT_DATA_CHUNK_PROMPT = register_prompt("extract_table_data_chunk", EXTRACT_DATA_CHUNK, TableDataResult)
+VERIFY_DATA_PROMPT = register_prompt("verify_table_data", VERIFY_DATA, VerifyExtractionResult)
+CORRECT_CELLS_PROMPT = register_prompt("correct_table_cells", CORRECT_CELLS, CellCorrectionResult)
+
+# flagged tables are corrected cell by cell up to this share of flagged cells, beyond it they are re-extracted
+MAX_CORRECTED_CELL_SHARE = 0.25
+# a streamed extraction is aborted if, after this many rows, most numeric cells are not in the OCR text
+STREAM_ABORT_MIN_ROWS = 5
+STREAM_ABORT_MISMATCH_SHARE = 0.5
+
+
+class MalformedExtractionError(ValueError):
+    """Raised while streaming an extraction whose rows are malformed, to stop the generation early."""
+
+
+def _check_streamed_row(row_index, row, header_width, known_numbers) -> int:
+    """Checks a completed row of a streamed extraction and returns the number of its numeric cells missing from the OCR text."""
+    if not isinstance(row, list) or not all(isinstance(cell, str) for cell in row):
+        raise MalformedExtractionError(f"Row {row_index} is not a list of strings: {row}")
+    if len(row) != header_width:
+        raise MalformedExtractionError(f"Row {row_index} has {len(row)} columns, but the header row has {header_width}.")
+    return len(check_row(row_index, row, known_numbers))
+
+
+def _streamed_rows(partial) -> list:
+    """Returns the rows of a (partial) streamed extraction, which are empty until the header row has started."""
+    rows = (partial.get("table_data") or []) if isinstance(partial, dict) else []
+    if not isinstance(rows, list):
+        raise MalformedExtractionError(f"The table data is not a list of rows: {rows}")
+    if rows and not isinstance(rows[0], list):
+        raise MalformedExtractionError(f"The header row is not a list of strings: {rows[0]}")
+    return rows
+
+
+def _invoke_extraction(prompt, content, ocr_text) -> dict:
+    """Runs an extraction prompt and returns the validated TableDataResult as a dictionary.
+
+    With STREAMING_EXTRACTION, the answer is streamed and every row is checked against the OCR
+    text as soon as it is complete. Malformed rows, or mostly unknown numbers after the first
+    rows, stop the generation with a MalformedExtractionError instead of waiting for the rest
+    of a bad answer. An answer that does not match TableDataResult raises a
+    MalformedExtractionError as well.
+    """
+    if os.getenv("STREAMING_EXTRACTION", "True") != "True":
+        return prompt.invoke(content)
+
+    known_numbers = ocr_numbers(ocr_text)
+    result, checked_rows, mismatched_cells = None, 0, 0
+    stream = prompt.stream(content)
+    try:
+        for partial in stream:
+            result = partial
+            rows = _streamed_rows(partial)
+            # the last row can still be growing, all rows before it are complete
+            while checked_rows < len(rows) - 1:
+                mismatched_cells += _check_streamed_row(checked_rows, rows[checked_rows], len(rows[0]), known_numbers)
+                checked_rows += 1
+                if checked_rows >= STREAM_ABORT_MIN_ROWS and mismatched_cells > STREAM_ABORT_MISMATCH_SHARE * checked_rows * len(rows[0]):
+                    raise MalformedExtractionError(f"{mismatched_cells} values of the first {checked_rows} rows do not appear in the OCR text.")
+    finally:
+        stream.close()
+
+    # all rows are checked again, the final answer replaces the streamed one if it was escalated to the main model
+    rows = _streamed_rows(result)
+    for row_index in range(len(rows)):
+        _check_streamed_row(row_index, rows[row_index], len(rows[0]), known_numbers)
+    try:
+        return TableDataResult.model_validate(result).model_dump()
+    except ValidationError as e:
+        raise MalformedExtractionError(f"The answer does not match the expected format: {e}") from e
 
 def _init(state: ExtractTableDataState) -> Command[Literal["extract_table_data"]]:
     # nothing to do since everything is already in the state
@@ -41,13 +144,123 @@ def _init(state: ExtractTableDataState) -> Command[Literal["extract_table_data"]
         with open('data/step2.pkl', 'rb') as f:
             state = pickle.load(f)
         return Command(update=state, goto=END)
+    # tables reused from other documents are not extracted again, their results are saved right away
+    writer = TableResultWriter(state.doc_path, "table_data")
+    for table in state.tables:
+        if table.get("extraction_source") == "reused":
+            writer.write_table(table)
     return Command(update={}, goto="extract_table_data")
 
 
+def _extract_table_data_from_grid(state: ExtractTableDataState, table) -> dict | None:
+    """Uses the Document Intelligence grid of a table as extraction result if it passes the quality checks."""
+    if os.getenv("DI_GRID_FAST_PATH", "True") != "True":
+        return None
+    if assess_grid_quality(table.get("grid")):
+        return None
+
+    # the unit is usually given in the table itself, otherwise in the text of its pages
+    is_weight_percent = detect_weight_percent(table["content"])
+    if is_weight_percent is None:
+        pages_content = "\n".join(p["content"] for p in state.pages if p["number"] - 1 in table["pages"])
+        is_weight_percent = detect_weight_percent(pages_content)
+    if is_weight_percent is None:
+        return None
+
+    return TableDataResult(table_data=grid_to_table_data(table["grid"]), is_weight_percent=is_weight_percent).model_dump()
+
+
+def _page_images(state: ExtractTableDataState, page_indices) -> list:
+    """Builds the image content parts of the pages with the given 0-based indices."""
+    pages_by_index = {p["number"] - 1: p for p in state.pages}
+    return [image_part(page_image(pages_by_index[p_nr])) for p_nr in page_indices]
+
+
+def _table_content(state: ExtractTableDataState, table) -> list:
+    """Builds the content parts with the OCR text of a table and the images of all pages that cover parts of it."""
+    return [text_part(f"OCR Text: {table['content']}")] + _page_images(state, table["pages"])
+
+
+def _extract_table_data_in_chunks(state: ExtractTableDataState, table) -> dict | None:
+    """Extracts a large table in row chunks that are sent to the LLM concurrently.
+
+    Every chunk gets the caption and header of the Document Intelligence grid, a range of its
+    rows and the images of the pages these rows are on. The chunk results are stitched back
+    into one table; if they do not fit together, None is returned and the table is extracted
+    as a whole.
+    """
+    if os.getenv("ROW_CHUNKED_EXTRACTION", "True") != "True":
+        return None
+    grid = table.get("grid")
+    if not grid or len(grid["rows"]) < int(os.getenv("ROW_CHUNK_MIN_ROWS", "30")):
+        return None
+
+    chunk_size = int(os.getenv("ROW_CHUNK_SIZE", "15"))
+    row_pages = grid.get("row_pages") or [table["pages"][0]] * len(grid["rows"])
+    chunks = [range(start, min(start + chunk_size, len(grid["rows"]))) for start in range(0, len(grid["rows"]), chunk_size)]
+
+    def extract_chunk(row_indices):
+        ocr_text = "\n".join([grid["caption"], "||".join(grid["headers"])] + ["||".join(grid["rows"][i]) for i in row_indices])
+        content = [text_part(f"OCR Text: {ocr_text}")] + _page_images(state, sorted({row_pages[i] for i in row_indices}))
+        return TableDataResult.model_validate(_invoke_extraction(EXTRACT_DATA_CHUNK_PROMPT, content, ocr_text))
+
+    try:
+        with ThreadPoolExecutor(max_workers=int(os.getenv("ROW_CHUNK_CONCURRENCY", "4"))) as executor:
+            results = list(executor.map(extract_chunk, chunks))
+    except Exception as e:
+        print(f"Chunked extraction of table '{table['number']}' failed, extracting it as a whole: {e}")
+        return None
+
+    table_data, reasons = stitch_table_chunks([result.table_data for result in results])
+    if reasons:
+        print(f"Chunks of table '{table['number']}' do not fit together, extracting it as a whole: {' '.join(reasons)}")
+        return None
+    weight_percent_votes = sum(result.is_weight_percent for result in results)
+    is_weight_percent = weight_percent_votes * 2 > len(results) or (weight_percent_votes * 2 == len(results) and results[0].is_weight_percent)
+    return TableDataResult(table_data=table_data, is_weight_percent=is_weight_percent).model_dump()
+
+
+def _cell_correction_applicable(table, flagged_cells) -> bool:
+    """Checks whether the flagged cells and rows are few enough to correct them instead of re-extracting the table."""
+    table_data = (table.get("extracted_data") or {}).get("table_data") or []
+    cell_count = sum(len(row) for row in table_data)
+    if not flagged_cells or not cell_count:
+        return False
+    column_count = max(len(row) for row in table_data)
+    flagged_count = sum(1 if cell["column"] is not None else column_count for cell in flagged_cells)
+    return flagged_count <= MAX_CORRECTED_CELL_SHARE * cell_count
+
+
+def _correct_flagged_cells(state: ExtractTableDataState, current_idx, current_table) -> Command[Literal["verify_table_data"]]:
+    """Lets the LLM correct only the flagged cells and rows and patches the corrections into the table data."""
+    extracted_data = current_table["extracted_data"]
+    content = [
+        text_part(f"Extracted Table Data: {extracted_data['table_data']}"),
+        text_part(f"Flagged cells and rows: {state.flagged_cells}"),
+        text_part(f"Verification feedback: {state.feedback}"),
+    ] + _table_content(state, current_table)
+
+    try:
+        resp = CellCorrectionResult.model_validate(CORRECT_CELLS_PROMPT.invoke(content))
+    except BadRequestError as e:
+        if e.code != "content_filter":
+            raise e
+        print(f"Content filter error during LLM processing for table '{current_idx}'")
+        resp = CellCorrectionResult(cells=[], rows=[])
+
+    update_tables = copy.deepcopy(state.tables)
+    update_tables[current_idx]["extracted_data"] = {
+        **extracted_data,
+        "table_data": patch_table_data(
+            extracted_data["table_data"], [cell.model_dump() for cell in resp.cells], [row.model_dump() for row in resp.rows]
+        ),
+    }
+    update_tables[current_idx]["extraction_source"] = "llm"
+    return Command(update={"tables": update_tables, "curr_table_idx": current_idx}, goto="verify_table_data")
+
+
 def _extract_table_data(state: ExtractTableDataState) -> Command[Literal["verify_table_data", "__end__"]]:
     """Extracts table data from OCR text and images using an LLM."""
-    parser = JsonOutputParser(pydantic_object=TableDataResult)
-    
     current_table = None
     current_idx = None
 
@@ -77,34 +290,39 @@ def _extract_table_data(state: ExtractTableDataState) -> Command[Literal["verify
                 pickle.dump(state, f) # serialize the list
         return Command(update={}, goto=END)
     
+    # clean Document Intelligence grids are used directly, the LLM is only needed for the others
+    if state.feedback is None:
+        resp = _extract_table_data_from_grid(state, current_table)
+        if resp is not None:
+            update_tables = copy.deepcopy(state.tables)
+            update_tables[current_idx]["extracted_data"] = resp
+            update_tables[current_idx]["extraction_source"] = "document_intelligence"
+            return Command(update={"tables": update_tables, "curr_table_idx": current_idx}, goto="verify_table_data")
+
+    # large tables are extracted in row chunks, falling back to one request if the chunks do not fit together
+    if state.feedback is None:
+        resp = _extract_table_data_in_chunks(state, current_table)
+        if resp is not None:
+            update_tables = copy.deepcopy(state.tables)
+            update_tables[current_idx]["extracted_data"] = resp
+            update_tables[current_idx]["extraction_source"] = "llm"
+            return Command(update={"tables": update_tables, "curr_table_idx": current_idx}, goto="verify_table_data")
+
+    # a few flagged cells are corrected in place instead of re-extracting the whole table
+    if state.feedback is not None and _cell_correction_applicable(current_table, state.flagged_cells):
+        return _correct_flagged_cells(state, current_idx, current_table)
+
     # extract data for current table
-    messages = [
-        SystemMessagePromptTemplate.from_template(
-            EXTRACT_DATA,
-            partial_variables={"format_instructions": parser.get_format_instructions()},
-        ),
-        HumanMessagePromptTemplate.from_template(
-            "OCR Text: {ocr_text}",
-            partial_variables={"ocr_text": current_table["content"]},
-            type="text",
-        ),
-    ]
-    
-    def get_page(pages, page_nr): # TODO THIS IS A DIRTY WORAROUND 
-        for p in pages:
-            if p["number"] - 1 == page_nr:
-                return p
-        return None
-    
-    # add all pages that cover parts of table t
-    for p_nr in current_table["pages"]:
-        img_base64 = get_page(state.pages, p_nr)["base64"]
-        add_base64image_to_messages(messages, img_base64)
+    content = _table_content(state, current_table)
+    if state.feedback is not None:
+        content.append(text_part(f"Feedback on the previous extraction of this table: {state.feedback}"))
 
-    prompts = ChatPromptTemplate(messages=messages)
-    chain = prompts | llm | parser
     try:
-        resp = chain.invoke({})
+        try:
+            resp = _invoke_extraction(EXTRACT_DATA_PROMPT, content, current_table["content"])
+        except MalformedExtractionError as e:
+            print(f"Aborted the extraction of table '{current_idx}', extracting it again: {e}")
+            resp = EXTRACT_DATA_PROMPT.invoke(content + [text_part(f"A previous extraction of this table was aborted: {e}")])
     except BadRequestError as e:
         if e.code == "content_filter":
             print(f"Content filter error during LLM processing for table '{current_idx}'")
@@ -116,11 +334,15 @@ def _extract_table_data(state: ExtractTableDataState) -> Command[Literal["verify
             raise e
     update_tables = copy.deepcopy(state.tables)
     update_tables[current_idx]["extracted_data"] = resp # is a dictionary
+    update_tables[current_idx]["extraction_source"] = "llm"
     return Command(update={"tables": update_tables, "curr_table_idx": current_idx}, goto="verify_table_data")
 
 
-def _verify_table_data(state: ExtractTableDataState) -> Command[Literal["extract_table_data"]]:
-    """Verifies the extracted table data using an LLM."""
+def _verify_table_data(state: ExtractTableDataState) -> Command[Literal["extract_table_data", "save_table_data"]]:
+    """Verifies the extracted table data, first locally and only on mismatches using an LLM.
+
+    A table that needs no further extraction is passed on to `save_table_data`.
+    """
     
     # limit of re-extraction trials
     max_n_retries = 3
@@ -130,76 +352,52 @@ def _verify_table_data(state: ExtractTableDataState) -> Command[Literal["extract
     # too many re-extraction trials -> go back directly
     if state.retry_counter >= max_n_retries:
         # leave without doing anything (clear feedback, reset counter)
-        return Command(update={"feedback":None, "retry_counter":init_val_for_retry_counter}, goto="extract_table_data")
+        return Command(update={"feedback":None, "flagged_cells":[], "retry_counter":init_val_for_retry_counter}, goto="save_table_data")
 
     # start verification
     current_idx = state.curr_table_idx
     current_table = state.tables[current_idx]
     curr_retry_counter = state.retry_counter
 
-    
-    parser = JsonOutputParser(pydantic_object=VerifyExtractionResult)
-    prompts = ChatPromptTemplate(
+    # mechanical cross-check against the OCR result; clean tables skip the LLM verification
+    mismatches = verify_table_locally(current_table)
+    if not mismatches:
+        return Command(update={"feedback":None, "flagged_cells":[], "retry_counter":init_val_for_retry_counter}, goto="save_table_data")
+    local_feedback = format_mismatches(mismatches)
+
+    table_data = {key: value for key, value in current_table.items() if key != "grid"}
+    resp = VERIFY_DATA_PROMPT.invoke(
         [
-            SystemMessagePromptTemplate.from_template(
-                VERIFY_DATA,
-                partial_variables={"format_instructions": parser.get_format_instructions()},
-            ),
-            HumanMessagePromptTemplate.from_template(
-                "Table Data: {table_data}: ",
-                partial_variables={"table_data": current_table},
-                type="text",
-            ),
+            text_part(f"Table Data: {table_data}: "),
+            text_part(f"Mismatches found by an automatic cross-check with the OCR text:\n{local_feedback}"),
         ]
     )
-
-    chain = prompts | llm | parser
-    resp = chain.invoke({})
     resp = VerifyExtractionResult.model_validate(resp)
     # decide whether a repeated extraction is required
     if resp.reextraction_necessary:
-        # repeat extraction for this table (return verification feedback; increase counter)
-        return Command(update={"feedback":resp.feedback, "retry_counter":curr_retry_counter+1}, goto="extract_table_data")
+        # repeat extraction for this table (return verification feedback and the flagged cells; increase counter)
+        feedback = f"{local_feedback}\n{resp.feedback}"
+        flagged_cells = flagged_cells_of(mismatches)
+        for cell in resp.flagged_cells:
+            if cell.model_dump() not in flagged_cells:
+                flagged_cells.append(cell.model_dump())
+        # mismatches of the whole table, e.g. a wrong shape, cannot be corrected cell by cell
+        if any(mismatch["row"] is None for mismatch in mismatches):
+            flagged_cells = []
+        return Command(update={"feedback":feedback, "flagged_cells":flagged_cells, "retry_counter":curr_retry_counter+1}, goto="extract_table_data")
     else:
         # extract data for another table (reset feedback and counter)
-        return Command(update={"feedback":None, "retry_counter":init_val_for_retry_counter}, goto="extract_table_data")
+        return Command(update={"feedback":None, "flagged_cells":[], "retry_counter":init_val_for_retry_counter}, goto="save_table_data")
         
 
 
-def save_table_data(state: ExtractTableDataState) -> Command[Literal["__end__"]]:
-    """Saves the extracted table data to a JSON file, updating existing data."""
-    doc_path = state.doc_path
-    output_dir = "output_data"
-    os.makedirs(output_dir, exist_ok=True)
-
-    if doc_path.startswith(("http://", "https://")):
-        parsed_url = urllib.parse.urlparse(doc_path)
-        path_segments = parsed_url.path.split("/")
-        filename_from_url = path_segments[-1] if path_segments[-1] else "url_doc"
-        file_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", filename_from_url).split(".")[0]
-        if not file_name:
-            file_name = "url_document"
-    else:
-        file_name = doc_path.split("/")[-1].split(".")[0]
-
-    json_file_path = os.path.join(output_dir, f"{file_name}.json")
-
-    data = state.table_data_result.model_dump()
-    data["confidence"] = state.confidence
-
-    if os.path.exists(json_file_path):
-        try:
-            with open(json_file_path, "r") as json_file:
-                existing_data = json.load(json_file)
-                existing_data.update(data)
-                data = existing_data
-        except json.JSONDecodeError:
-            pass
-
-    with open(json_file_path, "w") as json_file:
-        json.dump(data, json_file)
+def save_table_data(state: ExtractTableDataState) -> Command[Literal["extract_table_data"]]:
+    """Saves the extracted data of the table that was just finished as one record and continues with the next table."""
+    table = state.tables[state.curr_table_idx]
+    if table.get("extracted_data") is not None:
+        TableResultWriter(state.doc_path, "table_data").write_table(table)
 
-    return Command(goto=END)
+    return Command(goto="extract_table_data")
 
 
 def construct_extract_table_data():
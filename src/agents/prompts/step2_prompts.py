@@ -28,5 +28,45 @@ You are an chemical expert specialiced in ceramic and glass. Your task is to ver
 Consider the OCR to be more correct than the current state of the table.
 
 List ALL errors that were made.
+
+Flag every wrong cell with its row and column as 0-based indices into the current state of the extracted data: the first row of the data (usually the header) is row 0, the first value of a row is column 0. Flag a row without a column if the whole row is wrong or misses values.
+{format_instructions}
+"""
+
+CORRECT_CELLS = """
+You are a chemical expert. You know all about glass and ceramic compositions.
+
+You will receive the data that was extracted from a table, the cells and rows of it that were flagged as wrong by a verification together with its feedback, the OCR text of the table and scans of the pages with the table.
+
+Your task is to correct ONLY the flagged cells and rows. Row and column indices are 0-based indices into the extracted table data.
+
+- consider OCR values to be correct
+
+- give the complete value and signs of every corrected cell. do not shorten the values.
+
+- for a flagged row without a column, give all values of the corrected row
+
+- do not repeat cells that are correct
+{format_instructions}
+"""
+
+EXTRACT_DATA_CHUNK = """
+You are a chemical expert. You know all about glass and ceramic compositions.
+
+You will receive scans of documents and text that was extracted with OCR from a part of a large table. The OCR text contains the caption and the header row of the table and a range of its rows.
+
+Your task is to extract the values of this part of the table. You have to be very careful to get the values right!
+
+- the first row of your table data is the header row of the OCR text, followed by the rows of this part in their order
+
+- keep the orientation of the OCR table, do not transpose it
+
+- extract only the rows contained in the OCR text, even if the scans show more rows
+
+- consider OCR values to be correct
+
+- always give the complete values and signs per cell. do not shorten the values.
+
+It is EXTREMLY important that you get all digits of the values.
 {format_instructions}
-"""
\ No newline at end of file
+"""
@@ -2,21 +2,17 @@ import json
 from pathlib import Path
 from typing import Dict, List, Literal, Optional, Any, Union
 from pydantic import BaseModel, Field
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-)
 from langgraph.graph import END, START, StateGraph
 from langgraph.types import Command
 from agents.prompts.table_norming_prompts import (
     TABLE_NORMING_SYSTEM_PROMPT,
     TABLE_NORMING_USER_PROMPT,
 )
-from utils import llm
+from prompt_registry import register_prompt, text_part
+from result_writer import TableResultWriter, atomic_write_text, document_stem
+from composition_store import ingest_document_results
+from table_fingerprints import fingerprint_store_from_env
 from model import BaseState
-import copy
 
 # Step 2 -> Step 3: Define models
 class TableDataResult(BaseModel):
@@ -47,6 +43,9 @@ class NormalizedTableResult(BaseModel):
     )
 
 
+NORMALIZE_TABLE_PROMPT = register_prompt("normalize_table", TABLE_NORMING_SYSTEM_PROMPT, NormalizedTableResult)
+
+
 class TableNormingState(BaseState):
     doc_path: str
     normalized_table: Optional[NormalizedTableResult] = None
@@ -81,32 +80,27 @@ def _normalize_table(
     if state.error or not state.tables:
         return Command(update={"error": "No valid table data to normalize"}, goto=END)
 
-    parser = JsonOutputParser(pydantic_object=NormalizedTableResult)
+    writer = TableResultWriter(state.doc_path, "normalized")
+    # normalized tables are registered for the reuse in other documents
+    store = fingerprint_store_from_env()
     try:
         new_tables = []
         # Prepare input data for normalization
         for table in state.tables:
             table_data = table["extracted_data"]
 
-            # Use TABLE_NORMING prompts to normalize tables
-            messages = [
-                SystemMessagePromptTemplate.from_template(
-                    TABLE_NORMING_SYSTEM_PROMPT,
-                    partial_variables={
-                        "format_instructions": parser.get_format_instructions()
-                    },
-                ),
-                HumanMessagePromptTemplate.from_template(
-                    TABLE_NORMING_USER_PROMPT, partial_variables={"table_data": table_data}
-                ),
-            ]
-
-            chain = ChatPromptTemplate(messages=messages) | llm | parser
-            
-            parsed_resp = chain.invoke({})
-            new_table = copy.deepcopy(table)
-            new_table["normalized"] = parsed_resp
+            new_table = dict(table)
+            if "normalized" not in table:
+                # Use TABLE_NORMING prompts to normalize tables
+                parsed_resp = NORMALIZE_TABLE_PROMPT.invoke(
+                    [text_part(TABLE_NORMING_USER_PROMPT.format(table_data=table_data))]
+                )
+                new_table["normalized"] = parsed_resp
+            # Save every table right away so that finished tables survive a failing run
+            writer.write_table(new_table)
             new_tables.append(new_table)
+            if store is not None and ("reused_from" not in table or "normalized" not in table):
+                store.register(document_stem(state.doc_path), new_table, relevant=True)
 
         # Add normalized table response back to state
         return Command(
@@ -114,25 +108,26 @@ def _normalize_table(
         )
     except Exception as e:
         return Command(update={"error": str(e)}, goto=END)
+    finally:
+        if store is not None:
+            store.close()
 
 
 def save_normalized_table(state: TableNormingState) -> Command[Literal["__end__"]]:
+    """Marks the document as complete; the tables themselves are saved during normalization."""
     if not state.tables:
         return Command(goto=END)
 
     try:
-        output_path = (
-            Path("output_data") / f"{Path(state.doc_path).stem}_normalized.json"
-        )
-        output_path.parent.mkdir(exist_ok=True)
-
-        # Save normalized table with abnormal material details
-        data = {
-            "normalized_table": state.tables,
+        writer = TableResultWriter(state.doc_path, "normalized")
+        summary = {
+            "doc_path": state.doc_path,
+            "tables": [table["number"] for table in state.tables if "normalized" in table],
+            "results": str(writer.jsonl_path),
         }
-        output_path.write_text(
-            json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8"
-        )
+        output_path = Path("output_data") / f"{document_stem(state.doc_path)}_normalized_summary.json"
+        atomic_write_text(output_path, json.dumps(summary, ensure_ascii=False, indent=2))
+        ingest_document_results(writer.jsonl_path)
         return Command(goto=END)
     except Exception as e:
         return Command(update={"error": str(e)}, goto=END)
@@ -0,0 +1,259 @@
+"""Microbenchmarks of the CPU-bound stages of the pipeline.
+
+Run from `src`:
+
+    python -m benchmarks.cpu_benchmarks                    # run and print the timings
+    python -m benchmarks.cpu_benchmarks --save-baseline    # store the timings as new baseline
+    python -m benchmarks.cpu_benchmarks --check            # fail if a stage got slower than the threshold
+
+The inputs are the PDFs in `data/` (and the pickled states of the skipped steps) plus
+synthetic large inputs. Timings are compared relative to a pure-Python calibration loop
+that is measured in the same run, so a baseline taken on another machine stays usable.
+"""
+
+import argparse
+import copy
+import json
+import pickle
+import platform
+import statistics
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymupdf
+from PIL import Image
+
+import benchmarks.env_defaults  # noqa: F401 (before the pipeline modules)
+from agents.extract_table_agent import add_merged_table, get_table, get_table_content
+from model import BaseState
+from util_functions import image_bytes_to_base64, pdf_to_base64_images
+
+DATA_DIR = Path(__file__).resolve().parents[2] / "data"
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines.json"
+# a stage fails the check if it takes this many times its baseline (relative to the calibration);
+# below 2 to catch a doubled stage, above the run-to-run noise of the stages
+DEFAULT_THRESHOLD = 1.8
+# times below this are compared as this, short stages are disturbed by a single hiccup of the machine
+NOISE_FLOOR_SECONDS = 0.01
+MIN_REPEAT_SECONDS = 0.2
+
+
+class Benchmark:
+    """A function to time; `setup` builds fresh arguments for every call outside of the timing."""
+
+    def __init__(self, name: str, func: Callable[..., Any], setup: Optional[Callable[[], tuple]] = None):
+        self.name = name
+        self.func = func
+        self.setup = setup or (lambda: ())
+
+    def time_once(self) -> float:
+        args = self.setup()
+        started = time.perf_counter()
+        self.func(*args)
+        return time.perf_counter() - started
+
+    def measure(self, repeat: int) -> float:
+        """Returns the median of the mean time per call over `repeat` rounds of at least MIN_REPEAT_SECONDS."""
+        first = self.time_once()
+        number = max(1, min(10000, int(MIN_REPEAT_SECONDS / max(first, 1e-6))))
+        return statistics.median(sum(self.time_once() for _ in range(number)) / number for _ in range(repeat))
+
+
+def _checked_pdf_to_base64_images(pdf_bytes: bytes):
+    # pdf_to_base64_images returns an empty list if poppler is missing, which would time nothing
+    if not pdf_to_base64_images(pdf_bytes):
+        raise RuntimeError("pdf_to_base64_images returned no pages, is poppler installed?")
+
+
+def _calibration():
+    """A fixed pure-Python workload that scales the timings to the speed of the machine."""
+    values = {str(i): [i, i * 0.5, str(i)] for i in range(20000)}
+    json.loads(json.dumps(values))
+    return sum(len(key) for key in sorted(values, reverse=True))
+
+
+def _pdf_files() -> List[Path]:
+    return sorted(DATA_DIR.glob("*.pdf"))
+
+
+def _page_jpeg(pdf_path: Path) -> bytes:
+    """Renders the first page of a PDF like the pipeline does (892x1263 JPEG)."""
+    with pymupdf.open(pdf_path) as document:
+        page = document[0]
+        pixmap = page.get_pixmap(matrix=pymupdf.Matrix(892 / page.rect.width, 1263 / page.rect.height))
+        return pixmap.tobytes("jpeg")
+
+
+def _synthetic_jpeg(width: int, height: int) -> bytes:
+    buffered = BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def _synthetic_analyze_result(rows: int, columns: int) -> Dict[str, Any]:
+    """An analyze result in the JSON layout of Document Intelligence with one large table."""
+    cells = [
+        {"rowIndex": row, "columnIndex": column, "content": f"Component {column}" if row == 0 else f"{row % 97}.{column}"}
+        for row in range(rows)
+        for column in range(columns)
+    ]
+    return {"tables": [{"rowCount": rows, "columnCount": columns, "cells": cells, "caption": {"content": "Table 1 Glass compositions (wt%)"}}]}
+
+
+def _table_conversion(analyze_result: Dict[str, Any]):
+    for table_index in range(len(analyze_result["tables"])):
+        get_table_content(get_table(analyze_result, table_index))
+
+
+def _merge_setup(parts: int, rows: int, columns: int) -> Callable[[], tuple]:
+    """Builds the tables of `parts` consecutive pages with one table part each, for `add_merged_table`."""
+    grid = get_table(_synthetic_analyze_result(rows, columns), 0)
+    content = get_table_content(grid)
+
+    def setup():
+        pages = [{"number": page + 1, "tables": [page]} for page in range(parts)]
+        tables_to_merge = [{"number": page, "content": content, "pages": [page], "grid": copy.deepcopy(grid)} for page in range(parts)]
+        return [], tables_to_merge, pages
+
+    return setup
+
+
+def _synthetic_state(pages: int, tables: int, image_bytes: int) -> BaseState:
+    """A state with `pages` page images of `image_bytes` and `tables` tables with grids, like after step 1."""
+    # distinct strings per page, pickle would store a shared string only once
+    images = [f"data:image/jpeg;base64,{page:08d}" + "A" * image_bytes for page in range(pages)]
+    grid = get_table(_synthetic_analyze_result(40, 10), 0)
+    return BaseState(
+        doc_path="benchmark.pdf",
+        pdf_page_images=images,
+        pages=[{"number": page + 1, "content": f"page {page} " + "text " * 800, "tables": [], "base64": images[page]} for page in range(pages)],
+        tables=[{"number": table, "content": get_table_content(grid), "pages": [table % pages], "grid": grid} for table in range(tables)],
+    )
+
+
+def _state_benchmarks(name: str, state: BaseState) -> List[Benchmark]:
+    pickled = pickle.dumps(state)
+    dumped = state.model_dump_json()
+    return [
+        Benchmark(f"state_pickle_dumps[{name}]", pickle.dumps, lambda: (state,)),
+        Benchmark(f"state_pickle_loads[{name}]", pickle.loads, lambda: (pickled,)),
+        Benchmark(f"state_model_dump_json[{name}]", state.model_dump_json),
+        Benchmark(f"state_model_validate_json[{name}]", BaseState.model_validate_json, lambda: (dumped,)),
+        # the table nodes deep-copy the tables for every update
+        Benchmark(f"state_deepcopy_tables[{name}]", copy.deepcopy, lambda: (state.tables,)),
+    ]
+
+
+def build_benchmarks() -> List[Benchmark]:
+    benchmarks = []
+    for pdf_path in _pdf_files():
+        pdf_bytes = pdf_path.read_bytes()
+        benchmarks.append(Benchmark(f"pdf_to_base64_images[{pdf_path.stem}]", _checked_pdf_to_base64_images, lambda pdf_bytes=pdf_bytes: (pdf_bytes,)))
+        page_jpeg = _page_jpeg(pdf_path)
+        benchmarks.append(Benchmark(f"image_bytes_to_base64[{pdf_path.stem}]", image_bytes_to_base64, lambda page_jpeg=page_jpeg: (page_jpeg, True)))
+    large_jpeg = _synthetic_jpeg(2480, 3508)
+    benchmarks.append(Benchmark("image_bytes_to_base64[synthetic_a4_300dpi]", image_bytes_to_base64, lambda: (large_jpeg, True)))
+
+    small_result, large_result = _synthetic_analyze_result(20, 6), _synthetic_analyze_result(2000, 12)
+    benchmarks.append(Benchmark("table_conversion[20x6]", _table_conversion, lambda: (small_result,)))
+    benchmarks.append(Benchmark("table_conversion[2000x12]", _table_conversion, lambda: (large_result,)))
+
+    benchmarks.append(Benchmark("add_merged_table[2x30x8]", add_merged_table, _merge_setup(2, 30, 8)))
+    benchmarks.append(Benchmark("add_merged_table[20x200x12]", add_merged_table, _merge_setup(20, 200, 12)))
+
+    for pickle_path in sorted(DATA_DIR.glob("step*.pkl")):
+        with open(pickle_path, "rb") as f:
+            benchmarks.extend(_state_benchmarks(pickle_path.stem, pickle.load(f)))
+    benchmarks.extend(_state_benchmarks("synthetic_200_pages", _synthetic_state(200, 100, 250_000)))
+    return benchmarks
+
+
+def run(benchmarks: List[Benchmark], repeat: int) -> Tuple[Dict[str, float], List[str]]:
+    """Returns the timings of the benchmarks and the names of those that could not run."""
+    results = {}
+    skipped = []
+    for benchmark in benchmarks:
+        try:
+            results[benchmark.name] = benchmark.measure(repeat)
+        except Exception as e:
+            print(f"{benchmark.name:<60} skipped: {e}")
+            skipped.append(benchmark.name)
+            continue
+        print(f"{benchmark.name:<60} {results[benchmark.name] * 1000:12.3f} ms")
+    return results, skipped
+
+
+def compare(results: Dict[str, float], skipped: List[str], calibration: float, baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns the failed benchmarks: those whose time relative to the calibration grew beyond
+    `threshold` times the baseline, those without a baseline and those with a baseline that
+    could not run, e.g. the page rendering without poppler. Both times are raised to
+    NOISE_FLOOR_SECONDS for the comparison."""
+    failures = []
+    scale = calibration / baseline["calibration_seconds"]
+    for name in sorted(skipped):
+        if name in baseline["benchmarks"]:
+            print(f"{name:<60} SKIPPED")
+            failures.append(name)
+    for name, seconds in sorted(results.items()):
+        if name not in baseline["benchmarks"]:
+            print(f"{name:<60} NO BASELINE")
+            failures.append(name)
+            continue
+        ratio = max(seconds, NOISE_FLOOR_SECONDS) / max(baseline["benchmarks"][name] * scale, NOISE_FLOOR_SECONDS)
+        verdict = "REGRESSION" if ratio > threshold else "ok"
+        print(f"{name:<60} {ratio:6.2f}x baseline  {verdict}")
+        if ratio > threshold:
+            failures.append(name)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the CPU-bound pipeline stages.")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--repeat", type=int, default=9, help="Rounds per benchmark, the median round counts.")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH), help="Path of the baseline file.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the timings as new baseline.")
+    parser.add_argument("--check", action="store_true", help="Compare with the baseline and exit with 1 on a regression.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown factor in check mode.")
+    args = parser.parse_args()
+
+    benchmarks = [benchmark for benchmark in build_benchmarks() if not args.filter or args.filter in benchmark.name]
+    calibration = Benchmark("calibration", _calibration).measure(args.repeat)
+    results, skipped = run(benchmarks, args.repeat)
+    # measured before and after the benchmarks, the faster one is the least disturbed
+    calibration = min(calibration, Benchmark("calibration", _calibration).measure(args.repeat))
+    print(f"{'calibration':<60} {calibration * 1000:12.3f} ms")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        if skipped:
+            # a baseline without them would never check these stages again
+            sys.exit(f"Not saving the baseline, {len(skipped)} benchmarks could not run: {', '.join(skipped)}")
+        baseline = {"calibration_seconds": calibration, "python": platform.python_version(), "machine": platform.machine(), "benchmarks": {}}
+        if baseline_path.exists():
+            # a filtered run only replaces the baselines of the benchmarks it ran
+            previous = json.loads(baseline_path.read_text(encoding="utf-8"))
+            scale = calibration / previous["calibration_seconds"]
+            baseline["benchmarks"] = {name: seconds * scale for name, seconds in previous["benchmarks"].items()}
+        baseline["benchmarks"].update(results)
+        baseline["benchmarks"] = dict(sorted(baseline["benchmarks"].items()))
+        baseline_path.write_text(json.dumps(baseline, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline of {len(results)} benchmarks saved to {baseline_path}")
+
+    if args.check:
+        if not baseline_path.exists():
+            sys.exit(f"No baseline at {baseline_path}, create one with --save-baseline.")
+        failures = compare(results, skipped, calibration, json.loads(baseline_path.read_text(encoding="utf-8")), args.threshold)
+        if failures:
+            sys.exit(
+                f"{len(failures)} benchmarks are more than {args.threshold}x slower than their baseline, have no baseline or could not run: "
+                f"{', '.join(failures)}"
+            )
+        print(f"No benchmark is more than {args.threshold}x slower than its baseline.")
+
+
+if __name__ == "__main__":
+    main()
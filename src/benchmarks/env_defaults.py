@@ -0,0 +1,21 @@
+"""Settings the benchmarks need before the pipeline modules are imported.
+
+The agents create their LLM clients on import, which only needs syntactically valid
+settings. Imported by `cpu_benchmarks` ahead of the pipeline modules.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+for _name, _value in {
+    "AZURE_OPENAI_ENDPOINT": "https://benchmark.openai.azure.com",
+    "AZURE_OPENAI_API_KEY": "benchmark",
+    "OPENAI_API_VERSION": "2024-08-01-preview",
+    "AZURE_AI_SERVICES_ENDPOINT": "https://benchmark.services.ai.azure.com/models",
+    "AZURE_AI_SERVICES_CREDENTIALS": "benchmark",
+    # without a model name the client asks the endpoint for its model on creation
+    "AZURE_AI_SERVICES_PHI4_MODEL_NAME": "phi-4",
+}.items():
+    os.environ.setdefault(_name, _value)
@@ -0,0 +1,195 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+import threading
+import urllib.parse
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+CASSETTE_MODES = ("off", "record", "replay")
+
+
+class CassetteMissError(KeyError):
+    """Raised in replay mode for a request that was not recorded."""
+
+
+class CassetteStore:
+    """
+    Records the responses of external calls and serves them back without network.
+
+    Every response is one gzip-compressed JSON file, named by the hash of its request, below
+    `<cassette_dir>/<kind>/`. Identical requests of several runs or documents share one entry,
+    and concurrent calls never write the same file. In "record" mode the calls go out and their
+    responses are stored, in "replay" mode they are answered from the store only and a request
+    that was not recorded raises CassetteMissError.
+    """
+
+    def __init__(self, cassette_dir: str, mode: str):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}', expected one of {CASSETTE_MODES}.")
+        self.cassette_dir = Path(cassette_dir)
+        self.mode = mode
+        self.recorded = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request: Any) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, kind: str, key: str) -> Path:
+        return self.cassette_dir / kind / key[:2] / f"{key}.json.gz"
+
+    def load(self, kind: str, key: str, description: str) -> Any:
+        path = self._path(kind, key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            raise CassetteMissError(f"No recorded {kind} response for {description} (key {key}) in {self.cassette_dir}.") from None
+        with self._lock:
+            self.replayed += 1
+        return entry["response"]
+
+    def save(self, kind: str, key: str, description: str, response: Any):
+        path = self._path(kind, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump({"kind": kind, "request": description, "response": response}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.recorded += 1
+
+
+class CassetteChatModel:
+    """Wraps a chat model so that `invoke` and `stream` are recorded or replayed.
+
+    The request is identified by the model name, the kind of call and the complete messages
+    including the page images. A replayed stream yields the recorded answer as a single chunk.
+    """
+
+    def __init__(self, model, model_name: str, store: CassetteStore):
+        self.model = model
+        self.model_name = model_name
+        self.store = store
+
+    def _key(self, call: str, messages: List[BaseMessage]) -> str:
+        return self.store.key({"model": self.model_name, "call": call, "messages": [message_to_dict(message) for message in messages]})
+
+    def _description(self, messages: List[BaseMessage]) -> str:
+        return f"a call of model '{self.model_name}' with {len(messages)} messages"
+
+    def invoke(self, messages: List[BaseMessage]) -> BaseMessage:
+        key = self._key("invoke", messages)
+        if self.store.mode == "replay":
+            return messages_from_dict([self.store.load("llm", key, self._description(messages))])[0]
+        response = self.model.invoke(messages)
+        self.store.save("llm", key, self._description(messages), message_to_dict(response))
+        return response
+
+    def stream(self, messages: List[BaseMessage], **kwargs) -> Iterator[BaseMessage]:
+        key = self._key("stream", messages)
+        if self.store.mode == "replay":
+            yield messages_from_dict([self.store.load("llm", key, self._description(messages))])[0]
+            return
+        response = None
+        seen_by_caller = False
+        chunks = self.model.stream(messages, **kwargs)
+        try:
+            for chunk in chunks:
+                response = chunk if response is None else response + chunk
+                yield chunk
+            seen_by_caller = True
+        except GeneratorExit:
+            # a stream closed early by the caller is recorded as far as it was read, its replay
+            # then ends at the same point
+            seen_by_caller = True
+            raise
+        finally:
+            chunks.close()
+            if seen_by_caller and response is not None:
+                self.store.save("llm", key, self._description(messages), message_to_dict(response))
+
+
+class _RecordedPoller:
+    def __init__(self, result: AnalyzeResult):
+        self._result = result
+
+    def done(self) -> bool:
+        return True
+
+    def result(self, timeout: Optional[float] = None) -> AnalyzeResult:
+        return self._result
+
+
+class _RecordingPoller:
+    def __init__(self, poller, store: CassetteStore, key: str, description: str):
+        self._poller = poller
+        self._store = store
+        self._key = key
+        self._description = description
+
+    def done(self) -> bool:
+        return self._poller.done()
+
+    def result(self, timeout: Optional[float] = None) -> AnalyzeResult:
+        result = self._poller.result(timeout)
+        self._store.save("docint", self._key, self._description, result.as_dict())
+        return result
+
+
+class CassetteDocumentIntelligenceClient:
+    """Wraps a DocumentIntelligenceClient so that `begin_analyze_document` is recorded or replayed.
+
+    A document is identified by the model, the selected pages and the hash of its bytes, or by
+    its URL without the query string, so a SAS URL with a new signature still finds the recording. In replay mode
+    the wrapped client is not used and can be None.
+    """
+
+    def __init__(self, client, store: CassetteStore):
+        self.client = client
+        self.store = store
+
+    def begin_analyze_document(self, model_id: str, body: AnalyzeDocumentRequest, **kwargs):
+        if body.url_source:
+            parsed_url = urllib.parse.urlsplit(body.url_source)
+            source = parsed_url._replace(query="", fragment="").geturl()
+        else:
+            source = "sha256:" + hashlib.sha256(body.bytes_source).hexdigest()
+        request = {"model": model_id, "source": source}
+        description = f"model '{model_id}' on {source}"
+        if kwargs.get("pages"):
+            # only set for documents analyzed in windows, the keys of whole documents stay unchanged
+            request["pages"] = kwargs["pages"]
+            description += f" (pages {kwargs['pages']})"
+        key = self.store.key(request)
+        if self.store.mode == "replay":
+            return _RecordedPoller(AnalyzeResult(self.store.load("docint", key, description)))
+        return _RecordingPoller(self.client.begin_analyze_document(model_id, body, **kwargs), self.store, key, description)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cassette_store() -> Optional[CassetteStore]:
+    """
+    Returns the cassette store configured by the environment, or None if cassettes are off.
+
+    - CASSETTE_MODE: (Optional) "off" (default), "record" or "replay".
+    - CASSETTE_DIR: (Optional) Directory of the cassettes, defaults to "cassettes".
+    """
+    mode = os.getenv("CASSETTE_MODE", "off")
+    if mode == "off":
+        return None
+    return CassetteStore(os.getenv("CASSETTE_DIR", "cassettes"), mode)
+
+
+def cassette_report() -> Dict[str, Any]:
+    store = get_cassette_store()
+    if store is None:
+        return {"mode": "off"}
+    return {"mode": store.mode, "recorded": store.recorded, "replayed": store.replayed}
@@ -0,0 +1,170 @@
+import argparse
+import json
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from result_writer import atomic_write_text, document_stem
+
+COMPOSITION_SCHEMA = pa.schema(
+    [
+        pa.field("document", pa.string()),
+        pa.field("table_number", pa.int32()),
+        pa.field("example", pa.string()),
+        pa.field("element", pa.string()),
+        pa.field("min", pa.float64()),
+        pa.field("max", pa.float64()),
+        pa.field("min_raw", pa.string()),
+        pa.field("max_raw", pa.string()),
+        pa.field("unit", pa.dictionary(pa.int8(), pa.string())),
+        pa.field("page", pa.int32()),
+        pa.field("pages", pa.list_(pa.int32())),
+    ]
+)
+
+_VALUE_DECORATIONS = str.maketrans("", "", "<>≤≥~%= \u00a0")
+
+
+def parse_german_decimal(value: Optional[str]) -> Optional[float]:
+    """Parses a value in German decimal notation ("1,50", "1.234,5", "<0,1") into a float.
+
+    Comparison signs are ignored because they are already expressed by the min/max semantics.
+    A value without a comma is read with "." as decimal separator. Returns None for missing
+    or unparsable values.
+    """
+    if value is None:
+        return None
+    text = str(value).translate(_VALUE_DECORATIONS).replace("−", "-")
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def read_result_records(jsonl_path: Path) -> List[Dict[str, Any]]:
+    """Reads the normalized table records of a document, keeping the last record per table."""
+    records = {}
+    with open(jsonl_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record["number"]] = record
+    return list(records.values())
+
+
+def flatten_record(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Flattens a normalized table record into one row per example and element."""
+    extracted_data = record.get("extracted_data") or {}
+    is_weight_percent = extracted_data.get("is_weight_percent")
+    unit = None if is_weight_percent is None else ("wt%" if is_weight_percent else "mol%")
+    # table pages are 0-based page indices, the page column holds the 1-based page number
+    pages = [page + 1 for page in record.get("pages", [])]
+
+    rows = []
+    for example in (record.get("normalized") or {}).get("examples", []):
+        for molecule in example.get("molecules", []):
+            rows.append(
+                {
+                    "document": document_stem(record["doc_path"]),
+                    "table_number": record["number"],
+                    "example": str(example.get("exampleNumber")),
+                    "element": molecule.get("element"),
+                    "min": parse_german_decimal(molecule.get("min")),
+                    "max": parse_german_decimal(molecule.get("max")),
+                    "min_raw": molecule.get("min"),
+                    "max_raw": molecule.get("max"),
+                    "unit": unit,
+                    "page": pages[0] if pages else None,
+                    "pages": pages,
+                }
+            )
+    return rows
+
+
+class CompositionExporter:
+    """Exports normalized compositions into a Parquet dataset partitioned by batch.
+
+    Every export call adds part files to `<root>/batch=<batch_id>/`, so the dataset can grow
+    incrementally and is readable with `pyarrow.dataset.dataset(root, partitioning="hive")`.
+
+    Result files are exported into one part per document. The manifest `<root>/_exported.json`
+    (ignored by pyarrow.dataset because of its prefix) records the size and modification time
+    of every exported result file and its part: unchanged files are skipped, and the part of a
+    changed file replaces its previous part, so repeated exports never duplicate rows.
+    """
+
+    MANIFEST_NAME = "_exported.json"
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _write_part(self, records: Iterable[Dict[str, Any]], part_path: Path) -> Optional[Path]:
+        rows = [row for record in records for row in flatten_record(record)]
+        if not rows:
+            return None
+
+        table = pa.Table.from_pylist(rows, schema=COMPOSITION_SCHEMA)
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = part_path.with_suffix(f".parquet.{uuid.uuid4().hex[:8]}.tmp")
+        pq.write_table(table, tmp_path, compression="zstd")
+        tmp_path.replace(part_path)
+        return part_path
+
+    def export(self, records: Iterable[Dict[str, Any]], batch_id: str) -> Optional[Path]:
+        """Writes the rows of the given records as one new part file; returns its path or None if there are no rows."""
+        part_path = self.root / f"batch={batch_id}" / f"part-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"
+        return self._write_part(records, part_path)
+
+    def _read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            return json.loads((self.root / self.MANIFEST_NAME).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+
+    def export_result_files(self, jsonl_paths: Iterable[Path], batch_id: str) -> List[Path]:
+        """Exports the normalized results of the new or changed result files; returns the written part files."""
+        manifest = self._read_manifest()
+        part_paths = []
+        for jsonl_path in jsonl_paths:
+            source = str(Path(jsonl_path).resolve())
+            stat = Path(jsonl_path).stat()
+            entry = manifest.get(source)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                continue
+
+            part_path = self._write_part(read_result_records(jsonl_path), self.root / f"batch={batch_id}" / f"{Path(jsonl_path).stem}.parquet")
+            previous_part = self.root / entry["part"] if entry is not None and entry.get("part") else None
+            if previous_part is not None and previous_part != part_path:
+                previous_part.unlink(missing_ok=True)
+            manifest[source] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "part": part_path.relative_to(self.root).as_posix() if part_path else None,
+            }
+            # written after every document, so an interrupted export resumes where it stopped
+            atomic_write_text(self.root / self.MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True))
+            if part_path:
+                part_paths.append(part_path)
+        return part_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export normalized compositions to a Parquet dataset.")
+    parser.add_argument("dataset", help="Root directory of the Parquet dataset.")
+    parser.add_argument("--results", default="output_data", help="Directory with the *_normalized.jsonl result files.")
+    parser.add_argument("--batch-id", default=datetime.now(timezone.utc).strftime("%Y%m%d"), help="Partition of the exported rows.")
+    args = parser.parse_args()
+
+    jsonl_paths = sorted(Path(args.results).glob("*_normalized.jsonl"))
+    part_paths = CompositionExporter(args.dataset).export_result_files(jsonl_paths, args.batch_id)
+    print(f"Exported {len(part_paths)} of {len(jsonl_paths)} documents to {args.dataset}" if part_paths else "No new compositions to export.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import os
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+from composition_export import flatten_record, read_result_records
+
+_SUBSCRIPT_DIGITS = str.maketrans("₀₁₂₃₄₅₆₇₈₉", "0123456789")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY,
+    document TEXT NOT NULL,
+    table_number INTEGER NOT NULL,
+    example TEXT NOT NULL,
+    unit TEXT,
+    page INTEGER,
+    UNIQUE (document, table_number, example)
+);
+CREATE TABLE IF NOT EXISTS components (
+    example_id INTEGER NOT NULL REFERENCES examples (id) ON DELETE CASCADE,
+    element TEXT NOT NULL,
+    min_value REAL,
+    max_value REAL
+);
+CREATE INDEX IF NOT EXISTS components_element_min ON components (element, min_value, example_id);
+CREATE INDEX IF NOT EXISTS components_element_max ON components (element, max_value, example_id);
+CREATE INDEX IF NOT EXISTS components_example ON components (example_id, element);
+"""
+
+
+def canonical_element(element: str) -> str:
+    """Normalizes an element or oxide name ("SiO₂ " becomes "SiO2"); the case is kept."""
+    return "".join(element.translate(_SUBSCRIPT_DIGITS).split())
+
+
+class RangeFilter(BaseModel):
+    """Requires the value range of an element to lie within [low, high]; open bounds are None."""
+
+    element: str
+    low: Optional[float] = None
+    high: Optional[float] = None
+
+    @classmethod
+    def parse(cls, text: str) -> "RangeFilter":
+        """Parses a filter of the form `ELEMENT:LOW:HIGH`, e.g. `SiO2:55:65` or `B2O3:10:`."""
+        element, _, bounds = text.partition(":")
+        low, _, high = bounds.partition(":")
+        return cls(element=element, low=float(low) if low else None, high=float(high) if high else None)
+
+
+class CompositionStore:
+    """A local SQLite store of normalized compositions for range queries across the corpus.
+
+    Every example of a table is one row in `examples`, every element of an example one row in
+    `components`. The components are indexed on element and min/max value, so a multi-element
+    range filter is an index range scan on the narrowest filter plus index lookups per example.
+    """
+
+    def __init__(self, db_path: str):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest_records(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Adds normalized table records; a table that is ingested again replaces its previous examples.
+
+        Returns:
+            The number of ingested components.
+        """
+        count = 0
+        with self.connection:
+            for record in records:
+                rows = flatten_record(record)
+                if not rows:
+                    continue
+                self.connection.execute(
+                    "DELETE FROM examples WHERE document = ? AND table_number = ?", (rows[0]["document"], rows[0]["table_number"])
+                )
+                example_ids = {}
+                for row in rows:
+                    if row["example"] not in example_ids:
+                        cursor = self.connection.execute(
+                            "INSERT INTO examples (document, table_number, example, unit, page) VALUES (?, ?, ?, ?, ?)",
+                            (row["document"], row["table_number"], row["example"], row["unit"], row["page"]),
+                        )
+                        example_ids[row["example"]] = cursor.lastrowid
+                self.connection.executemany(
+                    "INSERT INTO components (example_id, element, min_value, max_value) VALUES (?, ?, ?, ?)",
+                    [(example_ids[row["example"]], canonical_element(row["element"] or ""), row["min"], row["max"]) for row in rows],
+                )
+                count += len(rows)
+        return count
+
+    def ingest_result_file(self, jsonl_path: Path) -> int:
+        """Adds the normalized tables of a `*_normalized.jsonl` result file."""
+        return self.ingest_records(read_result_records(jsonl_path))
+
+    def query(self, filters: List[RangeFilter], unit: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Finds the examples whose element values satisfy all range filters.
+
+        Args:
+            filters: One range filter per element, at least one.
+            unit: Optionally restrict the examples to "wt%" or "mol%".
+            limit: Maximum number of returned examples.
+
+        Returns:
+            One dictionary per example with document, table number, example, unit, page and the
+            (min, max) values of the filtered elements.
+        """
+        if not filters:
+            raise ValueError("At least one range filter is required.")
+        # the narrowest filter drives the index range scan, the others are checked per example
+        filters = sorted(filters, key=_filter_width)
+        conditions, parameters = [], []
+        for index, range_filter in enumerate(filters):
+            alias = f"c{index}"
+            filter_conditions = [f"{alias}.element = ?"]
+            parameters.append(canonical_element(range_filter.element))
+            if range_filter.low is not None:
+                filter_conditions.append(f"{alias}.min_value >= ?")
+                parameters.append(range_filter.low)
+            if range_filter.high is not None:
+                filter_conditions.append(f"{alias}.max_value <= ?")
+                parameters.append(range_filter.high)
+            if range_filter.low is not None and range_filter.high is not None:
+                # implied by min <= max, but bounds the scan of the min index on both sides
+                filter_conditions.append(f"{alias}.min_value <= ?")
+                parameters.append(range_filter.high)
+            if index == 0:
+                conditions.extend(filter_conditions)
+            else:
+                conditions.append(
+                    f"EXISTS (SELECT 1 FROM components {alias} INDEXED BY components_example WHERE {alias}.example_id = e.id AND {' AND '.join(filter_conditions)})"
+                )
+        driving_index = "components_element_max" if filters[0].low is None else "components_element_min"
+        if unit:
+            conditions.append("e.unit = ?")
+            parameters.append(unit)
+
+        sql = (
+            "SELECT e.id, e.document, e.table_number, e.example, e.unit, e.page "
+            f"FROM components c0 INDEXED BY {driving_index} JOIN examples e ON e.id = c0.example_id WHERE {' AND '.join(conditions)}"
+        )
+        if limit:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+
+        examples = {
+            row[0]: {"document": row[1], "table_number": row[2], "example": row[3], "unit": row[4], "page": row[5], "components": {}}
+            for row in self.connection.execute(sql, parameters)
+        }
+        if not examples:
+            return []
+
+        elements = sorted({canonical_element(range_filter.element) for range_filter in filters})
+        components = defaultdict(dict)
+        all_example_ids = list(examples)
+        for chunk_start in range(0, len(all_example_ids), 500):
+            example_ids = all_example_ids[chunk_start : chunk_start + 500]
+            rows = self.connection.execute(
+                f"SELECT example_id, element, min_value, max_value FROM components "
+                f"WHERE example_id IN ({','.join('?' * len(example_ids))}) AND element IN ({','.join('?' * len(elements))})",
+                example_ids + elements,
+            )
+            for example_id, element, min_value, max_value in rows:
+                components[example_id][element] = (min_value, max_value)
+        for example_id, example in examples.items():
+            example["components"] = components[example_id]
+        return list(examples.values())
+
+
+def _filter_width(range_filter: RangeFilter) -> float:
+    if range_filter.low is None or range_filter.high is None:
+        return float("inf")
+    return range_filter.high - range_filter.low
+
+
+def ingest_document_results(jsonl_path: Path):
+    """Feeds the results of a document into the store configured by COMPOSITION_STORE_PATH, if any."""
+    db_path = os.getenv("COMPOSITION_STORE_PATH")
+    if not db_path:
+        return
+    store = CompositionStore(db_path)
+    try:
+        store.ingest_result_file(jsonl_path)
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query normalized compositions across the corpus.")
+    parser.add_argument("--db", default=os.getenv("COMPOSITION_STORE_PATH", "output_data/compositions.sqlite"), help="Path of the SQLite store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Ingest all *_normalized.jsonl result files of a directory.")
+    ingest_parser.add_argument("results", nargs="?", default="output_data")
+
+    query_parser = subparsers.add_parser("query", help="Find examples by element ranges, e.g. SiO2:55:65 B2O3:10:")
+    query_parser.add_argument("filters", nargs="+", type=RangeFilter.parse)
+    query_parser.add_argument("--unit", choices=["wt%", "mol%"])
+    query_parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    store = CompositionStore(args.db)
+    try:
+        if args.command == "ingest":
+            count = sum(store.ingest_result_file(path) for path in sorted(Path(args.results).glob("*_normalized.jsonl")))
+            print(f"Ingested {count} components into {args.db}")
+        else:
+            for example in store.query(args.filters, unit=args.unit, limit=args.limit):
+                values = ", ".join(f"{element}=[{low}, {high}]" for element, (low, high) in sorted(example["components"].items()))
+                print(f"{example['document']}\ttable {example['table_number']}\texample {example['example']}\t{example['unit']}\tpage {example['page']}\t{values}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional
+
+from pydantic import BaseModel
+
+from handler.azure_blob_storage_handler import AzureBlobStorageManager, get_blob_storage_manager
+from handler.cosmos_db_handler import CosmosDBManager
+
+
+class SourceDocument(BaseModel):
+    """A document that is available as a local file for the pipeline."""
+
+    name: str
+    local_path: str
+    size: int
+    blob_name: Optional[str] = None
+    temporary: bool = False
+
+
+class DocumentSource(ABC):
+    """A source of input documents.
+
+    `names` lists the documents of the source, `fetch` makes one of them available as a local
+    file and `release` removes the local file again if the source created it. Iterating a
+    source releases every document when the next one is requested, `process` handles several
+    documents at a time and releases each one when its handler returned.
+    """
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def fetch(self, name: str) -> SourceDocument:
+        pass
+
+    def release(self, document: SourceDocument):
+        if document.temporary:
+            Path(document.local_path).unlink(missing_ok=True)
+
+    def _documents(self) -> Iterator[SourceDocument]:
+        """Yields the fetched documents; the caller releases them."""
+        for name in self.names():
+            yield self.fetch(name)
+
+    def __iter__(self) -> Iterator[SourceDocument]:
+        for document in self._documents():
+            try:
+                yield document
+            finally:
+                self.release(document)
+
+    def process(self, handler: Callable[[SourceDocument], Any], concurrency: int = 1):
+        """Calls `handler` for every document, for up to `concurrency` documents at a time.
+
+        The next document is only taken from the source when a slot is free, so prefetching
+        stays bounded. A handler that fails is reported with a message and does not stop the
+        other documents.
+        """
+        slots = threading.BoundedSemaphore(max(concurrency, 1))
+
+        def run(document: SourceDocument):
+            try:
+                handler(document)
+            except Exception as e:
+                print(f"Processing document '{document.name}' failed: {e}")
+            finally:
+                self.release(document)
+                slots.release()
+
+        documents = self._documents()
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            try:
+                while True:
+                    slots.acquire()
+                    document = next(documents, None)
+                    if document is None:
+                        slots.release()
+                        break
+                    executor.submit(run, document)
+            finally:
+                documents.close()
+
+
+class LocalDocumentSource(DocumentSource):
+    """The files of a local folder."""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def names(self) -> List[str]:
+        return sorted(filename for filename in os.listdir(self.folder) if os.path.isfile(os.path.join(self.folder, filename)))
+
+    def fetch(self, name: str) -> SourceDocument:
+        path = os.path.join(self.folder, name)
+        return SourceDocument(name=name, local_path=path, size=os.path.getsize(path))
+
+
+class BlobDocumentSource(DocumentSource):
+    """The blobs below a prefix of the storage container, or an explicit list of blob names or filenames.
+
+    Blobs are downloaded into `download_dir` (a temporary directory by default) and deleted
+    when they are released.
+    """
+
+    def __init__(
+        self,
+        blob_manager: AzureBlobStorageManager,
+        prefix: Optional[str] = None,
+        blob_names: Optional[List[str]] = None,
+        download_dir: Optional[str] = None,
+        suffix: str = ".pdf",
+    ):
+        self.blob_manager = blob_manager
+        self.prefix = prefix
+        self.blob_names = blob_names
+        self.download_dir = Path(download_dir or tempfile.mkdtemp(prefix="chemxtract_documents_"))
+        self.suffix = suffix
+
+    def names(self) -> List[str]:
+        if self.blob_names is not None:
+            return list(self.blob_names)
+        return sorted(
+            blob.name
+            for blob in self.blob_manager.container_client.list_blobs(name_starts_with=self.prefix)
+            if blob.name.lower().endswith(self.suffix)
+        )
+
+    def fetch(self, name: str) -> SourceDocument:
+        blob_name = self.blob_manager.resolve_blob_name(name)
+        if not blob_name:
+            raise FileNotFoundError(f"Blob '{name}' not found.")
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        # keep the file name, the output files are named after it
+        target_dir = Path(tempfile.mkdtemp(dir=self.download_dir))
+        local_path = target_dir / posixpath.basename(blob_name)
+        if not self.blob_manager.download_blob_to_path(blob_name, str(local_path)):
+            shutil.rmtree(target_dir, ignore_errors=True)
+            raise IOError(f"Blob '{blob_name}' could not be downloaded.")
+        return SourceDocument(name=name, local_path=str(local_path), size=local_path.stat().st_size, blob_name=blob_name, temporary=True)
+
+    def release(self, document: SourceDocument):
+        if document.temporary:
+            shutil.rmtree(Path(document.local_path).parent, ignore_errors=True)
+
+
+class CosmosManifestDocumentSource(BlobDocumentSource):
+    """The blobs listed in a Cosmos DB item, e.g. the `documents[].path` of a job item."""
+
+    def __init__(
+        self,
+        cosmos_manager: CosmosDBManager,
+        blob_manager: AzureBlobStorageManager,
+        item_id: str,
+        keys_path: Optional[List[str]] = None,
+        download_dir: Optional[str] = None,
+    ):
+        super().__init__(blob_manager, download_dir=download_dir)
+        self.cosmos_manager = cosmos_manager
+        self.item_id = item_id
+        self.keys_path = keys_path or ["documents", "path"]
+
+    def names(self) -> List[str]:
+        return [str(path) for path in self.cosmos_manager.extract_nested_values_from_item(self.item_id, self.keys_path) if path]
+
+
+class PrefetchingDocumentSource(DocumentSource):
+    """Fetches the next documents of a source in a background thread while the current one is processed.
+
+    At most `read_ahead` documents and, beyond the first one, at most `max_bytes` bytes are
+    held ahead of the document that is being processed. A document that cannot be fetched is
+    skipped with a message, like a failing document in the main loop.
+    """
+
+    def __init__(self, source: DocumentSource, read_ahead: int = 2, max_bytes: int = 512 * 1024 * 1024):
+        self.source = source
+        self.read_ahead = max(read_ahead, 1)
+        self.max_bytes = max_bytes
+
+    def names(self) -> List[str]:
+        return self.source.names()
+
+    def fetch(self, name: str) -> SourceDocument:
+        return self.source.fetch(name)
+
+    def release(self, document: SourceDocument):
+        self.source.release(document)
+
+    def _documents(self) -> Iterator[SourceDocument]:
+        names = self.source.names()
+        ready: deque = deque()
+        condition = threading.Condition()
+        state = {"bytes": 0, "finished": False, "stopped": False}
+
+        def has_room() -> bool:
+            return not ready or (len(ready) < self.read_ahead and state["bytes"] < self.max_bytes)
+
+        def prefetch():
+            try:
+                for name in names:
+                    with condition:
+                        condition.wait_for(lambda: state["stopped"] or has_room())
+                        if state["stopped"]:
+                            return
+                    try:
+                        document = self.source.fetch(name)
+                    except Exception as e:
+                        print(f"Skipping document '{name}': {e}")
+                        continue
+                    with condition:
+                        if state["stopped"]:
+                            self.source.release(document)
+                            return
+                        ready.append(document)
+                        state["bytes"] += document.size
+                        condition.notify_all()
+            finally:
+                with condition:
+                    state["finished"] = True
+                    condition.notify_all()
+
+        thread = threading.Thread(target=prefetch, name="document-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                with condition:
+                    condition.wait_for(lambda: ready or state["finished"])
+                    if not ready:
+                        return
+                    document = ready.popleft()
+                    state["bytes"] -= document.size
+                    condition.notify_all()
+                yield document
+        finally:
+            with condition:
+                state["stopped"] = True
+                condition.notify_all()
+            thread.join()
+            for document in ready:
+                self.source.release(document)
+
+
+def document_source_from_env() -> DocumentSource:
+    """Creates the document source configured by the environment.
+
+    DOCUMENT_SOURCE selects "local" (default), "blob" or "cosmos"; DOCUMENT_SOURCE_INPUT is the
+    folder, the blob prefix or the id of the Cosmos DB manifest item. DOCUMENT_READ_AHEAD and
+    DOCUMENT_READ_AHEAD_MAX_MB bound the prefetching.
+    """
+    kind = os.getenv("DOCUMENT_SOURCE", "local")
+    source_input = os.getenv("DOCUMENT_SOURCE_INPUT")
+    if kind == "blob":
+        source = BlobDocumentSource(get_blob_storage_manager(), prefix=source_input)
+    elif kind == "cosmos":
+        source = CosmosManifestDocumentSource(CosmosDBManager(), get_blob_storage_manager(), item_id=source_input)
+    elif kind == "local":
+        source = LocalDocumentSource(source_input or "input_data")
+    else:
+        raise ValueError(f"Unknown DOCUMENT_SOURCE '{kind}', expected 'local', 'blob' or 'cosmos'.")
+    return PrefetchingDocumentSource(
+        source,
+        read_ahead=int(os.getenv("DOCUMENT_READ_AHEAD", "2")),
+        max_bytes=int(float(os.getenv("DOCUMENT_READ_AHEAD_MAX_MB", "512")) * 1024 * 1024),
+    )
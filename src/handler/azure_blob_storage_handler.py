@@ -1,7 +1,50 @@
+import asyncio
+import functools
+import io
 import os
+import tempfile
+import threading
 from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas, BlobClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from handler.blob_filename_index import BlobFilenameIndex
+from typing import Dict, Iterable, Optional, Tuple
+
+# Size of the range requests of a download. Blobs up to this size are downloaded with a single
+# request, larger blobs with parallel range requests of this size.
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class _MemoryViewWriter(io.RawIOBase):
+    """A seekable stream that writes into a preallocated buffer, the target of parallel range downloads."""
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = offset
+        return self.position
+
+    def write(self, data):
+        size = len(data)
+        self.view[self.position : self.position + size] = data
+        self.position += size
+        return size
 
 
 class AzureBlobStorageManager:
@@ -16,6 +59,13 @@ class AzureBlobStorageManager:
     - `AZURE_STORAGE_ACCOUNT_NAME`:  The name of your Azure Storage Account.
     - `AZURE_STORAGE_ACCOUNT_KEY`:  The access key for your Azure Storage Account.
     - `AZURE_STORAGE_CONTAINER_NAME`: The name of the Azure Blob Storage container you want to access.
+
+    **Optional Environment Variables:**
+
+    - `AZURE_STORAGE_BLOB_PREFIX`: Restricts file name lookups to blobs below this prefix.
+    - `AZURE_STORAGE_FILENAME_INDEX_PATH`: Local JSON file in which the file name index is persisted.
+    - `AZURE_STORAGE_FILENAME_INDEX_TTL_SECONDS`: Age after which the file name index is rebuilt (default: 86400).
+    - `AZURE_STORAGE_DOWNLOAD_CONCURRENCY`: Number of parallel range requests per download (default: 4).
     """
 
     def __init__(self):
@@ -28,6 +78,9 @@ class AzureBlobStorageManager:
         - `AZURE_STORAGE_ACCOUNT_NAME`:  (Required) The name of your Azure Storage Account.
         - `AZURE_STORAGE_ACCOUNT_KEY`:  (Required) The access key for your Azure Storage Account.
         - `AZURE_STORAGE_CONTAINER_NAME`: (Required) The name of the Azure Blob Storage container.
+        - `AZURE_STORAGE_BLOB_PREFIX`, `AZURE_STORAGE_FILENAME_INDEX_PATH`, `AZURE_STORAGE_FILENAME_INDEX_TTL_SECONDS`:
+          (Optional) Configuration of the file name index used by `find_blob_by_filename`.
+        - `AZURE_STORAGE_DOWNLOAD_CONCURRENCY`: (Optional) Number of parallel range requests per download.
 
         Raises:
             ValueError: If any of the required environment variables are not set.
@@ -44,8 +97,19 @@ class AzureBlobStorageManager:
         if not self.container_name:
             raise ValueError("AZURE_STORAGE_CONTAINER_NAME environment variable not set.")
 
+        self.download_concurrency = int(os.getenv("AZURE_STORAGE_DOWNLOAD_CONCURRENCY", "4"))
+        # SAS URL and its expiry per (blob name, expiry hours)
+        self._sas_url_cache: Dict[Tuple[str, float], Tuple[str, datetime]] = {}
+        self._sas_url_lock = threading.Lock()
+
         self.blob_service_client = self._create_blob_service_client()
         self.container_client = self._get_container_client()
+        self.filename_index = BlobFilenameIndex(
+            self.container_client,
+            index_path=os.getenv("AZURE_STORAGE_FILENAME_INDEX_PATH"),
+            prefix=os.getenv("AZURE_STORAGE_BLOB_PREFIX"),
+            ttl_seconds=float(os.getenv("AZURE_STORAGE_FILENAME_INDEX_TTL_SECONDS", "86400")),
+        )
 
     def _create_blob_service_client(self):
         """
@@ -54,15 +118,19 @@ class AzureBlobStorageManager:
         Returns:
             BlobServiceClient: Initialized BlobServiceClient.
         """
-        connect_str = f"DefaultEndpointsProtocol=https;AccountName={self.account_name};AccountKey={self.account_key};EndpointSuffix=core.windows.net"
         try:
-            blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+            blob_service_client = BlobServiceClient.from_connection_string(
+                self._connection_string(), max_single_get_size=DOWNLOAD_CHUNK_SIZE, max_chunk_get_size=DOWNLOAD_CHUNK_SIZE
+            )
             print("BlobServiceClient initialized successfully.")
             return blob_service_client
         except Exception as e:
             print(f"Error initializing BlobServiceClient: {e}")
             raise
 
+    def _connection_string(self):
+        return f"DefaultEndpointsProtocol=https;AccountName={self.account_name};AccountKey={self.account_key};EndpointSuffix=core.windows.net"
+
     def _get_container_client(self):
         """
         Gets and returns a ContainerClient for the specified container name.
@@ -82,38 +150,42 @@ class AzureBlobStorageManager:
         """
         Searches for a blob in the container by its filename.
 
-        Iterates through all blobs in the container and checks if the name of any blob
-        ends with the provided filename. This allows finding blobs without knowing the full path.
+        Looks the filename up in the filename index of the container, which is built with one
+        listing and refreshed when it expires or a filename is missing. This allows finding blobs
+        without knowing the full path.
 
         Args:
             filename (str): The filename to search for (e.g., "1524643529172026216015001.pdf").
 
         Returns:
-            str or None: The full blob name (including path) if a blob with the given filename is found,
-                         otherwise None.
+            str or None: The full blob name (including path) of the blob with the given filename, the first one
+                         in listing order if there are several, otherwise None.
         """
         try:
-            blob_list = self.container_client.list_blobs()
-            for blob in blob_list:
-                if blob.name.endswith(filename):  # Check if blob name ends with the filename
-                    print(f"Found blob with filename '{filename}': '{blob.name}'")
-                    return blob.name  # Return the full blob name (path)
+            blob_name = self.filename_index.lookup(filename)
+            if blob_name:
+                print(f"Found blob with filename '{filename}': '{blob_name}'")
+                return blob_name
             print(f"Blob with filename '{filename}' not found in container '{self.container_name}'.")
-            return None  # Blob not found
+            return None
         except Exception as e:
             print(f"Error searching for blob by filename '{filename}': {e}")
             return None
 
-    def generate_sas_url(self, blob_name, expiry_hours=2):
+    def generate_sas_url(self, blob_name, expiry_hours=2, min_remaining_minutes=15):
         """
         Generates a SAS URL for a specific blob in the container.
 
         Also accepts just the filename without path. It will first try to find the full blob path
         using `find_blob_by_filename` if the provided `blob_name` does not contain a path.
 
+        Generated URLs are cached and returned again as long as they are valid for at least
+        `min_remaining_minutes`.
+
         Args:
             blob_name (str): Name of the blob (can be just filename or full path).
             expiry_hours (int): Number of hours until the SAS URL expires. Defaults to 2 hours.
+            min_remaining_minutes (int): Minimum remaining validity of a cached SAS URL. Defaults to 15 minutes.
 
         Returns:
             str: SAS URL for the blob, or None if an error occurs or blob is not found.
@@ -127,16 +199,25 @@ class AzureBlobStorageManager:
                 print(f"Could not find blob with filename '{blob_name}' to generate SAS URL.")
                 return None
 
+        now = datetime.now(timezone.utc)
+        with self._sas_url_lock:
+            cached = self._sas_url_cache.get((full_blob_name, expiry_hours))
+        if cached and cached[1] - now >= timedelta(minutes=min_remaining_minutes):
+            return cached[0]
+
         try:
+            expiry = now + timedelta(hours=expiry_hours)
             sas_token = generate_blob_sas(
                 account_name=self.account_name,
                 container_name=self.container_name,
                 blob_name=full_blob_name,
                 account_key=self.account_key,
                 permission=BlobSasPermissions(read=True),
-                expiry=datetime.now(timezone.utc) + timedelta(hours=expiry_hours),
+                expiry=expiry,
             )
             sas_url = f"https://{self.account_name}.blob.core.windows.net/{self.container_name}/{full_blob_name}?{sas_token}"
+            with self._sas_url_lock:
+                self._sas_url_cache[(full_blob_name, expiry_hours)] = (sas_url, expiry)
             print(f"SAS URL generated for blob '{full_blob_name}'.")
             return sas_url
         except Exception as e:
@@ -176,37 +257,147 @@ class AzureBlobStorageManager:
             print(f"Error checking if blob '{full_blob_name}' exists: {e}")
             return False
 
-    def download_blob_content(self, blob_name):
+    def resolve_blob_name(self, blob_name):
+        """Returns the full blob name of a blob name or bare filename, or None if the filename is not found."""
+        if "/" not in blob_name and "\\" not in blob_name:
+            return self.find_blob_by_filename(blob_name)
+        return blob_name
+
+    def download_blob_content(self, blob_name, max_concurrency=None):
         """
         Downloads the content of a blob as bytes.
 
+        Blobs larger than one chunk are downloaded with parallel range requests directly into a
+        preallocated buffer, so the content is held in memory only once.
+
         Also accepts just the filename. It will first try to find the full blob path
         using `find_blob_by_filename` if the provided `blob_name` does not contain a path.
 
         Args:
             blob_name (str): Name of the blob to download (can be just filename or full path).
+            max_concurrency (int): Number of parallel range requests, defaults to AZURE_STORAGE_DOWNLOAD_CONCURRENCY.
 
         Returns:
-            bytes or None: The content of the blob as bytes, or None if download fails or blob is not found.
+            bytearray or None: The content of the blob, or None if download fails or blob is not found.
         """
-        full_blob_name = blob_name
-
-        if "/" not in blob_name and "\\" not in blob_name:
-            full_blob_name = self.find_blob_by_filename(blob_name)
-            if not full_blob_name:
-                print(f"Blob with filename '{blob_name}' not found, cannot download content.")
-                return None
+        full_blob_name = self.resolve_blob_name(blob_name)
+        if not full_blob_name:
+            print(f"Blob with filename '{blob_name}' not found, cannot download content.")
+            return None
 
         try:
             blob_client: BlobClient = self.container_client.get_blob_client(blob=full_blob_name)
-            download_stream = blob_client.download_blob()
-            blob_content = download_stream.readall()
+            download_stream = blob_client.download_blob(max_concurrency=max_concurrency or self.download_concurrency)
+            blob_content = bytearray(download_stream.size)
+            download_stream.readinto(_MemoryViewWriter(memoryview(blob_content)))
             print(f"Content of blob '{full_blob_name}' downloaded successfully.")
             return blob_content
         except Exception as e:
             print(f"Error downloading content of blob '{full_blob_name}': {e}")
             return None
 
+    def download_blob_to_file(self, blob_name, max_concurrency=None, max_memory_size=16 * 1024 * 1024):
+        """
+        Downloads a blob into a spooled temporary file with parallel range requests.
+
+        The file stays in memory up to `max_memory_size` bytes and is moved to disk beyond that,
+        so large scans do not have to fit into memory.
+
+        Args:
+            blob_name (str): Name of the blob to download (can be just filename or full path).
+            max_concurrency (int): Number of parallel range requests, defaults to AZURE_STORAGE_DOWNLOAD_CONCURRENCY.
+            max_memory_size (int): Size up to which the file is kept in memory.
+
+        Returns:
+            SpooledTemporaryFile or None: The file positioned at its start, or None if download fails or blob is not found.
+        """
+        full_blob_name = self.resolve_blob_name(blob_name)
+        if not full_blob_name:
+            print(f"Blob with filename '{blob_name}' not found, cannot download content.")
+            return None
+
+        target = tempfile.SpooledTemporaryFile(max_size=max_memory_size, suffix=os.path.splitext(full_blob_name)[1])
+        try:
+            blob_client: BlobClient = self.container_client.get_blob_client(blob=full_blob_name)
+            blob_client.download_blob(max_concurrency=max_concurrency or self.download_concurrency).readinto(target)
+            target.seek(0)
+            print(f"Blob '{full_blob_name}' downloaded to a temporary file.")
+            return target
+        except Exception as e:
+            target.close()
+            print(f"Error downloading blob '{full_blob_name}' to a temporary file: {e}")
+            return None
+
+    def download_blob_to_path(self, blob_name, path, max_concurrency=None):
+        """
+        Downloads a blob into a local file with parallel range requests.
+
+        Args:
+            blob_name (str): Name of the blob to download (can be just filename or full path).
+            path (str): The local file to write.
+            max_concurrency (int): Number of parallel range requests, defaults to AZURE_STORAGE_DOWNLOAD_CONCURRENCY.
+
+        Returns:
+            bool: True if the blob was downloaded, False otherwise.
+        """
+        full_blob_name = self.resolve_blob_name(blob_name)
+        if not full_blob_name:
+            print(f"Blob with filename '{blob_name}' not found, cannot download content.")
+            return False
+
+        try:
+            blob_client: BlobClient = self.container_client.get_blob_client(blob=full_blob_name)
+            with open(path, "wb") as f:
+                blob_client.download_blob(max_concurrency=max_concurrency or self.download_concurrency).readinto(f)
+            print(f"Blob '{full_blob_name}' downloaded to '{path}'.")
+            return True
+        except Exception as e:
+            print(f"Error downloading blob '{full_blob_name}' to '{path}': {e}")
+            return False
+
+    def download_many_blob_contents(self, blob_names: Iterable[str], max_concurrency: int = 16) -> Dict[str, Optional[bytes]]:
+        """
+        Downloads many (small) blobs concurrently with one asynchronous client.
+
+        All downloads share the connection pool of the client; at most `max_concurrency` run at
+        the same time. Must not be called from a running event loop.
+
+        Args:
+            blob_names (Iterable[str]): Full blob names or bare filenames.
+            max_concurrency (int): Maximum number of downloads in flight.
+
+        Returns:
+            Dict[str, Optional[bytes]]: The content per given blob name, None for blobs that could not be downloaded.
+        """
+        blob_names = list(blob_names)
+        full_blob_names = {blob_name: self.resolve_blob_name(blob_name) for blob_name in blob_names}
+        return asyncio.run(self._download_many(full_blob_names, max_concurrency))
+
+    async def _download_many(self, full_blob_names: Dict[str, Optional[str]], max_concurrency: int) -> Dict[str, Optional[bytes]]:
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def download(container_client, blob_name, full_blob_name):
+            if not full_blob_name:
+                return blob_name, None
+            async with semaphore:
+                try:
+                    download_stream = await container_client.get_blob_client(full_blob_name).download_blob()
+                    return blob_name, await download_stream.readall()
+                except Exception as e:
+                    print(f"Error downloading content of blob '{full_blob_name}': {e}")
+                    return blob_name, None
+
+        async with AsyncBlobServiceClient.from_connection_string(self._connection_string()) as blob_service_client:
+            container_client = blob_service_client.get_container_client(self.container_name)
+            results = await asyncio.gather(*(download(container_client, name, full_name) for name, full_name in full_blob_names.items()))
+        return dict(results)
+
+
+@functools.lru_cache(maxsize=None)
+def get_blob_storage_manager() -> AzureBlobStorageManager:
+    """Returns an AzureBlobStorageManager shared by the pipeline, created on first use."""
+    return AzureBlobStorageManager()
+
 
 if __name__ == "__main__":
     # Example usage of AzureBlobStorageManager
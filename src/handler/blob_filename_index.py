@@ -0,0 +1,118 @@
+import json
+import os
+import posixpath
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from azure.storage.blob import ContainerClient
+
+
+class BlobFilenameIndex:
+    """
+    Maps file names to the full blob paths of a container, built with a single listing.
+
+    The index is built on the first lookup and persisted as JSON if `index_path` is given, so a
+    new process starts with the index of the previous run. It is rebuilt when it is older than
+    `ttl_seconds` or when a file name is not found and the last listing is at least
+    `min_refresh_seconds` old.
+
+    A refresh is not incremental: blob listings cannot be filtered by modification time on the
+    server, so every refresh lists the whole (prefix-scoped) container and rebuilds the index.
+    The newest modification time seen is only kept to report how many blobs were added or
+    changed since the previous listing. The cost of a listing is bounded by the TTL and
+    `min_refresh_seconds`, not by the number of lookups.
+
+    A file name that belongs to several blobs resolves to the first of them in listing order,
+    i.e. the lexicographically smallest path, with a warning.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerClient,
+        index_path: Optional[str] = None,
+        prefix: Optional[str] = None,
+        ttl_seconds: float = 24 * 3600,
+        min_refresh_seconds: float = 300,
+    ):
+        self.container_client = container_client
+        self.index_path = Path(index_path) if index_path else None
+        self.prefix = prefix or None
+        self.ttl_seconds = ttl_seconds
+        self.min_refresh_seconds = min_refresh_seconds
+        self.paths_by_filename: Dict[str, List[str]] = {}
+        self.built_at = 0.0
+        self.last_modified = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.index_path is None or not self.index_path.exists():
+            return
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable blob filename index '{self.index_path}': {e}")
+            return
+        if data.get("container") != self.container_client.container_name or data.get("prefix") != self.prefix:
+            return
+        self.paths_by_filename = data["paths_by_filename"]
+        self.built_at = data["built_at"]
+        self.last_modified = data["last_modified"]
+
+    def _save(self):
+        if self.index_path is None:
+            return
+        data = {
+            "container": self.container_client.container_name,
+            "prefix": self.prefix,
+            "built_at": self.built_at,
+            "last_modified": self.last_modified,
+            "paths_by_filename": self.paths_by_filename,
+        }
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self):
+        """Rebuilds the index from a full listing of the (prefix-scoped) container."""
+        paths_by_filename: Dict[str, List[str]] = {}
+        last_modified = self.last_modified
+        added = 0
+        for blob in self.container_client.list_blobs(name_starts_with=self.prefix):
+            paths_by_filename.setdefault(posixpath.basename(blob.name), []).append(blob.name)
+            modified = blob.last_modified.timestamp() if blob.last_modified else 0.0
+            if modified > self.last_modified:
+                added += 1
+            last_modified = max(last_modified, modified)
+        self.paths_by_filename = paths_by_filename
+        self.last_modified = last_modified
+        self.built_at = time.time()
+        self._save()
+        print(f"Blob filename index rebuilt from a full listing with {len(paths_by_filename)} file names, {added} blobs new or changed since the last listing.")
+
+    def lookup(self, filename: str) -> Optional[str]:
+        """
+        Returns the full blob path of a file name.
+
+        Returns:
+            str or None: The blob path, the first one in listing order if the file name is
+                         ambiguous, or None if the file name is unknown.
+        """
+        with self._lock:
+            age = time.time() - self.built_at
+            if age > self.ttl_seconds or (filename not in self.paths_by_filename and age > self.min_refresh_seconds):
+                self.refresh()
+            paths = self.paths_by_filename.get(filename, [])
+        if not paths:
+            return None
+        path = min(paths)
+        if len(paths) > 1:
+            print(f"Warning: file name '{filename}' is ambiguous, it matches {len(paths)} blobs: {sorted(paths)[:5]}; using '{path}'")
+        return path
+
+    def ambiguous_filenames(self) -> Dict[str, List[str]]:
+        """Returns all file names that belong to more than one blob."""
+        return {filename: paths for filename, paths in self.paths_by_filename.items() if len(paths) > 1}
@@ -1,11 +1,75 @@
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from azure.cosmos import cosmos_client, exceptions, ContainerProxy, CosmosDict
-from typing import Tuple, Any, List
+from pydantic import BaseModel
+from handler.cosmos_item_cache import CosmosItemCache
+from typing import Tuple, Any, Dict, Iterable, Iterator, List, Optional
 import logging
 
 log = logging.getLogger("cosmosdb")
 
+# Maximum number of operations in one transactional batch
+TRANSACTIONAL_BATCH_LIMIT = 100
+
+# Maximum number of ids that are read with one query in read_many
+READ_MANY_QUERY_LIMIT = 256
+
+
+class BulkItemStatus(BaseModel):
+    """The outcome of one item of a bulk write."""
+
+    id: str
+    partition_key: Any
+    status_code: int
+    error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return 200 <= self.status_code < 300
+
+
+def _retry_after_seconds(error: Exception, attempt: int) -> float:
+    """Returns the delay requested by the server for a throttled request, or an exponential backoff."""
+    headers = getattr(error, "headers", None) or {}
+    retry_after_ms = headers.get("x-ms-retry-after-ms")
+    if retry_after_ms:
+        return float(retry_after_ms) / 1000
+    return min(0.1 * 2**attempt, 10.0)
+
+
+def _hashable(partition_key: Any) -> Any:
+    """Hierarchical partition keys are lists; turns them into tuples to use them as dictionary keys."""
+    return tuple(partition_key) if isinstance(partition_key, list) else partition_key
+
+
+def _property_path(alias: str, keys: List[str]) -> str:
+    """Builds a property reference in bracket notation, e.g. c["documents"]["path"], with escaped keys."""
+    return alias + "".join(f"[{json.dumps(key)}]" for key in keys)
+
+
+def build_projection_queries(keys_path: List[str]) -> Tuple[Optional[str], str]:
+    """
+    Builds the queries that project the values at `keys_path` out of the item with the id @id.
+
+    Returns:
+        Tuple[Optional[str], str]: A query that joins the array at `keys_path[:-1]` and selects the last key of
+        every element (None for a single key), and a query that selects the value at `keys_path` directly.
+    """
+    parent, target = keys_path[:-1], keys_path[-1:]
+    value_query = f"SELECT VALUE {_property_path('c', keys_path)} FROM c WHERE c.id = @id AND IS_DEFINED({_property_path('c', keys_path)})"
+    if not parent:
+        return None, value_query
+    join_query = (
+        f"SELECT VALUE {_property_path('e', target)} FROM c JOIN e IN {_property_path('c', parent)} "
+        f"WHERE c.id = @id AND IS_DEFINED({_property_path('e', target)})"
+    )
+    return join_query, value_query
+
 
 class CosmosDBManager:
     container: ContainerProxy
@@ -20,9 +84,13 @@ class CosmosDBManager:
     - MASTER_KEY: Your Azure Cosmos DB account primary or secondary key.
     - DATABASE_ID: The ID of the Cosmos DB database to use.
     - CONTAINER_ID: The ID of the Cosmos DB container within the database to use.
+    - PARTITION_KEY_PATH: (Optional) The partition key path of the container, defaults to "/id".
+    - COSMOS_ITEM_CACHE_DIR: (Optional) Enables the ETag-revalidated item cache and persists it in this directory.
+    - COSMOS_ITEM_CACHE_TTL_SECONDS: (Optional) Age after which a cached item is revalidated, defaults to 300.
+    - COSMOS_ITEM_CACHE_MAX_ENTRIES: (Optional) Maximum number of cached items, defaults to 1000.
     """
 
-    def __init__(self):
+    def __init__(self, container: Optional[ContainerProxy] = None, item_cache: Optional[CosmosItemCache] = None):
         """
         Initializes the CosmosDBManager by loading environment variables from a .env file
         and initializing the Azure Cosmos DB client.
@@ -32,13 +100,32 @@ class CosmosDBManager:
         - MASTER_KEY: Your Azure Cosmos DB account primary or secondary key.
         - DATABASE_ID: The ID of the Cosmos DB database to use.
         - CONTAINER_ID: The ID of the Cosmos DB container within the database to use.
+        - PARTITION_KEY_PATH: (Optional) The partition key path of the container, defaults to "/id".
+        - COSMOS_ITEM_CACHE_DIR, COSMOS_ITEM_CACHE_TTL_SECONDS, COSMOS_ITEM_CACHE_MAX_ENTRIES: (Optional) The item cache.
+
+        Args:
+            container: An existing container client, e.g. an in-process fake for testing.
+                       If given, no Cosmos DB client is created.
+            item_cache: A cache for the items read by id. If not given, a cache is created when
+                        COSMOS_ITEM_CACHE_DIR is set.
         """
         load_dotenv()
         self.HOST = os.environ.get("HOST")
         self.MASTER_KEY = os.environ.get("MASTER_KEY")
         self.DATABASE_ID = os.environ.get("DATABASE_ID")
         self.CONTAINER_ID = os.environ.get("CONTAINER_ID")
-        self.client, self.db, self.container = self._initialize_cosmosdb()
+        self.PARTITION_KEY_PATH = os.environ.get("PARTITION_KEY_PATH", "/id")
+        if item_cache is None and os.environ.get("COSMOS_ITEM_CACHE_DIR"):
+            item_cache = CosmosItemCache(
+                cache_dir=os.environ["COSMOS_ITEM_CACHE_DIR"],
+                ttl_seconds=float(os.environ.get("COSMOS_ITEM_CACHE_TTL_SECONDS", "300")),
+                max_entries=int(os.environ.get("COSMOS_ITEM_CACHE_MAX_ENTRIES", "1000")),
+            )
+        self.item_cache = item_cache
+        if container is not None:
+            self.client, self.db, self.container = None, None, container
+        else:
+            self.client, self.db, self.container = self._initialize_cosmosdb()
 
     def _initialize_cosmosdb(self) -> Tuple[cosmos_client.CosmosClient, Any, Any]:
         """
@@ -75,61 +162,116 @@ class CosmosDBManager:
         log.debug(f"Getting item with Id: {item_id}")
         try:
             # Assuming the partition key is the same as the item_id
-            response = container.read_item(item=item_id, partition_key=item_id)
+            if self.item_cache is not None:
+                response = self.item_cache.read_item(container, item_id, item_id)
+            else:
+                response = container.read_item(item=item_id, partition_key=item_id)
             log.debug(f"Item Id: {response.get('id')}")
             return response
         except exceptions.CosmosHttpResponseError as e:
             log.error(f"Error occurred while getting item: {e.message}")
             return None
 
-    def extract_nested_values_from_item(self, item_id: str, keys_path: List[str]) -> List[Any]:
+    def extract_nested_values_from_item(self, item_id: str, keys_path: List[str], partition_key: Any = None) -> List[Any]:
         """
         Extracts values from a Cosmos DB item based on a provided path of keys.
 
+        The values are projected on the server, so only the extracted values are transferred and not
+        the whole item. If the level before the last key is an array, the last key is read from every
+        element of the array; otherwise the value at the path is returned, a list value is flattened.
+
         Args:
             item_id (str): The ID of the Cosmos DB item to retrieve.
             keys_path (List[str]): A list of keys representing the path to the desired values.
                                      For example, to get 'path' from 'documents' array, keys_path would be ['documents', 'path'].
+            partition_key: The partition key of the item, defaults to the item id.
 
         Returns:
             List[Any]: A list of extracted values, or an empty list if the item or path is not found, or if extraction fails.
         """
-        item = self.get_cosmos_item_by_id(item_id)
-        if not item:
-            log.debug(f"Could not retrieve item with id '{item_id}'.")
+        partition_key = item_id if partition_key is None else partition_key
+        join_query, value_query = build_projection_queries(keys_path)
+        parameters = [{"name": "@id", "value": item_id}]
+        try:
+            if join_query:
+                values = list(self.container.query_items(join_query, parameters=parameters, partition_key=partition_key))
+                if values:
+                    return values
+            values = list(self.container.query_items(value_query, parameters=parameters, partition_key=partition_key))
+        except exceptions.CosmosHttpResponseError as e:
+            log.error(f"Error occurred while extracting {keys_path} from item '{item_id}': {e.message}")
             return []
 
-        current_level = item
-        for key in keys_path[:-1]:  # Iterate through keys except the last one to navigate the structure
-            if key in current_level:
-                current_level = current_level.get(key)
-                if not isinstance(current_level, dict) and not isinstance(current_level, list):  # Ensure we can continue to navigate
-                    log.debug(f"Path element '{key}' did not lead to a nested structure (dict or list) as expected.")
-                    return []  # Stop if we can't navigate further
-            else:
-                log.error(f"Key '{key}' not found in the item for path '{keys_path}'.")
-                return []  # Key not found, path is invalid
-
-        target_key = keys_path[-1]  # The last key is the one from which we want to extract values
-        extracted_values = []
-
-        if isinstance(current_level, list):  # Handle case where the level before the last key is a list
-            for element in current_level:
-                if isinstance(element, dict) and target_key in element:
-                    extracted_values.append(element.get(target_key))
-        elif isinstance(current_level, dict) and target_key in current_level:  # Handle case where it's a dict
-            # If the target key is found at this level, and it's a list, extend the results. If it's a single value, append it.
-            target_value = current_level.get(target_key)
-            if isinstance(target_value, list):
-                extracted_values.extend(target_value)  # Extend if it's a list of values
-            else:
-                extracted_values.append(target_value)  # Append if it's a single value
+        if not values:
+            log.debug(f"Path '{keys_path}' not found in item '{item_id}'.")
+            return []
+        return values[0] if isinstance(values[0], list) else values
 
-        else:
-            log.error(f"Target key '{target_key}' not found at the end of path '{keys_path}'.")
-            return []  # Target key not found
+    def read_many(self, pairs: Iterable[Tuple[str, Any]], max_concurrency: int = 16) -> List[Optional[Dict[str, Any]]]:
+        """
+        Reads many items by id and partition key.
 
-        return extracted_values
+        If the SDK offers a batched read (`read_items`), it is used. Otherwise ids that share a
+        partition key are read with one query per partition key and single ids with point reads,
+        all running concurrently.
+
+        Args:
+            pairs (Iterable[Tuple[str, Any]]): (id, partition key) pairs of the items to read.
+            max_concurrency (int): Maximum number of requests in flight.
+
+        Returns:
+            List[Optional[dict]]: The items in the order of the pairs, None for items that do not exist or could not be read.
+        """
+        pairs = list(pairs)
+        positions: Dict[Tuple[str, Any], List[int]] = {}
+        for index, (item_id, partition_key) in enumerate(pairs):
+            positions.setdefault((item_id, _hashable(partition_key)), []).append(index)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(pairs)
+
+        def store(items: Iterable[Dict[str, Any]]):
+            for item in items:
+                for index in positions.get((item.get("id"), self._hashable_partition_key(item)), []):
+                    results[index] = item
+
+        read_items = getattr(self.container, "read_items", None)
+        if read_items is not None:
+            unique_pairs = [pairs[indices[0]] for indices in positions.values()]
+            store(read_items(items=unique_pairs, max_concurrency=max_concurrency))
+            return results
+
+        ids_by_partition_key: Dict[Any, List[str]] = {}
+        partition_keys: Dict[Any, Any] = {}
+        for item_id, partition_key in positions:
+            ids_by_partition_key.setdefault(partition_key, []).append(item_id)
+            partition_keys[partition_key] = pairs[positions[(item_id, partition_key)][0]][1]
+        requests = [
+            (partition_keys[key], ids[start : start + READ_MANY_QUERY_LIMIT])
+            for key, ids in ids_by_partition_key.items()
+            for start in range(0, len(ids), READ_MANY_QUERY_LIMIT)
+        ]
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for items in executor.map(lambda request: self._read_ids_of_partition(*request), requests):
+                store(items)
+        log.debug(f"Read {sum(item is not None for item in results)} of {len(pairs)} items with {len(requests)} requests")
+        return results
+
+    def _read_ids_of_partition(self, partition_key: Any, item_ids: List[str]) -> List[Dict[str, Any]]:
+        """Reads the existing items among `item_ids` of one partition, with a point read for a single id."""
+        try:
+            if len(item_ids) == 1:
+                return [self.container.read_item(item=item_ids[0], partition_key=partition_key)]
+            return list(
+                self.container.query_items(
+                    "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)",
+                    parameters=[{"name": "@ids", "value": item_ids}],
+                    partition_key=partition_key,
+                )
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return []
+        except exceptions.CosmosHttpResponseError as e:
+            log.error(f"Error occurred while reading {len(item_ids)} items of partition '{partition_key}': {e.message}")
+            return []
 
     def create_item(self, item_body):
         """
@@ -146,6 +288,7 @@ class CosmosDBManager:
         try:
             response = self.container.create_item(body=item_body)
             log.debug(f"Updated Item Id: {response.get('id')}")
+            self._cache_written_item(response)
             return response
         except exceptions.CosmosHttpResponseError as e:
             log.error(f"Error occurred while updating item: {e.message}")
@@ -171,8 +314,12 @@ class CosmosDBManager:
         try:
             response = self.container.replace_item(item=item_id, body=item_body)
             log.debug(f"Updated Item Id: {response.get('id')}")
+            self._cache_written_item(response)
             return response
         except exceptions.CosmosHttpResponseError as e:
+            if self.item_cache is not None:
+                # e.g. a precondition failure because the cached version is outdated
+                self.item_cache.invalidate(item_id, self.partition_key_of(item_body))
             log.error(f"Error occurred while updating item: {e.message}")
             log.error(f"Status Code: {e.status_code}, Sub-status: {e.sub_status}")  # More detailed error info
             log.error(f"Error Message: {e.message}")
@@ -181,6 +328,99 @@ class CosmosDBManager:
             log.error(f"An unexpected error occurred while updating item: {e}")
             return None
 
+    def _cache_written_item(self, item: Optional[Dict[str, Any]]):
+        """Puts an item returned by a write into the item cache, so the next read sees the new version."""
+        if self.item_cache is not None and item:
+            self.item_cache.put(dict(item), self.partition_key_of(item))
+
+    def partition_key_of(self, item: Dict[str, Any]) -> Any:
+        """Returns the partition key value of an item according to PARTITION_KEY_PATH."""
+        value = item
+        for key in self.PARTITION_KEY_PATH.strip("/").split("/"):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    def bulk_upsert_items(self, items: Iterable[Dict[str, Any]], max_concurrency: int = 8, max_retries: int = 5) -> List[BulkItemStatus]:
+        """
+        Upserts many items with transactional batches that run concurrently.
+
+        The items are grouped by partition key into batches of at most 100 operations. Throttled
+        batches (429) are retried after the delay given by the server. If an operation of a batch
+        fails for another reason, the batch is rolled back; the failing item is reported and the
+        remaining items are retried without it.
+
+        Args:
+            items (Iterable[dict]): The items to upsert. Each item MUST include its 'id'.
+            max_concurrency (int): Maximum number of batches in flight.
+            max_retries (int): Maximum number of retries per batch.
+
+        Returns:
+            List[BulkItemStatus]: One status per item, in the order of the input items.
+        """
+        items = list(items)
+        batches: Dict[Any, List[int]] = {}
+        for index, item in enumerate(items):
+            batches.setdefault(self._hashable_partition_key(item), []).append(index)
+
+        chunks = [
+            indices[start : start + TRANSACTIONAL_BATCH_LIMIT]
+            for indices in batches.values()
+            for start in range(0, len(indices), TRANSACTIONAL_BATCH_LIMIT)
+        ]
+        statuses: List[Optional[BulkItemStatus]] = [None] * len(items)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for chunk_statuses in executor.map(lambda chunk: self._execute_upsert_batch(items, chunk, max_retries), chunks):
+                for index, status in chunk_statuses.items():
+                    statuses[index] = status
+        log.debug(f"Bulk upsert of {len(items)} items in {len(chunks)} batches finished")
+        return statuses
+
+    def _hashable_partition_key(self, item: Dict[str, Any]) -> Any:
+        return _hashable(self.partition_key_of(item))
+
+    def _execute_upsert_batch(self, items: List[Dict[str, Any]], indices: List[int], max_retries: int) -> Dict[int, BulkItemStatus]:
+        """Executes one transactional batch of upserts with retries; returns the status per item index."""
+        partition_key = self.partition_key_of(items[indices[0]])
+        statuses: Dict[int, BulkItemStatus] = {}
+
+        def status(index: int, status_code: int, error: Optional[str] = None) -> BulkItemStatus:
+            return BulkItemStatus(id=str(items[index].get("id")), partition_key=partition_key, status_code=status_code, error=error)
+
+        pending = list(indices)
+        throttled_retries = 0
+        while pending:
+            try:
+                results = self.container.execute_item_batch([("upsert", (items[index],)) for index in pending], partition_key=partition_key)
+                for index, result in zip(pending, results):
+                    statuses[index] = status(index, int(result.get("statusCode", 200)))
+                    self._cache_written_item(result.get("resourceBody"))
+                pending = []
+            except exceptions.CosmosBatchOperationError as e:
+                failed_index = pending[e.error_index]
+                failed_response = e.operation_responses[e.error_index] if e.operation_responses else {}
+                failed_status = int(failed_response.get("statusCode", e.status_code or 0))
+                if failed_status == 429 and throttled_retries < max_retries:
+                    time.sleep(_retry_after_seconds(e, throttled_retries))
+                    throttled_retries += 1
+                elif failed_status == 429:
+                    for index in pending:
+                        statuses[index] = status(index, failed_status, "Throttled, retries exhausted.")
+                    pending = []
+                else:
+                    # the batch was rolled back, retry the other items without the failing one
+                    statuses[failed_index] = status(failed_index, failed_status, e.http_error_message)
+                    pending.remove(failed_index)
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code == 429 and throttled_retries < max_retries:
+                    time.sleep(_retry_after_seconds(e, throttled_retries))
+                    throttled_retries += 1
+                else:
+                    log.error(f"Bulk upsert batch failed with status {e.status_code}: {e.message}")
+                    for index in pending:
+                        statuses[index] = status(index, e.status_code, e.message)
+                    pending = []
+        return statuses
+
     def get_cosmos_items_iterable(self):
         """
         Retrieves items from Cosmos DB container efficiently using an iterator.
@@ -198,6 +438,104 @@ class CosmosDBManager:
             return None
 
 
+    def iter_item_pages(
+        self, query: str = "SELECT * FROM c", parameters: Optional[List[Dict[str, Any]]] = None, page_size: int = 100, continuation_token: Optional[str] = None
+    ) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Iterates the results of a cross-partition query page by page.
+
+        Every page is returned together with the continuation token after it. Passing a stored
+        token as `continuation_token` resumes the iteration after that page.
+
+        Args:
+            query (str): The query, by default all items.
+            parameters (List[dict]): The query parameters, e.g. [{"name": "@id", "value": "001"}].
+            page_size (int): Maximum number of items per page.
+            continuation_token (str): The token of the last processed page, or None to start at the beginning.
+
+        Yields:
+            Tuple[List[dict], Optional[str]]: The items of a page and the continuation token, None after the last page.
+        """
+        pager = self.container.query_items(
+            query, parameters=parameters, enable_cross_partition_query=True, max_item_count=page_size
+        ).by_page(continuation_token)
+        for page in pager:
+            yield list(page), pager.continuation_token
+
+    def iter_feed_range_pages(
+        self, feed_range: Dict[str, Any], page_size: int = 100, continuation_token: Optional[str] = None
+    ) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Iterates the current version of all items of one feed range page by page.
+
+        The items are read from the change feed of the feed range from its beginning. The continuation
+        token of a page contains the feed range, so a stored token resumes the iteration on its own.
+        """
+        if continuation_token:
+            items = self.container.query_items_change_feed(continuation=continuation_token, max_item_count=page_size)
+        else:
+            items = self.container.query_items_change_feed(feed_range=feed_range, start_time="Beginning", max_item_count=page_size)
+        pager = items.by_page()
+        for page in pager:
+            page_items = list(page)
+            if page_items:
+                yield page_items, pager.continuation_token
+
+    def read_items_parallel(self, max_concurrency: int = 8, page_size: int = 100) -> Iterator[Dict[str, Any]]:
+        """
+        Reads all items of the container with one reader per feed range running in parallel.
+
+        Pages are handed over to the caller as soon as any reader has fetched them, so the items are
+        not in a global order. At most `2 * max_concurrency` pages are buffered.
+
+        Args:
+            max_concurrency (int): Maximum number of feed ranges read at the same time.
+            page_size (int): Maximum number of items per page.
+
+        Yields:
+            dict: The items of the container.
+        """
+        feed_ranges = list(self.container.read_feed_ranges())
+        log.debug(f"Reading {len(feed_ranges)} feed ranges in parallel")
+        pages: queue.Queue = queue.Queue(maxsize=2 * max_concurrency)
+        stop = threading.Event()
+        done = object()
+
+        def read_feed_range(feed_range: Dict[str, Any]):
+            try:
+                if stop.is_set():
+                    return
+                for page_items, _ in self.iter_feed_range_pages(feed_range, page_size):
+                    if stop.is_set():
+                        return
+                    pages.put(page_items)
+            except Exception as e:
+                pages.put(e)
+            finally:
+                pages.put(done)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(read_feed_range, feed_range) for feed_range in feed_ranges]
+            try:
+                remaining = len(futures)
+                while remaining:
+                    page = pages.get()
+                    if page is done:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield from page
+            finally:
+                # unblock the readers if the caller stopped early or a reader failed
+                stop.set()
+                while not all(future.done() for future in futures):
+                    try:
+                        pages.get(timeout=0.01)
+                    except queue.Empty:
+                        pass
+
+
 # Example usage:
 if __name__ == "__main__":
     try:
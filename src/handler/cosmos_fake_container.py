@@ -0,0 +1,216 @@
+import copy
+import json
+import re
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from azure.core.paging import ItemPaged
+from azure.cosmos import exceptions
+
+_PATH_PATTERN = r'([ce])((?:\["(?:[^"\\]|\\.)*"\])+)'
+_PROJECTION_QUERY = re.compile(
+    rf"SELECT VALUE {_PATH_PATTERN} FROM c(?: JOIN e IN {_PATH_PATTERN})? WHERE c\.id = @id AND IS_DEFINED\({_PATH_PATTERN}\)$"
+)
+_MISSING = object()
+
+
+def _keys_of(path: str) -> List[str]:
+    return json.loads("[" + path[1:-1].replace('"][', '",') + "]") if path else []
+
+
+def _resolve(value: Any, keys: List[str]) -> Any:
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _paged(results: List[Any], page_size: Optional[int], continuation_token: Optional[str] = None) -> ItemPaged:
+    """Pages a result list like the SDK, with the offset of the next page as continuation token."""
+    page_size = page_size or 100
+
+    def get_next(token: Optional[str]) -> int:
+        return int(token or 0)
+
+    def extract_data(offset: int):
+        next_offset = offset + page_size
+        return (str(next_offset) if next_offset < len(results) else None), iter(results[offset:next_offset])
+
+    return ItemPaged(get_next, extract_data)
+
+
+class FakeCosmosContainer:
+    """
+    An in-process stand-in for a Cosmos DB `ContainerProxy`, used to test `CosmosDBManager`
+    without a Cosmos DB account.
+
+    Items are kept in memory per (partition key, id) and get an `_etag` and `_ts` on every write
+    like in Cosmos DB. Queries support `SELECT * FROM c`, the id lookup of `read_many` and
+    the projection queries built by `build_projection_queries`; the items are split into
+    `feed_range_count` feed ranges by partition key. Throttling can be simulated by setting `throttle_next` to the number of
+    following requests that should fail with status 429.
+    """
+
+    def __init__(self, partition_key_path: str = "/id", retry_after_ms: int = 10, feed_range_count: int = 4):
+        self.partition_key_path = partition_key_path
+        self.feed_range_count = feed_range_count
+        self.retry_after_ms = retry_after_ms
+        self.throttle_next = 0
+        self.request_count = 0
+        self._items: Dict[tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _partition_key_of(self, body: Dict[str, Any]) -> Any:
+        value = body
+        for key in self.partition_key_path.strip("/").split("/"):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    def _key(self, item_id: str, partition_key: Any) -> tuple:
+        return (tuple(partition_key) if isinstance(partition_key, list) else partition_key, item_id)
+
+    def _count_request(self):
+        """Counts a request and raises a 429 error if throttling is requested."""
+        with self._lock:
+            self.request_count += 1
+            if self.throttle_next > 0:
+                self.throttle_next -= 1
+                error = exceptions.CosmosHttpResponseError(status_code=429, message="Request rate is large.")
+                error.headers = {"x-ms-retry-after-ms": str(self.retry_after_ms)}
+                raise error
+
+    def _store(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        stored = copy.deepcopy(body)
+        stored["_etag"] = f'"{uuid.uuid4()}"'
+        stored["_ts"] = int(time.time())
+        self._items[self._key(stored["id"], self._partition_key_of(stored))] = stored
+        return copy.deepcopy(stored)
+
+    def read_item(self, item: str, partition_key: Any, initial_headers: Optional[Dict[str, str]] = None, **kwargs) -> Dict[str, Any]:
+        self._count_request()
+        with self._lock:
+            stored = self._items.get(self._key(item, partition_key))
+            if stored is None:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"Item '{item}' not found.")
+            if initial_headers and initial_headers.get("If-None-Match") == stored["_etag"]:
+                # like the SDK, a 304 Not Modified is returned as an empty item
+                return {}
+            return copy.deepcopy(stored)
+
+    def create_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self._count_request()
+        with self._lock:
+            if self._key(body["id"], self._partition_key_of(body)) in self._items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message=f"Item '{body['id']}' already exists.")
+            return self._store(body)
+
+    def upsert_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self._count_request()
+        with self._lock:
+            return self._store(body)
+
+    def replace_item(self, item: str, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self._count_request()
+        with self._lock:
+            if self._key(item, self._partition_key_of(body)) not in self._items:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"Item '{item}' not found.")
+            return self._store(body)
+
+    def read_all_items(self, **kwargs) -> List[Dict[str, Any]]:
+        self._count_request()
+        with self._lock:
+            return [copy.deepcopy(item) for item in self._items.values()]
+
+    def execute_item_batch(self, batch_operations: List[tuple], partition_key: Any, **kwargs) -> List[Dict[str, Any]]:
+        """Executes upsert, create and replace operations atomically like a transactional batch."""
+        self._count_request()
+        with self._lock:
+            snapshot = dict(self._items)
+            results = []
+            for index, (operation, args, *_) in enumerate(batch_operations):
+                body = args[-1]
+                status_code = 200
+                if self._partition_key_of(body) != partition_key:
+                    status_code = 400
+                elif operation == "create" and self._key(body["id"], partition_key) in self._items:
+                    status_code = 409
+                elif operation == "replace" and self._key(body["id"], partition_key) not in self._items:
+                    status_code = 404
+                elif operation in ("create", "upsert") and self._key(body["id"], partition_key) not in self._items:
+                    status_code = 201
+
+                if status_code >= 400:
+                    self._items = snapshot
+                    responses = [{"statusCode": 424}] * len(batch_operations)
+                    responses[index] = {"statusCode": status_code}
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index,
+                        headers={},
+                        status_code=status_code,
+                        message=f"Operation {index} of the batch failed with status {status_code}.",
+                        operation_responses=responses,
+                    )
+                results.append({"statusCode": status_code, "resourceBody": self._store(body)})
+            return results
+
+    def query_items(self, query: str, parameters: Optional[List[Dict[str, Any]]] = None, partition_key: Any = None, max_item_count: Optional[int] = None, **kwargs) -> ItemPaged:
+        self._count_request()
+        parameters = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        with self._lock:
+            items = [
+                copy.deepcopy(item)
+                for key, item in self._items.items()
+                if partition_key is None or key[0] == self._key(item["id"], partition_key)[0]
+            ]
+        if query.strip() == "SELECT * FROM c":
+            return _paged(items, max_item_count)
+        if query.strip() == "SELECT * FROM c WHERE ARRAY_CONTAINS(@ids, c.id)":
+            return _paged([item for item in items if item["id"] in parameters["@ids"]], max_item_count)
+
+        match = _PROJECTION_QUERY.match(query.strip())
+        if not match:
+            raise NotImplementedError(f"Query not supported by the fake container: {query}")
+        _, select_path, _, join_path, _, _ = match.groups()
+        results = []
+        for item in (item for item in items if item["id"] == parameters.get("@id")):
+            if join_path is None:
+                values = [_resolve(item, _keys_of(select_path))]
+            else:
+                array = _resolve(item, _keys_of(join_path))
+                values = [_resolve(element, _keys_of(select_path)) for element in array] if isinstance(array, list) else []
+            results.extend(value for value in values if value is not _MISSING)
+        return _paged(results, max_item_count)
+
+    def read_feed_ranges(self, **kwargs) -> List[Dict[str, Any]]:
+        return [{"fakeFeedRange": index} for index in range(self.feed_range_count)]
+
+    def _in_feed_range(self, partition_key: Any, feed_range: Dict[str, Any]) -> bool:
+        return sum(json.dumps(partition_key).encode("utf-8")) % self.feed_range_count == feed_range["fakeFeedRange"]
+
+    def query_items_change_feed(
+        self, feed_range: Optional[Dict[str, Any]] = None, continuation: Optional[str] = None, max_item_count: Optional[int] = None, **kwargs
+    ) -> ItemPaged:
+        """Returns the items of a feed range; a continuation token is "<feed range>:<offset>"."""
+        self._count_request()
+        offset = 0
+        if continuation:
+            feed_range_index, offset = map(int, continuation.split(":"))
+            feed_range = {"fakeFeedRange": feed_range_index}
+        with self._lock:
+            items = sorted(
+                (copy.deepcopy(item) for key, item in self._items.items() if self._in_feed_range(key[0], feed_range)),
+                key=lambda item: (item["_ts"], item["id"]),
+            )
+        page_size = max_item_count or 100
+
+        def get_next(token: Optional[str]) -> int:
+            return int(token.split(":")[1]) if token else offset
+
+        def extract_data(start: int):
+            end = start + page_size
+            return (f"{feed_range['fakeFeedRange']}:{end}" if end < len(items) else None), iter(items[start:end])
+
+        return ItemPaged(get_next, extract_data)
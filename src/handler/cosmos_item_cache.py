@@ -0,0 +1,120 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from azure.cosmos import ContainerProxy
+
+log = logging.getLogger("cosmosdb")
+
+
+class CosmosItemCache:
+    """
+    A read-through cache of Cosmos DB items that revalidates with the `_etag` of the items.
+
+    Items are kept in memory in least-recently-used order and, if a cache directory is given,
+    as one JSON file per item on disk so they survive between runs. An item younger than the
+    TTL is served without a request. An older item is revalidated with a conditional read
+    (If-None-Match with its `_etag`); Cosmos DB answers an unchanged item with 304 and an
+    empty body, which costs far fewer RUs than reading the item again.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, ttl_seconds: float = 300, max_entries: int = 1000):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _key(item_id: str, partition_key: Any) -> str:
+        return json.dumps([item_id, partition_key])
+
+    def _path(self, key: str) -> Optional[Path]:
+        return self.cache_dir / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json" if self.cache_dir else None
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the entry of an item from memory or from disk."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        path = self._path(key)
+        if path is None or not path.exists():
+            return None
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        self._remember(key, entry, persist=False)
+        return entry
+
+    def _remember(self, key: str, entry: Dict[str, Any], persist: bool = True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+        if self.cache_dir:
+            if persist:
+                path = self._path(key)
+                # one temporary file per thread, concurrent writes of the same key must not interleave
+                tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+                tmp_path.write_text(json.dumps(entry), encoding="utf-8")
+                os.replace(tmp_path, path)
+            for evicted_key in evicted:
+                self._path(evicted_key).unlink(missing_ok=True)
+
+    def put(self, item: Dict[str, Any], partition_key: Any):
+        """Stores an item that was just read or written."""
+        self._remember(self._key(item["id"], partition_key), {"item": item, "etag": item.get("_etag"), "validated_at": time.time()})
+
+    def invalidate(self, item_id: str, partition_key: Any):
+        """Removes an item, e.g. after a write whose result is not known."""
+        key = self._key(item_id, partition_key)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.cache_dir:
+            self._path(key).unlink(missing_ok=True)
+
+    def read_item(self, container: ContainerProxy, item_id: str, partition_key: Any) -> Dict[str, Any]:
+        """
+        Returns an item from the cache, revalidating it after the TTL, or reads it from the container.
+
+        Raises the errors of `container.read_item`, e.g. CosmosResourceNotFoundError for a deleted item.
+        """
+        key = self._key(item_id, partition_key)
+        entry = self._load(key)
+        if entry is not None and time.time() - entry["validated_at"] < self.ttl_seconds:
+            self.hits += 1
+            return copy.deepcopy(entry["item"])
+
+        if entry is not None and entry.get("etag"):
+            try:
+                response = container.read_item(item=item_id, partition_key=partition_key, initial_headers={"If-None-Match": entry["etag"]})
+            except Exception:
+                self.invalidate(item_id, partition_key)
+                raise
+            if not response:
+                # 304 Not Modified comes back without a body
+                self.revalidations += 1
+                self._remember(key, {**entry, "validated_at": time.time()})
+                return copy.deepcopy(entry["item"])
+        else:
+            response = container.read_item(item=item_id, partition_key=partition_key)
+        self.misses += 1
+        self.put(copy.deepcopy(response), partition_key)
+        return response
@@ -0,0 +1,142 @@
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+import pymupdf
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
+from azure.core.exceptions import HttpResponseError
+
+from util_functions import PYMUPDF_LOCK
+
+
+def _page_numbers(pages: Optional[str], page_count: int) -> List[int]:
+    """Parses a page selection like "1-3,5" into page numbers, all pages if it is not set."""
+    if not pages:
+        return list(range(1, page_count + 1))
+    page_numbers = []
+    for part in pages.split(","):
+        first, _, last = part.partition("-")
+        page_numbers.extend(range(int(first), min(int(last or first), page_count) + 1))
+    return page_numbers
+
+
+def _analyze_pdf(data: bytes, model_id: str, pages_selection: Optional[str] = None) -> AnalyzeResult:
+    """Builds an AnalyzeResult with the pages, lines and tables PyMuPDF finds in the selected pages of a PDF."""
+    content = ""
+    pages: List[Dict[str, Any]] = []
+    tables: List[Dict[str, Any]] = []
+    with pymupdf.open(stream=data, filetype="pdf") as document:
+        for page_number in _page_numbers(pages_selection, document.page_count):
+            page = document[page_number - 1]
+            lines = [line for line in page.get_text().splitlines() if line.strip()]
+            page_text = "\n".join(lines) + "\n"
+            pages.append(
+                {
+                    "pageNumber": page_number,
+                    "width": page.rect.width,
+                    "height": page.rect.height,
+                    "unit": "pixel",
+                    "spans": [{"offset": len(content), "length": len(page_text)}],
+                    "lines": [{"content": line} for line in lines],
+                }
+            )
+            content += page_text
+            for found in page.find_tables().tables:
+                rows = found.extract()
+                tables.append(
+                    {
+                        "rowCount": len(rows),
+                        "columnCount": found.col_count,
+                        "cells": [
+                            {"rowIndex": row_index, "columnIndex": column_index, "content": cell or ""}
+                            for row_index, row in enumerate(rows)
+                            for column_index, cell in enumerate(row)
+                        ],
+                        "boundingRegions": [{"pageNumber": page_number, "polygon": []}],
+                    }
+                )
+    return AnalyzeResult({"apiVersion": "fake", "modelId": model_id, "content": content, "pages": pages, "tables": tables})
+
+
+class _FakePoller:
+    """Polls like an LROPoller: the result is seen at the first poll after the analysis finished."""
+
+    def __init__(self, client: "FakeDocumentIntelligenceClient", result: AnalyzeResult, service_seconds: float, polling_interval: float):
+        self.client = client
+        self._result = result
+        self._started_at = time.monotonic()
+        self._service_seconds = service_seconds
+        self._polling_interval = polling_interval
+        self._finished = False
+        self.polls = 0
+
+    def done(self) -> bool:
+        return time.monotonic() - self._started_at >= self._service_seconds
+
+    def result(self, timeout: Optional[float] = None) -> AnalyzeResult:
+        try:
+            while not self.done():
+                time.sleep(self._polling_interval)
+                self.polls += 1
+        finally:
+            if not self._finished:
+                self._finished = True
+                self.client._finish()
+        return self._result
+
+
+class FakeDocumentIntelligenceClient:
+    """
+    An in-process stand-in for a `DocumentIntelligenceClient`, used to run and test the pipeline
+    without a Document Intelligence resource.
+
+    PDFs are analyzed with PyMuPDF (page text, lines and the tables found by `find_tables`).
+    The service is simulated with a processing time of `seconds_per_page` per page and a tier
+    limit of `max_concurrent` analyses: further submissions fail with status 429 like a
+    throttled resource. `polls` counts the result polls of all analyses.
+    """
+
+    def __init__(self, seconds_per_page: float = 0.05, max_concurrent: int = 4):
+        self.seconds_per_page = seconds_per_page
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.submissions = 0
+        self.rejections = 0
+        self._pollers: List[_FakePoller] = []
+        self._lock = threading.Lock()
+
+    def _finish(self):
+        with self._lock:
+            self.running -= 1
+
+    @property
+    def polls(self) -> int:
+        return sum(poller.polls for poller in self._pollers)
+
+    def begin_analyze_document(
+        self, model_id: str, body: AnalyzeDocumentRequest, polling_interval: float = 30, pages: Optional[str] = None, **kwargs
+    ) -> _FakePoller:
+        with self._lock:
+            self.submissions += 1
+            if self.running >= self.max_concurrent:
+                self.rejections += 1
+                error = HttpResponseError(message="Requests to the Analyze Document operation have exceeded the rate limit of your current tier.")
+                error.status_code = 429
+                raise error
+            self.running += 1
+        try:
+            if body.url_source:
+                with urllib.request.urlopen(body.url_source) as response:
+                    data = response.read()
+            else:
+                data = body.bytes_source
+            with PYMUPDF_LOCK:
+                result = _analyze_pdf(data, model_id, pages)
+        except Exception:
+            self._finish()
+            raise
+        poller = _FakePoller(self, result, self.seconds_per_page * len(result.pages), polling_interval)
+        with self._lock:
+            self._pollers.append(poller)
+        return poller
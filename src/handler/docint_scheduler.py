@@ -0,0 +1,214 @@
+import functools
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.policies import RetryPolicy
+
+from cassettes import CassetteDocumentIntelligenceClient, get_cassette_store
+
+
+class _ThrottleObservingRetryPolicy(RetryPolicy):
+    """The retry policy of the SDK, reporting every 429 response it retries to the scheduler."""
+
+    def __init__(self, on_throttled, **kwargs):
+        super().__init__(**kwargs)
+        self.on_throttled = on_throttled
+
+    def increment(self, settings, response=None, error=None):
+        if response is not None and response.http_response.status_code == 429:
+            self.on_throttled()
+        return super().increment(settings, response=response, error=error)
+
+
+def _retry_after(error: HttpResponseError) -> Optional[float]:
+    headers = error.response.headers if error.response is not None else {}
+    for header, factor in (("Retry-After", 1.0), ("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) * factor
+            except ValueError:
+                return None
+    return None
+
+
+class DocumentIntelligenceScheduler:
+    """
+    Submits the analyses of all documents through one Document Intelligence client with a shared limit.
+
+    At most `limit` analyses are in flight (submitted and not finished); further documents wait
+    in a queue. The limit adapts to the tier of the resource like a congestion window: every
+    accepted submission raises it by 1/limit up to `max_concurrency`, a 429 response (retried
+    by the SDK or raised from the submission) halves it down to `min_concurrency`, at most once
+    per `decrease_cooldown_seconds`. The result of an analysis is polled every
+    `polling_interval(page_count)` seconds, short for small documents and longer for large
+    ones, unless the service sends a Retry-After header, which takes precedence in azure-core.
+
+    `metrics()` reports the queue depth, the analyses in flight, the current limit, the number
+    of throttled responses and the mean time documents waited for a slot versus the mean time
+    Document Intelligence needed to process them.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        initial_concurrency: Optional[int] = None,
+        polling_min_seconds: float = 1.0,
+        polling_seconds_per_page: float = 0.25,
+        polling_max_seconds: float = 10.0,
+        max_submit_attempts: int = 6,
+        throttle_backoff_seconds: float = 2.0,
+        decrease_cooldown_seconds: float = 2.0,
+    ):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.polling_min_seconds = polling_min_seconds
+        self.polling_seconds_per_page = polling_seconds_per_page
+        self.polling_max_seconds = polling_max_seconds
+        self.max_submit_attempts = max_submit_attempts
+        self.throttle_backoff_seconds = throttle_backoff_seconds
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.queued = 0
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.service_seconds = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def polling_interval(self, page_count: Optional[int]) -> float:
+        """Returns the polling interval for a document of `page_count` pages."""
+        if not page_count:
+            return self.polling_min_seconds
+        return min(max(self.polling_min_seconds, self.polling_seconds_per_page * page_count), self.polling_max_seconds)
+
+    def on_throttled(self):
+        """Halves the limit after a 429 response, once per cooldown so that a burst of 429s counts once."""
+        with self._condition:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.decrease_cooldown_seconds:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self._last_decrease = now
+
+    def _on_accepted(self):
+        with self._condition:
+            self.submitted += 1
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _submit(self, model_id: str, body: AnalyzeDocumentRequest, page_count: Optional[int], pages: Optional[str]):
+        # the page selection is only passed if set, so clients without it keep working
+        kwargs = {"pages": pages} if pages else {}
+        for attempt in range(self.max_submit_attempts):
+            try:
+                return self.client.begin_analyze_document(model_id, body, polling_interval=self.polling_interval(page_count), **kwargs)
+            except HttpResponseError as e:
+                if e.status_code != 429 or attempt == self.max_submit_attempts - 1:
+                    raise
+                self.on_throttled()
+                time.sleep(_retry_after(e) or self.throttle_backoff_seconds * 2**attempt)
+
+    def analyze(self, model_id: str, body: AnalyzeDocumentRequest, page_count: Optional[int] = None, pages: Optional[str] = None) -> AnalyzeResult:
+        """
+        Analyzes a document once a slot is free and waits for its result.
+
+        Args:
+            model_id: The Document Intelligence model, e.g. "prebuilt-layout".
+            body: The analyze request with the URL or the bytes of the document.
+            page_count: The number of pages to analyze, if known, for the polling interval.
+            pages: (Optional) The 1-based pages to analyze, e.g. "1-20", instead of the whole document.
+
+        Returns:
+            AnalyzeResult: The result of the analysis. Errors are raised.
+        """
+        queued_at = time.monotonic()
+        with self._condition:
+            self.queued += 1
+            self._condition.wait_for(lambda: self.in_flight < max(int(self.limit), self.min_concurrency))
+            self.queued -= 1
+            self.in_flight += 1
+            started_at = time.monotonic()
+            self.wait_seconds += started_at - queued_at
+
+        try:
+            poller = self._submit(model_id, body, page_count, pages)
+            self._on_accepted()
+            result = poller.result()
+            with self._condition:
+                self.completed += 1
+            return result
+        except Exception:
+            with self._condition:
+                self.failed += 1
+            raise
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self.service_seconds += time.monotonic() - started_at
+                self._condition.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns the current state and the accumulated timings of the scheduler."""
+        with self._condition:
+            finished = self.completed + self.failed
+            return {
+                "queue_depth": self.queued,
+                "in_flight": self.in_flight,
+                "limit": round(self.limit, 2),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "throttled": self.throttled,
+                "mean_wait_seconds": round(self.wait_seconds / finished, 3) if finished else 0.0,
+                "mean_service_seconds": round(self.service_seconds / finished, 3) if finished else 0.0,
+            }
+
+
+@functools.lru_cache(maxsize=None)
+def get_docint_scheduler() -> DocumentIntelligenceScheduler:
+    """
+    Returns the Document Intelligence scheduler shared by the pipeline, created on first use.
+
+    Configured by the environment:
+    - ENDPOINT_DOCINT, API_KEY_DOCINT: The Document Intelligence resource.
+    - DOCINT_MAX_CONCURRENCY: (Optional) Maximum number of analyses in flight, defaults to 8.
+    - DOCINT_CLIENT: (Optional) "azure" (default) or "fake" for the local stand-in client of
+      `handler.docint_fake_client`, which analyzes PDFs with PyMuPDF.
+    - CASSETTE_MODE: (Optional) Records the analyses or replays them without a client, see `cassettes`.
+    """
+    max_concurrency = int(os.getenv("DOCINT_MAX_CONCURRENCY", "8"))
+    scheduler = DocumentIntelligenceScheduler(None, max_concurrency=max_concurrency)
+    cassette_store = get_cassette_store()
+    if cassette_store is not None and cassette_store.mode == "replay":
+        # replayed analyses need no client, and the polling interval does not delay them
+        scheduler.client = CassetteDocumentIntelligenceClient(None, cassette_store)
+        scheduler.polling_min_seconds = scheduler.polling_max_seconds = 0.0
+        return scheduler
+
+    if os.getenv("DOCINT_CLIENT", "azure") == "fake":
+        from handler.docint_fake_client import FakeDocumentIntelligenceClient
+
+        scheduler.client = FakeDocumentIntelligenceClient()
+    else:
+        scheduler.client = DocumentIntelligenceClient(
+            endpoint=os.getenv("ENDPOINT_DOCINT"),
+            credential=AzureKeyCredential(os.getenv("API_KEY_DOCINT")),
+            retry_policy=_ThrottleObservingRetryPolicy(scheduler.on_throttled),
+        )
+    if cassette_store is not None:
+        scheduler.client = CassetteDocumentIntelligenceClient(scheduler.client, cassette_store)
+    return scheduler
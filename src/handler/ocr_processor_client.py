@@ -1,7 +1,11 @@
 import os
+import queue
+from typing import Iterable, Iterator, List, Optional, Union
+
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
+from pydantic import BaseModel
 
 
 class DocumentIntelligenceAuth:
@@ -13,11 +17,57 @@ class DocumentIntelligenceAuth:
         return DocumentIntelligenceClient(endpoint=self.endpoint, credential=AzureKeyCredential(self.key))
 
 
+class OCRPage(BaseModel):
+    """The text lines of one page."""
+
+    page_number: int
+    lines: List[str]
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+
+class OCRResult(BaseModel):
+    """The OCR result of one document of a batch; `index` is its position in the batch."""
+
+    index: int
+    pages: List[OCRPage] = []
+    error: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        """The text of all pages, one line per text line like `extract_text_from_url`."""
+        return "".join(line + "\n" for page in self.pages for line in page.lines)
+
+
+def _analyze_request(source: Union[str, bytes]) -> AnalyzeDocumentRequest:
+    if isinstance(source, str) and source.startswith(("http://", "https://")):
+        return AnalyzeDocumentRequest(url_source=source)
+    return AnalyzeDocumentRequest(bytes_source=source)
+
+
+def _pages_of(result: AnalyzeResult) -> List[OCRPage]:
+    return [OCRPage(page_number=page.page_number, lines=[line.content for line in page.lines or []]) for page in result.pages]
+
+
 class OCRProcessor:
     def __init__(self, client):
         """Initializes the OCRProcessor with a DocumentIntelligenceClient."""
         self.client = client
 
+    def extract_pages(self, source: Union[str, bytes], model_id: str = "prebuilt-read") -> List[OCRPage]:
+        """Analyzes one document and returns its text page by page.
+
+        Args:
+            source: The URL of the document (e.g., SAS URL) or the document or image data.
+
+        Returns:
+            The text lines per page. Errors are raised.
+        """
+        poller = self.client.begin_analyze_document(model_id, _analyze_request(source))
+        return _pages_of(poller.result())
+
     def extract_text_from_url(self, document_url):
         """Analyzes a document from a URL using the prebuilt-read model.
 
@@ -28,18 +78,8 @@ class OCRProcessor:
             The extracted text content as a string, or None if an error occurs.
         """
         try:
-            analyze_request = AnalyzeDocumentRequest(url_source=document_url)
-            poller = self.client.begin_analyze_document(
-                "prebuilt-read",
-                analyze_request,  # Pass AnalyzeDocumentRequest as body
-            )
-            result = poller.result()
-
-            extracted_text = ""
-            for page in result.pages:
-                for line in page.lines:
-                    extracted_text += line.content + "\n"
-            return extracted_text
+            pages = self.extract_pages(document_url)
+            return "".join(line + "\n" for page in pages for line in page.lines)
         except Exception as e:
             print(f"Error during OCR processing: {e}")
             return None
@@ -54,18 +94,59 @@ class OCRProcessor:
             The extracted text content as a string, or None if an error occurs.
         """
         try:
-            analyze_request = AnalyzeDocumentRequest(bytes_source=base64_image)
-            poller = self.client.begin_analyze_document(
-                "prebuilt-read",
-                analyze_request,  # Pass AnalyzeDocumentRequest as body
-            )
-            result = poller.result()
-
-            extracted_text = ""
-            for page in result.pages:
-                for line in page.lines:
-                    extracted_text += line.content + "\n"
-            return extracted_text
+            pages = self.extract_pages(base64_image)
+            return "".join(line + "\n" for page in pages for line in page.lines)
         except Exception as e:
             print(f"Error during OCR processing: {e}")
             return None
+
+    def analyze_batch(
+        self, sources: Iterable[Union[str, bytes]], model_id: str = "prebuilt-read", max_in_flight: int = 16
+    ) -> Iterator[OCRResult]:
+        """Analyzes many documents at once and yields their results as they finish.
+
+        Up to `max_in_flight` analyses are submitted at the same time. Every poller polls in its
+        own background thread and reports its completion to a queue, so a slow document does not
+        hold back the results of the others. Failed documents are yielded with an error.
+
+        Args:
+            sources: URLs (e.g., SAS URLs) or document data, see `extract_pages`.
+            model_id: The Document Intelligence model, "prebuilt-read" by default.
+            max_in_flight: Maximum number of submitted analyses that are not finished yet.
+
+        Yields:
+            OCRResult: The result of a document, in order of completion; `index` is its position in `sources`.
+        """
+        pending = enumerate(sources)
+        in_flight = {}
+        finished: queue.Queue = queue.Queue()
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                next_source = next(pending, None)
+                if next_source is None:
+                    exhausted = True
+                    break
+                index, source = next_source
+                try:
+                    poller = self.client.begin_analyze_document(model_id, _analyze_request(source))
+                except Exception as e:
+                    print(f"Error submitting document {index} for OCR processing: {e}")
+                    yield OCRResult(index=index, error=str(e))
+                    continue
+                in_flight[index] = poller
+                poller.add_done_callback(lambda _, index=index: finished.put(index))
+
+            if not in_flight:
+                return
+            index = finished.get()
+            # a callback can fire twice if the poller finishes while it is being registered
+            poller = in_flight.pop(index, None)
+            if poller is None:
+                continue
+            try:
+                yield OCRResult(index=index, pages=_pages_of(poller.result()))
+            except Exception as e:
+                print(f"Error during OCR processing of document {index}: {e}")
+                yield OCRResult(index=index, error=str(e))
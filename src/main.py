@@ -3,7 +3,13 @@ from agents.extract_table_agent import construct_extract_table_agent
 from agents.table_norming_agent import construct_table_norming
 from agents.extract_table_data_agent import construct_extract_table_data
 from model import BaseState
+from document_sources import document_source_from_env
+from prompt_registry import prompt_cache_report
+from handler.docint_scheduler import get_docint_scheduler
+from cassettes import cassette_report
+from page_images import get_page_image_cache
 import os
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from openinference.instrumentation.langchain import LangChainInstrumentor
 from phoenix.otel import register
@@ -61,16 +67,52 @@ def main_local_files():
             _ = graph.invoke(state)
 
 
+def _document_concurrency() -> int:
+    # documents processed at the same time; their analyses share the limit of the Document Intelligence scheduler
+    concurrency = int(os.getenv("DOCUMENT_CONCURRENCY", "4"))
+    # the debug snapshots data/step1.pkl and data/step2.pkl hold a single document, they are
+    # loaded with SKIP_STEP_<N>=True and written with SKIP_STEP_<N>=False
+    snapshot_flags = [flag for flag in ("SKIP_STEP_1", "SKIP_STEP_2") if os.getenv(flag) in ("True", "False")]
+    if concurrency > 1 and snapshot_flags:
+        print(f"Processing one document at a time instead of {concurrency}, since the step snapshots are used ({', '.join(snapshot_flags)}).")
+        return 1
+    return concurrency
+
+
+def main_document_source():
+    """Processes the documents of the source configured by DOCUMENT_SOURCE, DOCUMENT_CONCURRENCY at a time, prefetching the next ones."""
+    graph = _construct_graph()
+
+    def process(document):
+        print(document.name)
+        state = BaseState(doc_path=document.local_path, blob_name=document.blob_name)
+        _ = graph.invoke(state)
+
+    document_source_from_env().process(process, concurrency=_document_concurrency())
+    print(f"Prompt cache usage per task: {prompt_cache_report()}")
+    print(f"Document Intelligence scheduler: {get_docint_scheduler().metrics()}")
+    print(f"Cassettes: {cassette_report()}")
+    print(f"Page image cache: {get_page_image_cache().metrics()}")
+
+
 def main():
     pdfs = [  # "data/56388722_us2015274579.pdf"
         # "data/78071_DE1771318A1.pdf"
         "data/80946226_cn111646693.pdf"
     ]
     graph = _construct_graph()
-    for pdf in pdfs:
-        state = BaseState(doc_path=pdf)
-        _ = graph.invoke(state)
+    with ThreadPoolExecutor(max_workers=_document_concurrency()) as executor:
+        for _ in executor.map(lambda pdf: graph.invoke(BaseState(doc_path=pdf)), pdfs):
+            pass
+    print(f"Prompt cache usage per task: {prompt_cache_report()}")
+    print(f"Document Intelligence scheduler: {get_docint_scheduler().metrics()}")
+    print(f"Cassettes: {cassette_report()}")
+    print(f"Page image cache: {get_page_image_cache().metrics()}")
 
 
 if __name__ == "__main__":
-    main()
+    # with DOCUMENT_SOURCE the documents come from the configured source, otherwise from the list in main()
+    if os.getenv("DOCUMENT_SOURCE"):
+        main_document_source()
+    else:
+        main()
@@ -11,7 +11,9 @@ class MainInfo(BaseModel):
 
 class BaseState(BaseModel):
     doc_path: str = ""
+    blob_name: str | None = None  # set for documents from blob storage, which are analyzed by SAS URL
     error: str = ""
+    page_count: int = 0  # set when the document is split into page images
     pdf_page_images: list[str] = []
     pages: list[Dict[str, Any]] = []
     tables: list[Dict[str, Any]] = []
@@ -35,6 +37,7 @@ class ExtractTableDataState(BaseState):
     #images: List[str] = [] # pages
     #table_data_result: dict = {} # --> subfield of tables ("extracted_data"), type: TableDataResult
     feedback: str|None = None
+    flagged_cells: list[Dict[str, Any]] = [] # cells ({"row", "column"}) and rows ({"row"}) flagged by the verification
     retry_counter: int = 1
     curr_table_idx: int = None
     #confidence: str = ""
@@ -0,0 +1,86 @@
+import functools
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from util_functions import pdf_pages_to_base64_images
+
+
+class PageImageCache:
+    """
+    Renders page images on demand and keeps the most recently used ones up to a byte budget.
+
+    Used for the pages of documents that are processed in windows: their images are not kept
+    in the state, but rendered when a prompt needs them. The cache is shared by all documents,
+    so `max_bytes` bounds the memory of page images regardless of the size or number of
+    documents. Rendering happens outside the lock, a page that is requested concurrently may
+    be rendered twice.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.renders = 0
+        self.evictions = 0
+        self._images: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_path: str, page_number: int) -> str:
+        """Returns the base64 data URL of a page (1-based), rendering it if it is not cached."""
+        key = (doc_path, page_number)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return image
+
+        image = pdf_pages_to_base64_images(doc_path, page_number, page_number)[0]
+        with self._lock:
+            self.renders += 1
+            if key not in self._images and len(image) <= self.max_bytes:
+                self._images[key] = image
+                self.bytes += len(image)
+                while self.bytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self.bytes -= len(evicted)
+                    self.evictions += 1
+        return image
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"pages": len(self._images), "bytes": self.bytes, "hits": self.hits, "renders": self.renders, "evictions": self.evictions}
+
+
+@functools.lru_cache(maxsize=None)
+def get_page_image_cache() -> PageImageCache:
+    """Returns the page image cache with the budget of PAGE_IMAGE_CACHE_MAX_MB (default 64 MB)."""
+    return PageImageCache(int(float(os.getenv("PAGE_IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024))
+
+
+def page_window_size(page_count: int) -> Optional[int]:
+    """
+    Returns the number of pages per window for a document of `page_count` pages, or None if
+    the document is processed as a whole.
+
+    Documents with more pages than PAGE_WINDOW_SIZE are processed in windows of that many
+    pages; a PAGE_WINDOW_SIZE of 0 (default) processes every document as a whole.
+    """
+    window_size = int(os.getenv("PAGE_WINDOW_SIZE", "0"))
+    if window_size <= 0 or page_count <= window_size:
+        return None
+    return window_size
+
+
+def page_windows(page_count: int, window_size: int) -> List[Tuple[int, int]]:
+    """Splits the pages 1..page_count into windows of (first_page, last_page), both inclusive."""
+    return [(first_page, min(first_page + window_size - 1, page_count)) for first_page in range(1, page_count + 1, window_size)]
+
+
+def page_image(page: Dict[str, Any]) -> str:
+    """Returns the image of a page: the image kept in the state, or for pages of a windowed document the rendered one."""
+    if page.get("base64"):
+        return page["base64"]
+    return get_page_image_cache().get(page["doc_path"], page["number"])
@@ -0,0 +1,275 @@
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Type
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.outputs import ChatGeneration
+from langchain_core.prompts import SystemMessagePromptTemplate
+from pydantic import BaseModel
+
+from cassettes import CassetteChatModel, get_cassette_store
+from utils import llm, phi4
+
+# the models a task can be routed to with LLM_ROUTE_<TASK>, e.g. LLM_ROUTE_DETECT_RELEVANT_TABLE=phi4
+MODEL_NAMES = ("main", "phi4")
+# models that accept page images; the others only get the text parts of a call
+IMAGE_MODELS = {"main"}
+# AzureChatOpenAI only reports the token usage of a stream if it is asked for in the request,
+# the Azure AI inference client of phi4 rejects these options
+STREAM_OPTIONS = {"main": {"stream_options": {"include_usage": True}}, "phi4": {}}
+
+# Rough token estimates, e.g. for packing several tables into one request or for streams that
+# are closed before the usage is reported.
+# A page image (892x1263, high detail) is billed as 6 tiles of 170 tokens plus 85 base tokens.
+PAGE_IMAGE_TOKENS = 1105
+CHARS_PER_TOKEN = 4
+
+
+def text_part(text: str) -> Dict[str, Any]:
+    """Content part with text for the variable part of a prompt."""
+    return {"type": "text", "text": text}
+
+
+def image_part(image_base64: str) -> Dict[str, Any]:
+    """Content part with a base64 data URL image for the variable part of a prompt."""
+    return {"type": "image_url", "image_url": {"url": image_base64}}
+
+
+def estimate_input_tokens(messages: List[BaseMessage]) -> int:
+    """Estimates the input tokens of a call from the length of its texts and the number of its images."""
+    tokens = 0
+    for message in messages:
+        parts = message.content if isinstance(message.content, list) else [message.content]
+        for part in parts:
+            if isinstance(part, str):
+                tokens += len(part) // CHARS_PER_TOKEN
+            elif part.get("type") == "image_url":
+                tokens += PAGE_IMAGE_TOKENS
+            else:
+                tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+    return tokens
+
+
+class PromptCacheStats:
+    """Accumulates input tokens and cached input tokens reported for the calls of one task.
+
+    Streams that are closed early never receive the usage, which the service sends last. They
+    are counted as `truncated_calls` with estimated input tokens, kept apart from the reported
+    ones so that the cached-token ratio is not distorted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.truncated_calls = 0
+        self.estimated_input_tokens = 0
+
+    def record(self, usage_metadata: Optional[Dict[str, Any]]):
+        if not usage_metadata:
+            return
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += usage_metadata.get("input_tokens", 0)
+            self.cached_tokens += (usage_metadata.get("input_token_details") or {}).get("cache_read", 0) or 0
+
+    def record_truncated(self, estimated_input_tokens: int):
+        with self._lock:
+            self.calls += 1
+            self.truncated_calls += 1
+            self.estimated_input_tokens += estimated_input_tokens
+
+    @property
+    def cached_token_ratio(self) -> float:
+        return self.cached_tokens / self.input_tokens if self.input_tokens else 0.0
+
+
+def _model(name: str):
+    model = {"main": llm, "phi4": phi4}[name]
+    store = get_cassette_store()
+    return model if store is None else CassetteChatModel(model, name, store)
+
+
+def _min_confidence(value: Any) -> Optional[float]:
+    """Returns the lowest `confidence` reported anywhere in a parsed answer, e.g. per table of a packed answer."""
+    if isinstance(value, list):
+        confidences = [_min_confidence(element) for element in value]
+    elif isinstance(value, dict):
+        confidences = [_min_confidence(element) for key, element in value.items() if key != "confidence"]
+        if isinstance(value.get("confidence"), (int, float)):
+            confidences.append(float(value["confidence"]))
+    else:
+        return None
+    confidences = [confidence for confidence in confidences if confidence is not None]
+    return min(confidences) if confidences else None
+
+
+class PrecompiledPrompt:
+    """A prompt for one task whose static prefix is rendered once.
+
+    The system prompt including the format instructions and the optional static user prompt
+    are rendered when the prompt is registered. The variable content of a call (texts and
+    page images) is always appended after this prefix, so the prefix is byte-identical across
+    calls and can be served from the prompt cache of Azure OpenAI.
+
+    The task is sent to the model named by LLM_ROUTE_<TASK> ("main" by default). An answer of
+    another model that cannot be parsed, does not match the result model or reports a
+    `confidence` below LLM_ESCALATION_MIN_CONFIDENCE is escalated to the main model, for
+    streamed calls once the stream is complete. Models without image input get only the text
+    parts of a call; calls without text always use the main model, with a warning for the
+    first of them.
+    """
+
+    def __init__(self, task: str, system_prompt: str, pydantic_object: Type[BaseModel], user_prompt: Optional[str] = None):
+        self.task = task
+        self.pydantic_object = pydantic_object
+        self.parser = JsonOutputParser(pydantic_object=pydantic_object)
+        self.route = os.getenv(f"LLM_ROUTE_{task.upper()}", "main")
+        if self.route not in MODEL_NAMES:
+            raise ValueError(f"Unknown model '{self.route}' for task '{task}', expected one of {MODEL_NAMES}.")
+        self.min_confidence = float(os.getenv("LLM_ESCALATION_MIN_CONFIDENCE", "0.7"))
+        self.routed_calls = 0
+        self.escalations = 0
+        self.image_only_calls = 0
+        self._lock = threading.Lock()
+        self.prefix: List[BaseMessage] = [
+            SystemMessagePromptTemplate.from_template(system_prompt).format(format_instructions=self.parser.get_format_instructions())
+        ]
+        if user_prompt:
+            self.prefix.append(HumanMessage(content=user_prompt))
+        self.cache_stats = PromptCacheStats()
+
+    def messages(self, content: List[Dict[str, Any]]) -> List[BaseMessage]:
+        """Builds the messages of a call from the static prefix and the variable content parts."""
+        return self.prefix + [HumanMessage(content=content)]
+
+    def routed_content(self, content: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        """Returns the content for the routed model, or None if the call has to use the main model."""
+        if self.route == "main":
+            return None
+        if self.route in IMAGE_MODELS:
+            return content
+        text_content = [part for part in content if part.get("type") == "text"]
+        if not text_content:
+            with self._lock:
+                self.image_only_calls += 1
+                first = self.image_only_calls == 1
+            if first:
+                print(f"Warning: task '{self.task}' is routed to '{self.route}', which has no image input, but its call has no text; using the main model.")
+            return None
+        return text_content
+
+    def _invoke_model(self, model, content: List[Dict[str, Any]]) -> Dict[str, Any]:
+        response = model.invoke(self.messages(content))
+        self.cache_stats.record(response.usage_metadata)
+        return self.parser.invoke(response)
+
+    def _escalation_reason(self, result: Dict[str, Any]) -> Optional[str]:
+        """Returns why an answer of the routed model has to be escalated, or None if it is kept."""
+        self.pydantic_object.model_validate(result)
+        confidence = _min_confidence(result)
+        if confidence is None or confidence >= self.min_confidence:
+            return None
+        return f"confidence {confidence} is below {self.min_confidence}"
+
+    def _escalate(self, content: List[Dict[str, Any]], reason: str) -> Dict[str, Any]:
+        print(f"Escalating task '{self.task}' from '{self.route}' to the main model: {reason}")
+        with self._lock:
+            self.escalations += 1
+        return self._invoke_model(_model("main"), content)
+
+    def invoke(self, content: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Sends the prompt with the given variable content to the LLM and parses the JSON answer."""
+        routed_content = self.routed_content(content)
+        if routed_content is None:
+            return self._invoke_model(_model("main"), content)
+
+        with self._lock:
+            self.routed_calls += 1
+        try:
+            result = self._invoke_model(_model(self.route), routed_content)
+            reason = self._escalation_reason(result)
+        except Exception as e:
+            reason = str(e)
+        return result if reason is None else self._escalate(content, reason)
+
+    def stream(self, content: List[Dict[str, Any]]) -> Iterator[Any]:
+        """Streams the answer of the LLM and yields the JSON parsed so far whenever it grows.
+
+        The last yielded value is the complete answer, parsed like in `invoke`. Closing the
+        iterator early stops the generation. A complete answer of the routed model is escalated
+        like in `invoke`; the answer of the main model is then yielded as a whole, so the last
+        value can differ from the ones streamed before it.
+        """
+        response = None
+        parsed = None
+        completed = False
+        routed_content = self.routed_content(content)
+        if routed_content is None:
+            messages = self.messages(content)
+            chunks = _model("main").stream(messages, **STREAM_OPTIONS["main"])
+        else:
+            with self._lock:
+                self.routed_calls += 1
+            messages = self.messages(routed_content)
+            chunks = _model(self.route).stream(messages, **STREAM_OPTIONS[self.route])
+        try:
+            for chunk in chunks:
+                response = chunk if response is None else response + chunk
+                # the accumulated answer is parsed, like the transform of the JSON output parser
+                # does, which would however consume the remaining stream when it is closed early
+                partial = self.parser.parse_result([ChatGeneration(message=response)], partial=True)
+                if partial is not None and partial != parsed:
+                    parsed = partial
+                    yield parsed
+            completed = True
+        finally:
+            chunks.close()
+            if response is not None and response.usage_metadata:
+                self.cache_stats.record(response.usage_metadata)
+            elif not completed:
+                self.cache_stats.record_truncated(estimate_input_tokens(messages))
+        response = response if response is not None else AIMessage(content="")
+        if routed_content is None:
+            final = self.parser.parse_result([ChatGeneration(message=response)])
+        else:
+            try:
+                final = self.parser.parse_result([ChatGeneration(message=response)])
+                reason = self._escalation_reason(final)
+            except Exception as e:
+                reason = str(e)
+            if reason is not None:
+                final = self._escalate(content, reason)
+        if final != parsed:
+            yield final
+
+
+PROMPTS: Dict[str, PrecompiledPrompt] = {}
+
+
+def register_prompt(task: str, system_prompt: str, pydantic_object: Type[BaseModel], user_prompt: Optional[str] = None) -> PrecompiledPrompt:
+    """Precompiles the prompt of a task and adds it to the module-level registry."""
+    prompt = PrecompiledPrompt(task, system_prompt, pydantic_object, user_prompt)
+    PROMPTS[task] = prompt
+    return prompt
+
+
+def prompt_cache_report() -> Dict[str, Dict[str, Any]]:
+    """Returns the number of calls, input tokens, cached tokens, cached-token ratio and model routing per task."""
+    return {
+        task: {
+            "model": prompt.route,
+            "routed_calls": prompt.routed_calls,
+            "escalations": prompt.escalations,
+            "image_only_calls": prompt.image_only_calls,
+            "calls": prompt.cache_stats.calls,
+            "input_tokens": prompt.cache_stats.input_tokens,
+            "cached_tokens": prompt.cache_stats.cached_tokens,
+            "cached_token_ratio": round(prompt.cache_stats.cached_token_ratio, 3),
+            "truncated_calls": prompt.cache_stats.truncated_calls,
+            "estimated_input_tokens": prompt.cache_stats.estimated_input_tokens,
+        }
+        for task, prompt in PROMPTS.items()
+    }
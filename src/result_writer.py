@@ -0,0 +1,78 @@
+import json
+import os
+import re
+import tempfile
+import urllib.parse
+from pathlib import Path
+from typing import Any, Dict
+
+# Keys of a table that are not written to the results: the OCR content and grid can be
+# reproduced from Document Intelligence, page images are never part of a table result.
+REDUNDANT_TABLE_KEYS = {"content", "grid", "base64"}
+
+
+def document_stem(doc_path: str) -> str:
+    """Returns the file name stem used for the outputs of a local document or a document URL."""
+    if doc_path.startswith(("http://", "https://")):
+        parsed_url = urllib.parse.urlparse(doc_path)
+        path_segments = parsed_url.path.split("/")
+        filename_from_url = path_segments[-1] if path_segments[-1] else "url_doc"
+        file_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", filename_from_url).split(".")[0]
+        return file_name or "url_document"
+    return Path(doc_path).stem
+
+
+def atomic_write_text(path: Path, text: str):
+    """Writes a file via a temporary file in the same directory and an atomic rename."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False) as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, path)
+
+
+def append_json_line(path: Path, record: Dict[str, Any]):
+    """Appends a record as one JSON line.
+
+    The line is written with a single write on a file opened with O_APPEND, so records of
+    concurrent writers are never interleaved.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def table_record(doc_path: str, table: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the result record of a table without OCR content, grid and page images."""
+    record = {"doc_path": doc_path}
+    record.update({key: value for key, value in table.items() if key not in REDUNDANT_TABLE_KEYS})
+    return record
+
+
+class TableResultWriter:
+    """Writes the results of a document table by table as soon as they are ready.
+
+    Every table is appended as one record to `<output_dir>/<stem>_<kind>.jsonl` and written
+    atomically to `<output_dir>/<stem>/table_<number>_<kind>.json`. Records are never
+    rewritten, so a document that is processed again appends new records; readers of the
+    JSON Lines file keep the last record per table number.
+    """
+
+    def __init__(self, doc_path: str, kind: str, output_dir: str = "output_data"):
+        self.doc_path = doc_path
+        self.kind = kind
+        stem = document_stem(doc_path)
+        self.jsonl_path = Path(output_dir) / f"{stem}_{kind}.jsonl"
+        self.tables_dir = Path(output_dir) / stem
+
+    def write_table(self, table: Dict[str, Any]) -> Dict[str, Any]:
+        """Writes the result of one table and returns the written record."""
+        record = table_record(self.doc_path, table)
+        atomic_write_text(self.tables_dir / f"table_{table['number']}_{self.kind}.json", json.dumps(record, ensure_ascii=False))
+        append_json_line(self.jsonl_path, record)
+        return record
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import struct
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from table_validation import canonical_number
+
+_TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)?|\w+", re.UNICODE)
+_NUMBER_TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)?$")
+
+# MinHash with 64 permutations, split into 16 LSH bands of 4 rows. Two tables with a Jaccard
+# similarity of 0.9 almost certainly share at least one band, tables with a similarity of 0.5
+# only with a probability of about 0.64, and those candidates are then checked with the full signature.
+NUM_PERMUTATIONS = 64
+BAND_ROWS = 4
+SHINGLE_SIZE = 3
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _seed(name: str) -> int:
+    return int.from_bytes(hashlib.sha1(name.encode("utf-8")).digest()[:8], "big")
+
+
+# fixed (a, b) of the hash permutations (a * x + b) mod p, so signatures stay comparable across runs
+_PERMUTATIONS = [(_seed(f"a{i}") % (_MERSENNE_PRIME - 1) + 1, _seed(f"b{i}") % _MERSENNE_PRIME) for i in range(NUM_PERMUTATIONS)]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (
+    id INTEGER PRIMARY KEY,
+    document TEXT NOT NULL,
+    table_number INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    numbers TEXT NOT NULL,
+    minhash TEXT NOT NULL,
+    relevant INTEGER,
+    extracted_data TEXT,
+    extraction_source TEXT,
+    normalized TEXT,
+    UNIQUE (document, table_number)
+);
+CREATE INDEX IF NOT EXISTS tables_fingerprint ON tables (fingerprint);
+CREATE TABLE IF NOT EXISTS bands (
+    table_id INTEGER NOT NULL REFERENCES tables (id) ON DELETE CASCADE,
+    band INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bands_hash ON bands (band, hash);
+CREATE INDEX IF NOT EXISTS bands_table ON bands (table_id);
+"""
+
+
+def canonical_tokens(content: str) -> List[str]:
+    """Splits the text of a table into lower-case words and canonical numbers, dropping markup and layout."""
+    return [
+        canonical_number(token) if _NUMBER_TOKEN_PATTERN.match(token) else token.lower()
+        for token in _TOKEN_PATTERN.findall(content or "")
+    ]
+
+
+def table_fingerprint(tokens: List[str]) -> str:
+    """Returns the hash of the canonical text of a table, equal for verbatim copies."""
+    return hashlib.sha256(" ".join(tokens).encode("utf-8")).hexdigest()
+
+
+def number_signature(tokens: List[str]) -> str:
+    """Returns the sorted numbers of a table; a stored result is only reused if they are identical."""
+    counts = Counter(token for token in tokens if _NUMBER_TOKEN_PATTERN.match(token))
+    return json.dumps(sorted(counts.items()))
+
+
+def minhash(tokens: List[str]) -> List[int]:
+    """Computes the MinHash signature of the token shingles of a table."""
+    shingles = {" ".join(tokens[i : i + SHINGLE_SIZE]) for i in range(max(len(tokens) - SHINGLE_SIZE + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+    return [min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in _PERMUTATIONS]
+
+
+def _band_hashes(signature: List[int]) -> List[str]:
+    return [
+        hashlib.sha1(struct.pack(f">{BAND_ROWS}Q", *signature[start : start + BAND_ROWS])).hexdigest()
+        for start in range(0, NUM_PERMUTATIONS, BAND_ROWS)
+    ]
+
+
+def _similarity(signature: List[int], other: List[int]) -> float:
+    return sum(value == other_value for value, other_value in zip(signature, other)) / NUM_PERMUTATIONS
+
+
+class TableFingerprintStore:
+    """A local SQLite index of the tables seen across the corpus, to reuse their results for copies.
+
+    Patent families repeat the same tables almost verbatim. Every table is stored with the hash
+    of its canonical text, the MinHash signature of its token shingles (indexed in LSH bands for
+    near-duplicates) and the sorted numbers of its text, together with its relevance, extracted
+    data and normalization. A new table matches a stored one if the canonical texts are equal,
+    or if the estimated similarity reaches `min_similarity`; in both cases the numbers have to
+    be identical, so a table with a single changed value is processed again.
+    """
+
+    def __init__(self, db_path: str, min_similarity: float = 0.9):
+        self.min_similarity = min_similarity
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def find(self, content: str, exclude_document: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Returns the stored results of a table with the same content, or None.
+
+        Args:
+            content: The text of the table.
+            exclude_document: A document whose own tables are not matched, e.g. the document
+                that is processed again.
+
+        Returns:
+            A dictionary with document, table_number, similarity, relevant, extracted_data,
+            extraction_source and normalized; the results that are not known yet are None.
+        """
+        tokens = canonical_tokens(content)
+        numbers = number_signature(tokens)
+        columns = "id, document, table_number, relevant, extracted_data, extraction_source, normalized"
+        row = self.connection.execute(
+            f"SELECT {columns} FROM tables WHERE fingerprint = ? AND numbers = ? AND document != ? ORDER BY id DESC LIMIT 1",
+            (table_fingerprint(tokens), numbers, exclude_document or ""),
+        ).fetchone()
+        similarity = 1.0
+        if row is None:
+            signature = minhash(tokens)
+            bands = _band_hashes(signature)
+            candidates = self.connection.execute(
+                f"SELECT DISTINCT t.id, t.minhash FROM bands b JOIN tables t ON t.id = b.table_id "
+                f"WHERE ({' OR '.join(['(b.band = ? AND b.hash = ?)'] * len(bands))}) AND t.numbers = ? AND t.document != ?",
+                [value for band in enumerate(bands) for value in band] + [numbers, exclude_document or ""],
+            ).fetchall()
+            best_id, similarity = None, 0.0
+            for table_id, stored_minhash in candidates:
+                candidate_similarity = _similarity(signature, json.loads(stored_minhash))
+                if candidate_similarity > similarity:
+                    best_id, similarity = table_id, candidate_similarity
+            if best_id is None or similarity < self.min_similarity:
+                return None
+            row = self.connection.execute(f"SELECT {columns} FROM tables WHERE id = ?", (best_id,)).fetchone()
+
+        _, document, table_number, relevant, extracted_data, extraction_source, normalized = row
+        return {
+            "document": document,
+            "table_number": table_number,
+            "similarity": similarity,
+            "relevant": None if relevant is None else bool(relevant),
+            "extracted_data": json.loads(extracted_data) if extracted_data else None,
+            "extraction_source": extraction_source,
+            "normalized": json.loads(normalized) if normalized else None,
+        }
+
+    def register(self, document: str, table: Dict[str, Any], relevant: Optional[bool] = None):
+        """Stores a table with its known results; a table that is registered again replaces its previous entry."""
+        tokens = canonical_tokens(table["content"])
+        signature = minhash(tokens)
+        extracted_data = table.get("extracted_data")
+        normalized = table.get("normalized")
+        with self.connection:
+            self.connection.execute("DELETE FROM tables WHERE document = ? AND table_number = ?", (document, table["number"]))
+            cursor = self.connection.execute(
+                "INSERT INTO tables (document, table_number, fingerprint, numbers, minhash, relevant, extracted_data, extraction_source, normalized) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    document,
+                    table["number"],
+                    table_fingerprint(tokens),
+                    number_signature(tokens),
+                    json.dumps(signature),
+                    None if relevant is None else int(relevant),
+                    json.dumps(extracted_data, ensure_ascii=False) if extracted_data else None,
+                    table.get("extraction_source"),
+                    json.dumps(normalized, ensure_ascii=False) if normalized else None,
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO bands (table_id, band, hash) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, band, band_hash) for band, band_hash in enumerate(_band_hashes(signature))],
+            )
+
+
+def fingerprint_store_from_env() -> Optional[TableFingerprintStore]:
+    """Opens the store configured by TABLE_FINGERPRINT_STORE_PATH, or returns None if it is not set."""
+    db_path = os.getenv("TABLE_FINGERPRINT_STORE_PATH")
+    if not db_path:
+        return None
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    return TableFingerprintStore(db_path, min_similarity=float(os.getenv("TABLE_FINGERPRINT_MIN_SIMILARITY", "0.9")))
@@ -0,0 +1,232 @@
+import re
+from typing import Any, Dict, List, Optional, Set
+
+# A cell counts as numeric if, apart from comparison signs, whitespace and a percent sign,
+# it consists of a single (optionally signed) number with "." or "," as decimal separator.
+_NUMERIC_CELL_PATTERN = re.compile(r"^[<>≤≥~±=\s]*([-+−]?\d+(?:[.,]\d+)?)\s*%?$")
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+# Placeholders that patents use for components that are not part of an example.
+_EMPTY_CELL_PLACEHOLDERS = {"", "-", "–", "—", "/", "n.a.", "n/a"}
+_MOL_PERCENT_PATTERN = re.compile(r"mol(?:e|ar)?\s*[-.]?\s*(?:%|percent|prozent)", re.IGNORECASE)
+_WEIGHT_PERCENT_PATTERN = re.compile(
+    r"(?:\bwt\b|\bweight\b|\bmass\b|\bmasse|\bgew)\s*[-.]?\s*(?:%|percent|prozent)|%\s*by\s*(?:weight|mass)|\bwt\.?\s*%", re.IGNORECASE
+)
+
+
+def canonical_number(token: str) -> str:
+    """Bring a numeric token into a comparable form ("1,50" and "1.50" become "1.50")."""
+    return token.strip().replace("−", "-").lstrip("+-").replace(",", ".")
+
+
+def parse_numeric_cell(cell: Any) -> Optional[str]:
+    """Return the canonical number of a numeric cell, or None if the cell is not numeric."""
+    if not isinstance(cell, str):
+        return None
+    match = _NUMERIC_CELL_PATTERN.match(cell)
+    if not match:
+        return None
+    return canonical_number(match.group(1))
+
+
+def ocr_numbers(content: str) -> Set[str]:
+    """Collect all numbers that appear in an OCR text in canonical form."""
+    return {canonical_number(token) for token in _NUMBER_PATTERN.findall(content or "")}
+
+
+def _mismatch(message: str, row: Optional[int] = None, column: Optional[int] = None) -> Dict[str, Any]:
+    return {"row": row, "column": column, "message": message}
+
+
+def check_row(row_index: int, row: List[Any], known_numbers: Set[str]) -> List[Dict[str, Any]]:
+    """Check that every numeric cell of an extracted row appears in the OCR text.
+
+    Args:
+        row_index: Index of the row within the extracted table data.
+        row: The extracted cell values of the row.
+        known_numbers: Canonical numbers found in the OCR text (see `ocr_numbers`).
+
+    Returns:
+        A list of mismatches, one per numeric cell that is missing from the OCR text.
+    """
+    mismatches = []
+    for column_index, cell in enumerate(row):
+        number = parse_numeric_cell(cell)
+        if number is not None and number not in known_numbers:
+            mismatches.append(
+                _mismatch(f"Value '{cell}' in row {row_index}, column {column_index} does not appear in the OCR text.", row_index, column_index)
+            )
+    return mismatches
+
+
+def grid_to_table_data(grid: Dict[str, Any]) -> List[List[str]]:
+    """Turn a Document Intelligence grid into table data, dropping completely empty rows and columns."""
+    grid_rows = [grid["headers"]] + grid["rows"]
+    filled_rows = [row for row in grid_rows if any(cell.strip() for cell in row)]
+    column_count = max((len(row) for row in filled_rows), default=0)
+    filled_columns = [
+        column_index for column_index in range(column_count) if any(column_index < len(row) and row[column_index].strip() for row in filled_rows)
+    ]
+    return [[row[column_index] if column_index < len(row) else "" for column_index in filled_columns] for row in filled_rows]
+
+
+def _grid_shape(grid: Dict[str, Any]) -> tuple[int, int]:
+    """Row and column count of a Document Intelligence grid, ignoring completely empty rows and columns."""
+    table_data = grid_to_table_data(grid)
+    return len(table_data), len(table_data[0]) if table_data else 0
+
+
+def check_shape(table_data: List[List[Any]], grid: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Compare the shape of the extracted table data with the Document Intelligence grid.
+
+    The extraction may transpose the table, so both orientations of the grid are accepted.
+    """
+    mismatches = []
+    column_counts = {len(row) for row in table_data}
+    if len(column_counts) > 1:
+        expected_columns = max(column_counts, key=lambda count: sum(len(row) == count for row in table_data))
+        for row_index, row in enumerate(table_data):
+            if len(row) != expected_columns:
+                mismatches.append(_mismatch(f"Row {row_index} has {len(row)} columns, but most rows have {expected_columns}.", row_index))
+        return mismatches
+
+    extracted_shape = (len(table_data), column_counts.pop() if column_counts else 0)
+    grid_rows, grid_columns = _grid_shape(grid)
+    if extracted_shape not in ((grid_rows, grid_columns), (grid_columns, grid_rows)):
+        mismatches.append(
+            _mismatch(
+                f"The extracted table has {extracted_shape[0]} rows and {extracted_shape[1]} columns, "
+                f"but the OCR table has {grid_rows} rows and {grid_columns} columns."
+            )
+        )
+    return mismatches
+
+
+def verify_table_locally(table: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Mechanically cross-check the extracted data of a table against its OCR content.
+
+    Every numeric cell must appear in `table["content"]` and the row and column counts must
+    match the Document Intelligence grid (`table["grid"]`) if one is available.
+
+    Args:
+        table: A table dictionary with "content", "extracted_data" and optionally "grid".
+
+    Returns:
+        A list of mismatches as dictionaries with "row", "column" and "message". An empty list
+        means the extraction is consistent with the OCR result.
+    """
+    extracted_data = table.get("extracted_data") or {}
+    table_data = extracted_data.get("table_data") or []
+    if not table_data:
+        return [_mismatch("No table data was extracted.")]
+
+    mismatches = []
+    grid = table.get("grid")
+    if grid:
+        mismatches.extend(check_shape(table_data, grid))
+
+    known_numbers = ocr_numbers(table.get("content", ""))
+    for row_index, row in enumerate(table_data):
+        mismatches.extend(check_row(row_index, row, known_numbers))
+    return mismatches
+
+
+def flagged_cells_of(mismatches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Collect the cells and rows that mismatches point to; mismatches of the whole table are skipped."""
+    flagged = []
+    for mismatch in mismatches:
+        if mismatch.get("row") is None:
+            continue
+        cell = {"row": mismatch["row"], "column": mismatch.get("column")}
+        if cell not in flagged:
+            flagged.append(cell)
+    return flagged
+
+
+def patch_table_data(table_data: List[List[str]], cells: List[Dict[str, Any]], rows: List[Dict[str, Any]]) -> List[List[str]]:
+    """Apply corrected cells ({"row", "column", "value"}) and rows ({"row", "values"}) to a copy of table data.
+
+    Corrections outside of the table are ignored.
+    """
+    patched = [list(row) for row in table_data]
+    for row in rows:
+        if 0 <= row["row"] < len(patched):
+            patched[row["row"]] = list(row["values"])
+    for cell in cells:
+        if 0 <= cell["row"] < len(patched) and 0 <= cell["column"] < len(patched[cell["row"]]):
+            patched[cell["row"]][cell["column"]] = cell["value"]
+    return patched
+
+
+def stitch_table_chunks(chunk_tables: List[List[List[str]]]) -> tuple[List[List[str]], List[str]]:
+    """Stitch the table data of row chunks, which all start with the header row, into one table.
+
+    Every chunk must repeat the header of the first chunk and all rows must have as many
+    columns as the header, otherwise a chunk was transposed or shifted by the extraction.
+
+    Returns:
+        The stitched table data and the reasons why the chunks do not fit together; the table
+        data can only be used if there are no reasons.
+    """
+    if not chunk_tables or not all(chunk_tables):
+        return [], ["A chunk has no table data."]
+
+    def canonical_header(row: List[str]) -> List[str]:
+        return ["".join(str(cell).split()) for cell in row]
+
+    header = chunk_tables[0][0]
+    reasons = []
+    for chunk_index, chunk_table in enumerate(chunk_tables):
+        if canonical_header(chunk_table[0]) != canonical_header(header):
+            reasons.append(f"The header of chunk {chunk_index} differs from the header of the first chunk.")
+        column_counts = {len(row) for row in chunk_table}
+        if column_counts != {len(header)}:
+            reasons.append(f"Chunk {chunk_index} has rows with {sorted(column_counts)} columns, the header has {len(header)}.")
+    stitched = [list(header)] + [list(row) for chunk_table in chunk_tables for row in chunk_table[1:]]
+    return stitched, reasons
+
+
+def format_mismatches(mismatches: List[Dict[str, Any]]) -> str:
+    """Render mismatches as a feedback text for the LLM."""
+    return "\n".join(f"- {mismatch['message']}" for mismatch in mismatches)
+
+
+def detect_weight_percent(text: str) -> Optional[bool]:
+    """Detect whether a text states weight% (True) or mol% (False); None if unclear or both."""
+    is_mol = bool(_MOL_PERCENT_PATTERN.search(text or ""))
+    is_weight = bool(_WEIGHT_PERCENT_PATTERN.search(text or ""))
+    if is_mol == is_weight:
+        return None
+    return is_weight
+
+
+def assess_grid_quality(grid: Optional[Dict[str, Any]], min_numeric_rate: float = 0.9) -> List[str]:
+    """Check whether a Document Intelligence grid can be used as extraction result without an LLM.
+
+    The value cells (all cells except the header row and the label column) must mostly parse as
+    numbers, the grid must not contain merged cells and all rows must have the same column count.
+
+    Args:
+        grid: The grid of a table as built in the extract table agent.
+        min_numeric_rate: Minimum share of filled value cells that must be numeric.
+
+    Returns:
+        The reasons why the grid is not clean; an empty list if it can be used directly.
+    """
+    if not grid or not grid.get("rows"):
+        return ["The table has no grid with data rows."]
+
+    reasons = []
+    if grid.get("merged_cells", 0):
+        reasons.append(f"The table contains {grid['merged_cells']} merged cells.")
+    column_counts = {len(row) for row in [grid["headers"]] + grid["rows"]}
+    if len(column_counts) > 1:
+        reasons.append(f"The rows have inconsistent column counts {sorted(column_counts)}.")
+
+    value_cells = [cell.strip() for row in grid["rows"] for cell in row[1:]]
+    filled_cells = [cell for cell in value_cells if cell.lower() not in _EMPTY_CELL_PLACEHOLDERS]
+    numeric_cells = [cell for cell in filled_cells if parse_numeric_cell(cell) is not None]
+    if not numeric_cells:
+        reasons.append("The table contains no numeric values.")
+    elif len(numeric_cells) / len(filled_cells) < min_numeric_rate:
+        reasons.append(f"Only {len(numeric_cells)} of {len(filled_cells)} value cells are numeric.")
+    return reasons
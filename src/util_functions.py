@@ -1,4 +1,5 @@
 import base64
+import threading
 from io import BytesIO
 from PIL import Image
 from langchain_core.prompts.image import ImagePromptTemplate
@@ -6,9 +7,12 @@ from langchain_core.prompts import HumanMessagePromptTemplate
 import base64
 from io import BytesIO
 from PIL import Image
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, convert_from_path
 from PIL import Image
 
+# PyMuPDF is not thread-safe, documents that are processed concurrently use it one after the other
+PYMUPDF_LOCK = threading.Lock()
+
 def get_mime_type(fmt):
     """Get MIME type for a given image format.
 
@@ -120,6 +124,17 @@ def add_file_content_to_messages(messages, image_path: str):
 
     return messages
 
+def _images_to_base64(images, fmt):
+    mime_type = get_mime_type(fmt)
+    data_url_prefix = f"data:{mime_type};base64,"
+    base64_images = []
+    for image in images:
+        buffered = BytesIO()
+        image.save(buffered, format=fmt.upper())
+        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        base64_images.append(f"{data_url_prefix}{img_str}")
+    return base64_images
+
 def pdf_to_base64_images(pdf_bytes, dpi=200, fmt="jpeg", poppler_path=None):
     """Convert PDF bytes to a list of base64 data URLs (one per page).
 
@@ -132,20 +147,26 @@ def pdf_to_base64_images(pdf_bytes, dpi=200, fmt="jpeg", poppler_path=None):
     Returns:
         List of base64 data URL strings, one per page. Returns empty list on error.
     """
-    base64_images = []
     try:
         images = convert_from_bytes(pdf_bytes, dpi=dpi, fmt=fmt, poppler_path=poppler_path,size=(892, 1263))
-        mime_type = get_mime_type(fmt)
-        data_url_prefix = f"data:{mime_type};base64,"
-
-        for image in images:
-            buffered = BytesIO()
-            image.save(buffered, format=fmt.upper())
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            base64_images.append(f"{data_url_prefix}{img_str}")
+        base64_images = _images_to_base64(images, fmt)
 
     except Exception as e:
         print(f"Error converting PDF to images: {e}")
         return []
 
-    return base64_images 
\ No newline at end of file
+    return base64_images 
+
+def pdf_pages_to_base64_images(pdf_path, first_page, last_page, dpi=200, fmt="jpeg", poppler_path=None):
+    """Convert a range of pages of a PDF file to base64 data URLs, like `pdf_to_base64_images`.
+
+    Args:
+        pdf_path: Path to the PDF file, which poppler reads directly.
+        first_page: Number of the first page to convert (1-based).
+        last_page: Number of the last page to convert (inclusive).
+
+    Returns:
+        List of base64 data URL strings, one per page of the range. Errors are raised.
+    """
+    images = convert_from_path(pdf_path, dpi=dpi, fmt=fmt, first_page=first_page, last_page=last_page, poppler_path=poppler_path, size=(892, 1263))
+    return _images_to_base64(images, fmt)